@@ -5,26 +5,12 @@ Stores file data in a sqlite database for rapid localization of files on a tape
 """
 
 # Global libraries
-import datetime
-import fnmatch
+import contextlib
+import errno
 import os
-import subprocess
 import sys
-import tempfile
 import time
 
-# Installed libraries
-import sqlite3
-
-# My installed libraries
-from sqlitehelper import SH, DBTable, DBCol, DBColROWID
-
-# Used for notifications
-try:
-	import pushover
-except:
-	pushover = None
-
 # Path of configuration file for Pushover
 PUSHOVER_CFG_FILE = "~/.pushoverrc"
 PUSHOVER_CFG_FILE = os.path.expanduser(PUSHOVER_CFG_FILE)
@@ -32,33 +18,74 @@ PUSHOVER_CFG_FILE = os.path.expanduser(PUSHOVER_CFG_FILE)
 
 from .util import PrintHelpException, ItemExists, ItemNotFound, DataArgsParser, getuname
 from .util import dateYYYYMMDD, dateYYYYMMDDHHMMSS, rangeint, hashfile
+from .stats import STATS, Progress, fmt_bytes
+
+# Number of files looked up in the catalog at once while queueing
+QUEUE_CHUNK = 10000
+
+
+def __getattr__(name):
+	"""
+	Import the catalog (and sqlitehelper with it) only when first used, so that
+	actions which don't need it start quickly.
+	"""
+	if name == 'db':
+		from .catalog import db
+		return db
 
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-def send_notification(args, flags, msg):
+# Background notification dispatcher, created on first use
+_notifier = None
+
+def get_notifier(args):
 	"""
-	Fault-tolerant (if not installed or throws an exception) push notification to update the user.
+	Get the notification dispatcher, creating it on first use.
+	Raises ImportError if the transport requires a library that is not installed.
 	"""
-	# Not configured, cannot notify
-	if pushover is None: return
+	global _notifier
+
+	if _notifier is None:
+		from . import notify
+
+		transport = notify.get_transport(args.notify_to, timeout=args.notify_timeout)
+		_notifier = notify.Dispatcher(transport, timeout=args.notify_timeout)
+
+	return _notifier
 
+def close_notifications():
+	"""Flush any pending notifications before exiting"""
+	global _notifier
+
+	if _notifier is not None:
+		_notifier.close()
+		_notifier = None
+
+def send_notification(args, flags, msg, key=None):
+	"""
+	Fault-tolerant, non-blocking push notification to update the user.
+	Messages are handed to a background dispatcher so a slow endpoint cannot stall the caller.
+	Pending messages with the same @key are coalesced into the newest one.
+	"""
 	# User doesn't want notifications
-	if args.notify == 'none': return
+	if args.notify is None or args.notify == 'none': return
 
 	# Flags specified by the code 
 	if args.notify not in flags: return
 
+	print("notify: %s" % msg)
+
 	try:
-		pushover.Client().send_message(msg, title="pymtar")
+		get_notifier(args).post(msg, key=key)
 	except Exception as e:
+		# Not configured, cannot notify
 		print("Failed to send message: %s" % e)
-	finally:
-		print("notify: %s" % msg)
 
 def send_notification_queue_start(args, num_files, vals):
 	send_notification(args, ('all','limited'), "starting queue of %d files to tape=%s and num=%d" % (num_files, vals['tape'], vals['tar']))
 
 def send_notification_queue_step(args, x, num_files, id_tape, num):
-	send_notification(args, ('all',), "queue %d files of %d done to tape=%s and num=%d" % (x,num_files,id_tape,num))
+	send_notification(args, ('all',), "queue %d files of %d done to tape=%s and num=%d" % (x,num_files,id_tape,num), key='queue-step')
 
 def send_notification_queue_done(args, id_tape, num):
 	send_notification(args, ('all','limited'), "queue completed to tape=%s and num=%d" % (id_tape,num))
@@ -80,224 +107,6 @@ def send_notification_tar_done(args, id_tape, num):
 
 
 
-class db(SH):
-	"""DB schema"""
-
-	__schema__ = [
-		DBTable('tape',
-			DBColROWID(),
-			DBCol('manufacturer', 'text'), # Tape manufacturer
-			DBCol('model', 'text'), # Tape model number
-			DBCol('gen', 'text'), # Generation (eg, "LTO8RW")
-			DBCol('sn', 'text'), # Serial number on cartridge
-			DBCol('barcode', 'text'), # Standard LTO barcode, null if not used
-			DBCol('ptime', 'date') # Purchase date and time
-		),
-		# A tape "file" equivalent to a tar file
-		DBTable('tar',
-			DBColROWID(),
-			DBCol('id_tape', 'integer'), # Tape this tar belongs to
-			DBCol('num', 'integer'), # File number on the tape
-			DBCol('stime', 'datetime'), # Star write time
-			DBCol('etime', 'datetime'), # End write time
-			DBCol('access_cnt', 'integer'), # Read counter
-			DBCol('blk_offset', 'integer'), # Block offset on tape
-			DBCol('options', 'text'), # Options supplied to tar (eg, z, j)
-			DBCol('uname', 'text'), # uname -a value at time of write
-		),
-		# One row per file stored in a tar file
-		DBTable('tarfile',
-			DBColROWID(),
-			DBCol('id_tape', 'integer'), # Tape this file belongs to
-			DBCol('id_tar', 'integer'), # tar file this file belongs to
-			DBCol('fullpath', 'text'), # Full, absolute path
-			DBCol('relpath', 'text'), # Relative path as supplied to tar
-			DBCol('fname', 'text'), # File name
-			DBCol('sz', 'integer'), # Size of file in bytes
-			DBCol('sha256', 'text') # sha256 hash
-		)
-	]
-
-	def open(self, rowfactory=None):
-		ex = os.path.exists(self.Filename)
-
-		super().open()
-
-		if not ex:
-			self.MakeDatabaseSchema()
-
-	def reopen(self):
-		super().reopen()
-
-	@staticmethod
-	def _now():
-		return datetime.datetime.utcnow()
-
-	# -------------------------------------------------------------------------
-	# -------------------------------------------------------------------------
-	# Tapes
-
-	def find_tapes(self):
-		res = self.tape.select('*')
-		return [dict(_) for _ in res]
-
-	def find_tape_by_id(self, rowid):
-		res = self.tape.select('*', 'rowid=?', [rowid])
-		return [dict(_) for _ in res]
-
-	def find_tape_by_sn(self, sn):
-		res = self.tape.select('*', 'sn=?', [sn])
-		return [dict(_) for _ in res]
-
-	def find_tape_by_barcode(self, bcode):
-		res = self.tape.select('*', 'barcode=?', [bcode])
-		return [dict(_) for _ in res]
-
-	def find_tape_by_multi(self, val):
-		res = self.tape.select('*', 'rowid=? or sn=? or barcode=?', [val,val,val])
-		return [dict(_) for _ in res]
-
-	def new_tape(self, manufacturer, model, gen, sn, barcode, ptime):
-		rows = self.find_tape_by_sn(sn)
-		if len(rows):
-			raise ItemExists("Tape with serial number '%s' already exists, cannot add it again" % sn)
-
-		if barcode is not None:
-			rows = self.find_tape_by_barcode(barcode)
-			if len(rows):
-				raise ItemExists("Tape with barcode '%s' already exists, cannot add it again" % barcode)
-
-		# TODO: validate gen
-		# TODO: validate ptime
-
-		self.begin()
-		ret = self.tape.insert(manufacturer=manufacturer, model=model, gen=gen, sn=sn, barcode=barcode, ptime=ptime)
-		self.commit()
-		return ret
-
-	# -------------------------------------------------------------------------
-	# -------------------------------------------------------------------------
-	# Tars
-
-	def find_tars(self):
-		res = self.tar.select('*')
-		return [dict(_) for _ in res]
-
-	def find_tars_by_tape_multi(self, val):
-		rows = self.find_tape_by_multi(val)
-		if not len(rows):
-			return None
-
-		res = self.tar.select('*', 'id_tape=?', [rows[0]['rowid']])
-		return [dict(_) for _ in res]
-
-	def find_tars_by_tape_num(self, tape, num):
-		rows = self.find_tape_by_multi(tape)
-		if not len(rows):
-			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
-
-		id_tape = rows[0]['rowid']
-
-		res = self.tar.select('*', 'id_tape=? and num=?', [id_tape, num])
-		rows = [dict(_) for _ in res]
-		if not len(rows):
-			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d)" % (num, tape, id_tape))
-
-		return rows[0]
-
-	def new_tar(self, tape, num, stime, etime, access_cnt, options, uname):
-		rows = self.find_tape_by_multi(tape)
-		if not len(rows):
-			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
-
-		id_tape = rows[0]['rowid']
-
-		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, num])
-		rows = res.fetchall()
-		if len(rows):
-			raise ItemExists("Tar file num %d with tape '%s' (rowid=%d) already exists, cannot add it again" % (num, tape, id_tape))
-
-		self.begin()
-		ret = self.tar.insert(id_tape=id_tape, num=num, stime=stime, etime=etime, access_cnt=access_cnt, options=options, uname=uname)
-		self.commit()
-		return ret
-
-	def get_tar(self, id_tar):
-		res = self.tar.select('*', '`rowid`=?', [id_tar])
-		if res is None:
-			return None
-		else:
-			return res.fetchone()
-
-	# -------------------------------------------------------------------------
-	# -------------------------------------------------------------------------
-	# Tar files
-
-	def find_tarfiles(self):
-		res = self.tar.select('*')
-		return [dict(_) for _ in res]
-
-	def find_tarfiles_by_tape(self, val):
-		rows = self.find_tape_by_multi(val)
-		if not len(rows):
-			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
-
-		id_tape = rows[0]['rowid']
-
-		res = self.tarfile.select('*', 'id_tape=?', [id_tape])
-		return [dict(_) for _ in res]
-
-	def find_tarfiles_by_tar(self, tape, tar):
-		rows = self.find_tape_by_multi(tape)
-		if not len(rows):
-			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
-
-		id_tape = rows[0]['rowid']
-
-		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, int(tar)])
-		rows = res.fetchall()
-		if not len(rows):
-			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d), cannot add tar file" % (tar, tape, id_tape))
-
-		id_tar = rows[0]['rowid']
-
-		res = self.tarfile.select('*', 'id_tape=? and id_tar=?', [id_tape, id_tar])
-		return [dict(_) for  _ in res]
-
-	def new_tarfile(self, tape, tar, fullpath, relpath, fname, sz, sha256):
-		rows = self.find_tape_by_multi(tape)
-		if not len(rows):
-			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
-
-		id_tape = rows[0]['rowid']
-
-		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, int(tar)])
-		rows = res.fetchall()
-		if not len(rows):
-			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d), cannot add tar file" % (tar, tape, id_tape))
-
-		id_tar = rows[0]['rowid']
-
-		self.begin()
-		ret = self.tarfile.insert(id_tape=id_tape, id_tar=id_tar, fullpath=fullpath, relpath=relpath, fname=fname, sz=sz, sha256=sha256)
-		self.commit()
-		return ret
-
-	def find_tarfiles_by_name(self, pattern):
-		res = self.tarfile.select('*', None, None, '`id_tape` asc, `id_tar` asc')
-		for row in res:
-			# Get the full path
-			path = row['fullpath']
-			# And get just the filename
-			parts = path.split('/')
-
-			# Match pattern on just the file name itself, not full path
-			if fnmatch.fnmatch(parts[-1], pattern):
-				row = dict(row)
-				tar_row = self.get_tar(row['id_tar'])
-				row['tar'] = dict(tar_row)
-				yield row
-
 class mt:
 	"""
 	Wrapper class to the command line tool mt(1) that provides tape control function.
@@ -324,7 +133,11 @@ class mt:
 
 	@staticmethod
 	def _run(*args, timeout=5):
-		r = subprocess.run(args, timeout=timeout, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+		import subprocess
+
+		# Time each mt operation separately (eg, mt.status, mt.fsf)
+		with STATS.phase('mt.' + args[3]):
+			r = subprocess.run(args, timeout=timeout, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
 		return r.stdout.decode('ascii')
 
@@ -377,6 +190,177 @@ class mt:
 
 		self._run('mt', '-f', self._dev, 'asf', str(cnt), timeout=None)
 
+	@contextlib.contextmanager
+	def open_write(self):
+		"""Open the drive to write a tape file at the current position, a file mark is written on close"""
+		with open(self._dev, 'wb', buffering=0) as f:
+			yield f
+
+	@contextlib.contextmanager
+	def open_read(self):
+		"""Open the drive to read the tape file at the current position"""
+		with open(self._dev, 'rb', buffering=0) as f:
+			yield f
+
+class _LimitedWriter:
+	"""Writer passing writes on to @dst until @left bytes are used, then failing them whole with ENOSPC"""
+
+	def __init__(self, dst, left):
+		self.dst = dst
+		self.left = left
+
+	def write(self, data):
+		if len(data) > self.left:
+			raise OSError(errno.ENOSPC, "No space left on tape")
+		self.left -= len(data)
+		return self.dst.write(data)
+
+class filetape:
+	"""
+	File-backed stand-in for a tape drive with the same interface as mt.
+	Used for testing and benchmarking without a drive.
+
+	The directory @path holds one file per tape file (file00000, file00001, ...) and the head
+	position is kept in @path/.position so it persists between invocations like a real drive.
+	Positioning follows the Linux st(4) semantics described in the README (eg, bsf leaves
+	the head at block -1 of the previous file).
+	Writes are limited to @rate bytes per second if given, like a drive streaming at that rate.
+	A byte count in @path/.capacity makes it a cartridge of that size: a write that doesn't fit
+	in what the tape files so far leave fails with ENOSPC, like a drive at the end of the medium.
+	"""
+
+	def __init__(self, path, rate=None):
+		self._dir = os.path.abspath(path)
+		self._rate = rate
+		self._posfile = os.path.join(self._dir, '.position')
+
+		if not os.path.isdir(self._dir):
+			raise Exception("File-backed tape is not a directory: %s" % self._dir)
+
+		# Execute a command
+		self.status()
+
+	def _fname(self, fnum):
+		return os.path.join(self._dir, 'file%05d' % fnum)
+
+	def _numfiles(self):
+		cnt = 0
+		while os.path.exists(self._fname(cnt)):
+			cnt += 1
+		return cnt
+
+	def _capacity(self):
+		"""Bytes the cartridge holds from @path/.capacity, None if not limited"""
+		fname = os.path.join(self._dir, '.capacity')
+		if not os.path.exists(fname):
+			return None
+
+		with open(fname, 'r') as f:
+			return int(f.read().strip())
+
+	def _getpos(self):
+		if not os.path.exists(self._posfile):
+			return (0, 0)
+
+		with open(self._posfile, 'r') as f:
+			fnum, blk = f.read().split()
+			return (int(fnum), int(blk))
+
+	def _setpos(self, fnum, blk):
+		with open(self._posfile, 'w') as f:
+			f.write("%d %d\n" % (fnum, blk))
+
+	def status(self):
+		"""(file number, block position, partition) like mt.status()"""
+		with STATS.phase('mt.status'):
+			fnum, blk = self._getpos()
+			return (fnum, blk, 0)
+
+	def rewind(self):
+		"""Rewind tape to the beginning"""
+		with STATS.phase('mt.rewind'):
+			self._setpos(0, 0)
+
+	def offline(self):
+		"""aka eject, which for a directory is just a rewind"""
+		with STATS.phase('mt.offline'):
+			self._setpos(0, 0)
+
+	def bsf(self, cnt=1):
+		"""Move back one file, or @cnt if provided"""
+		if type(cnt) is not int:
+			raise Exception("bsf: cnt parameter must be an integer, got '%s' type %s" % (cnt,type(cnt)))
+
+		with STATS.phase('mt.bsf'):
+			fnum, blk = self._getpos()
+			if fnum - cnt < 0:
+				self._setpos(0, 0)
+			else:
+				self._setpos(fnum - cnt, -1)
+
+	def fsf(self, cnt=1):
+		"""Move forward one file, or @cnt if provided"""
+		if type(cnt) is not int:
+			raise Exception("fsf: cnt parameter must be an integer, got '%s' type %s" % (cnt,type(cnt)))
+
+		with STATS.phase('mt.fsf'):
+			fnum, blk = self._getpos()
+			if fnum + cnt > self._numfiles():
+				raise Exception("fsf: cannot space past end of data (file %d of %d)" % (fnum + cnt, self._numfiles()))
+			self._setpos(fnum + cnt, 0)
+
+	def asf(self, cnt):
+		"""Rewind the tape and advance to @cnt files"""
+		if type(cnt) is not int:
+			raise Exception("fsf: cnt parameter must be an integer, got '%s' type %s" % (cnt,type(cnt)))
+
+		self.rewind()
+		self.fsf(cnt)
+
+	@contextlib.contextmanager
+	def open_write(self):
+		"""Write a tape file at the current position, discarding it and every later file like a real tape"""
+		fnum, blk = self._getpos()
+		if blk != 0:
+			raise Exception("Can only write at the start of a tape file, at %s" % ((fnum, blk),))
+
+		for x in range(fnum, self._numfiles()):
+			os.unlink(self._fname(x))
+
+		cap = self._capacity()
+		with open(self._fname(fnum), 'wb') as f:
+			out = f
+			if cap is not None:
+				used = sum(os.path.getsize(self._fname(_)) for _ in range(fnum))
+				out = _LimitedWriter(out, cap - used)
+			if self._rate:
+				from .stream import ThrottledWriter
+				out = ThrottledWriter(out, self._rate)
+			yield out
+
+		# File mark written, head is at the start of the next file
+		self._setpos(fnum+1, 0)
+
+	@contextlib.contextmanager
+	def open_read(self):
+		"""Read the tape file at the current position"""
+		fnum, blk = self._getpos()
+		with open(self._fname(fnum), 'rb') as f:
+			yield f
+			at_end = f.read(1) == b''
+
+		# Reading through the file mark leaves the head at the start of the next file
+		if at_end:
+			self._setpos(fnum+1, 0)
+		else:
+			self._setpos(fnum, 1)
+
+def get_tape(dev):
+	"""Get a tape controller for @dev, which is a device file or a directory for a file-backed tape"""
+	if os.path.isdir(dev):
+		return filetape(dev)
+	else:
+		return mt(dev)
 
 
 class actions:
@@ -385,13 +369,39 @@ class actions:
 	This utilizes the pymtar.db class to interact with the database.
 	"""
 
+	# Catalog provider used in place of opening the catalog (eg, by the daemon), see daemon.Daemon
+	_db_provider = None
+
 	@classmethod
-	def _db_open(kls, args):
+	def _db_open(kls, args, readonly=False):
+		"""Open the catalog, @readonly for actions that only query it"""
+		if kls._db_provider is not None:
+			return kls._db_provider(args)
+
+		from .catalog import db
+
 		d = db(os.path.join(os.getcwd(), args.db))
-		d.open()
+		d.open(profile=args.db_profile, readonly=readonly)
 
 		return d
 
+	# Latest value of each per-write gauge, kept so that every drive appears in the export
+	_prom_gauges = {}
+
+	@classmethod
+	def _write_prometheus(kls, args, extra=None):
+		"""Export counters and timers to the Prometheus textfile if requested"""
+		if args.prom_textfile is None:
+			return
+
+		for name, labels, value in (extra or []):
+			kls._prom_gauges[ (name, tuple(sorted(labels.items()))) ] = (name, labels, value)
+
+		try:
+			STATS.write_prometheus(args.prom_textfile, list(kls._prom_gauges.values()))
+		except OSError as e:
+			print("Failed to write Prometheus textfile '%s': %s" % (args.prom_textfile, e))
+
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
 	@classmethod
@@ -403,11 +413,114 @@ class actions:
 		acts['queue'] = kls.action_queue
 		acts['write'] = kls.action_write
 		acts['extract'] = kls.action_extract
+		acts['verify'] = kls.action_verify
+		acts['plan'] = kls.action_plan
+		acts['daemon'] = kls.action_daemon
+		acts['replicate'] = kls.action_replicate
+		acts['import'] = kls.action_import
+		acts['checkpoint'] = kls.action_checkpoint
+
+		if args.action[0] not in acts:
+			raise PrintHelpException("Action '%s' not recognized" % args.action[0])
 
-		if args.action[0] in acts:
+		try:
 			acts[ args.action[0] ](args)
+		finally:
+			close_notifications()
+
+	@classmethod
+	def _seek_tar(kls, m, num):
+		"""Position tape controller @m at the start of tape file @num"""
+		# Move the tape as appropriate
+		ret = m.status()
+		if ret[0] == -1:
+			raise Exception("no tape present, cannot seek")
+
+		# Go all the way back to start of the tape
+		elif num == 0:
+			m.rewind()
+
+		# Not the first file, so look for it
 		else:
-			raise PrintHelpException("Action '%s' not recognized" % args.action[0])
+			# 3 cases of being at the start, middle, or end of the desired file number
+			if num == ret[0] and ret[1] == 0:
+				# Already there
+				pass
+
+			elif num == ret[0] and ret[1] > 0:
+				# In the middle of the desired file number, so have to back up and then forward
+
+				# Back up to (ret[0]-1, -1)
+				m.bsf()
+				# Forward to (ret[0], 0)
+				m.fsf()
+
+			elif num == ret[0] and ret[1] == -1:
+				# At the end of the desired file number, so have to back up and then forward
+
+				# Back up to (ret[0]-1, -1)
+				m.bsf()
+				# Forward to (ret[0], 0)
+				m.fsf()
+
+			# Need to advance a number of files:
+			elif ret[0] < num:
+				m.fsf(num - ret[0])
+
+			# Need to backup a number of files
+			elif num < ret[0]:
+				# Have to back up one more than desired (to end of previous file)
+				m.bsf(ret[0] - num + 1)
+				# then advance one to start of desired file
+				m.fsf(1)
+
+		ret2 = m.status()
+		if num != ret2[0] and ret2[1] != 0:
+			raise Exception("Failed to seek tape: desired file number %d, was at %s and now at %s" % (num, ret, ret2))
+
+	@classmethod
+	def _changer(kls, args):
+		"""Tape changer from --changer, None if not used"""
+		if args.changer is None:
+			return None
+
+		if kls._changer_obj is None:
+			from .changer import get_changer
+			kls._changer_obj = get_changer(args.changer, args.files)
+
+		return kls._changer_obj
+
+	# Changer, created on first use
+	_changer_obj = None
+
+	@classmethod
+	def _cache(kls, args):
+		"""Restore cache from --cache, None if not used"""
+		if args.cache is None:
+			return None
+
+		from .cache import RestoreCache
+		return RestoreCache(args.cache, args.cache_size * 1024 * 1024)
+
+	@classmethod
+	def _mount(kls, args, tape, drive=0):
+		"""
+		Get the device for @tape in @drive, loading it with the changer if there is one or
+		otherwise asking for it to be inserted.
+		"""
+		ch = kls._changer(args)
+		if ch is not None:
+			if not tape['barcode']:
+				raise Exception("Tape SN=%s has no barcode, cannot load it with the changer" % tape['sn'])
+
+			ch.load(tape['barcode'], drive)
+			return ch.device(drive)
+
+		dev = args.files[drive]
+		print("Insert tape SN=%s, barcode=%s into %s" % (tape['sn'], tape['barcode'], dev))
+		if sys.stdin.isatty():
+			input("Press enter when loaded")
+		return dev
 
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
@@ -427,22 +540,67 @@ class actions:
 
 	@classmethod
 	def action_find_tape_barcode(kls, args, bcode):
-		d = kls._db_open(args)
-		print(d.find_tape_by_barcode(bcode))
+		d = kls._db_open(args, readonly=True)
+		if d.find_shard_paths():
+			print(list(d.federated(kls._FEDERATED_TAPES + " where p.`barcode`=?", [bcode], order=('shard', 'rowid'))))
+		else:
+			print(d.find_tape_by_barcode(bcode))
 
 	@classmethod
 	def action_find_tape_sn(kls, args, sn):
-		d = kls._db_open(args)
-		print(d.find_tape_by_sn(sn))
+		d = kls._db_open(args, readonly=True)
+		if d.find_shard_paths():
+			print(list(d.federated(kls._FEDERATED_TAPES + " where p.`sn`=?", [sn], order=('shard', 'rowid'))))
+		else:
+			print(d.find_tape_by_sn(sn))
 
 	@classmethod
 	def action_find_tarfiles_name(kls, args, name):
-		d = kls._db_open(args)
+		d = kls._db_open(args, readonly=True)
+		if d.find_shard_paths():
+			# Rowids are per shard so tapes are shown by serial number
+			rows = d.federated(kls._FEDERATED_FILES + " where fnmatch(?, f.`fname`)", [name], order=('fullpath', 'sn'))
+			print("TAPE_SN.TAR: FULLPATH")
+			for row in rows:
+				print("{sn}.{num}: {fullpath}".format(**row))
+			return
+
 		rows = d.find_tarfiles_by_name(name)
 		print("TAPE.TAR: FULLPATH")
 		for row in rows:
 			print("{id_tape}.{tar[num]}: {fullpath}".format(**row))
 
+	# Queries run on each shard of a federated catalog, see db.federated().
+	# Columns are named rather than * so that UNION ALL lines up over shards from different versions.
+	_FEDERATED_TAPES = "select p.`rowid` as `rowid`, p.`manufacturer`, p.`model`, p.`gen`, p.`sn`, p.`barcode`, p.`ptime` from {s}.`tape` p"
+	_FEDERATED_TARS = ("select t.`rowid` as `rowid`, t.`id_tape`, t.`num`, t.`stime`, t.`etime`, t.`access_cnt`, t.`blk_offset`, t.`options`, t.`uname`, p.`sn`, p.`barcode` "
+		"from {s}.`tar` t join {s}.`tape` p on p.`rowid`=t.`id_tape`")
+	_FEDERATED_FILES = ("select f.`rowid` as `rowid`, f.`id_tape`, f.`id_tar`, f.`fullpath`, f.`relpath`, f.`fname`, f.`sz`, f.`sha256`, t.`num`, p.`sn`, p.`barcode` "
+		"from {s}.`tarfile` f join {s}.`tar` t on t.`rowid`=f.`id_tar` join {s}.`tape` p on p.`rowid`=f.`id_tape`")
+
+	@classmethod
+	def _federated_list(kls, d, sql, vals, order):
+		"""
+		Run a listing over all shards of @d.
+		A tape= filter is looked up in the manifest so only the shard holding the tape is searched.
+		"""
+		paths = None
+		where = ''
+		params = []
+		if 'tape' in vals:
+			# Tape in this catalog itself, or in shards found through the manifest
+			paths = []
+			if len(d.find_tape_by_multi(vals['tape'])):
+				paths.append(os.path.abspath(d.Filename))
+			paths += sorted(set(_['path'] for _ in d.find_shards_by_tape_multi(vals['tape'])))
+			if not len(paths):
+				raise PrintHelpException("Tape with rowid, serial number, or barcode '%s' not found" % vals['tape'])
+
+			where = " where p.`sn`=? or p.`barcode`=? or p.`rowid`=?"
+			params = [vals['tape']] * 3
+
+		return d.federated(sql + where, params, order=order, paths=paths)
+
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
 	@classmethod
@@ -456,16 +614,35 @@ class actions:
 		elif args.action[1] == 'files':
 			kls.action_list_tarfiles(args, args.action[2:])
 
+		elif args.action[1] == 'stats':
+			kls.action_list_tarstats(args, args.action[2:])
+
+		elif args.action[1] == 'shards':
+			kls.action_list_shards(args)
+
 		else:
 			raise PrintHelpException("Unrecognized list command: %s" % args.action[1])
 
+	@classmethod
+	def action_list_shards(kls, args):
+		if len(args.action) != 2:
+			raise PrintHelpException("No parameters are accepted for list shards")
+
+		d = kls._db_open(args, readonly=True)
+		print("SHARD: TAPE_SN (BARCODE)")
+		for row in d.find_shards():
+			print("{path}: {sn} ({barcode})".format(**row))
+
 	@classmethod
 	def action_list_tapes(kls, args):
 		if len(args.action) != 2:
 			raise PrintHelpException("No parameters are accepted for list tapes")
 
-		d = kls._db_open(args)
-		rows = d.find_tapes()
+		d = kls._db_open(args, readonly=True)
+		if d.find_shard_paths():
+			rows = kls._federated_list(d, kls._FEDERATED_TAPES, {}, ('sn', 'shard'))
+		else:
+			rows = d.find_tapes()
 		for row in rows:
 			print(row)
 
@@ -474,10 +651,15 @@ class actions:
 		# Split ['foo=bar', 'baz=bat'] into [['foo','bar'], ['baz','bat']]
 		vals = dict([_.split('=',1) for _ in vals])
 
-		d = kls._db_open(args)
+		d = kls._db_open(args, readonly=True)
+
+		if d.find_shard_paths():
+			if len(set(vals) - {'tape'}):
+				raise PrintHelpException("Unsupported filter for tar listing: %s" % str(vals))
+			rows = kls._federated_list(d, kls._FEDERATED_TARS, vals, ('sn', 'num', 'shard'))
 
 		# No filtering
-		if not len(vals):
+		elif not len(vals):
 			rows = d.find_tars()
 		else:
 			if 'tape' in vals:
@@ -497,10 +679,15 @@ class actions:
 		# Split ['foo=bar', 'baz=bat'] into [['foo','bar'], ['baz','bat']]
 		vals = dict([_.split('=',1) for _ in vals])
 
-		d = kls._db_open(args)
+		d = kls._db_open(args, readonly=True)
+
+		if d.find_shard_paths():
+			if len(set(vals) - {'tape'}):
+				raise PrintHelpException("Unsupported filter for file listing across shards: %s" % str(vals))
+			rows = kls._federated_list(d, kls._FEDERATED_FILES, vals, ('fullpath', 'sn', 'shard'))
 
 		# No filtering
-		if not len(vals):
+		elif not len(vals):
 			rows = d.find_tarfiles()
 		else:
 			if 'tape' in vals:
@@ -518,6 +705,29 @@ class actions:
 		for row in rows:
 			print(row)
 
+	@classmethod
+	def action_list_tarstats(kls, args, vals):
+		# Split ['foo=bar', 'baz=bat'] into [['foo','bar'], ['baz','bat']]
+		vals = dict([_.split('=',1) for _ in vals])
+
+		d = kls._db_open(args, readonly=True)
+
+		# No filtering
+		if not len(vals):
+			rows = d.find_tarstats()
+		else:
+			if 'tape' in vals:
+				rows = d.find_tarstats_by_tape_multi(vals['tape'])
+
+				if rows is None:
+					raise PrintHelpException("Tape with rowid, serial number, or barcode '%s' not found" % vals['tape'])
+
+			else:
+				raise PrintHelpException("Unsupported filter for stats listing: %s" % str(vals))
+
+		for row in rows:
+			print(row)
+
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
 	@classmethod
@@ -531,22 +741,43 @@ class actions:
 		elif args.action[1] == 'file':
 			kls.action_new_tarfile(args, args.action[2:])
 
+		elif args.action[1] == 'shard':
+			kls.action_new_shard(args, args.action[2:])
+
 		else:
 			raise PrintHelpException("Unrecognized new command: %s" % args.action[1])
 
 	@classmethod
-	def action_new_tape(kls, args, vals):
+	def action_new_shard(kls, args, vals):
 		# Split ['foo=bar', 'baz=bat'] into [['foo','bar'], ['baz','bat']]
 		vals = dict([_.split('=',1) for _ in vals])
 
 		# Parse paramaters
-		p = DataArgsParser('new tape')
-		p.add('manufacturer', str, required=True)
-		p.add('model', str, required=True)
-		p.add('gen', str, required=True)
-		p.add('sn', str, required=True)
-		p.add('barcode', str, required=False)
-		p.add('ptime', dateYYYYMMDD, required=True)
+		p = DataArgsParser('new shard')
+		p.add('path', str, required=True)
+		vals = p.check(vals)
+
+		d = kls._db_open(args)
+		try:
+			cnt = d.new_shard(vals['path'])
+		except (ItemExists, ItemNotFound) as e:
+			raise PrintHelpException(str(e))
+
+		print("Shard %s added with %d tapes" % (vals['path'], cnt))
+
+	@classmethod
+	def action_new_tape(kls, args, vals):
+		# Split ['foo=bar', 'baz=bat'] into [['foo','bar'], ['baz','bat']]
+		vals = dict([_.split('=',1) for _ in vals])
+
+		# Parse paramaters
+		p = DataArgsParser('new tape')
+		p.add('manufacturer', str, required=True)
+		p.add('model', str, required=True)
+		p.add('gen', str, required=True)
+		p.add('sn', str, required=True)
+		p.add('barcode', str, required=False)
+		p.add('ptime', dateYYYYMMDD, required=True)
 
 		vals = p.check(vals, set_absent_as_none=True)
 
@@ -627,6 +858,7 @@ class actions:
 			elif a.startswith("tar="): vals.append(a)
 			elif a.startswith("basedir="): vals.append(a)
 			elif a.startswith("forceupdate="): vals.append(a)
+			elif a.startswith("jobs="): vals.append(a)
 			else:
 				continue
 
@@ -641,8 +873,12 @@ class actions:
 		p.add('tar', int, required=True)
 		p.add('basedir', str, required=True)
 		p.add('forceupdate', str, required=False)
+		p.add('jobs', int, required=False)
 		vals = p.check(vals, set_absent_as_none=True)
 
+		# Files are hashed concurrently by sha256sum processes
+		jobs = vals['jobs'] or os.cpu_count() or 1
+
 		forceupdate = False
 		if 'forceupdate' in vals and vals['forceupdate'] is not None:
 			# Enable
@@ -676,8 +912,43 @@ class actions:
 		# Send start notification
 		send_notification_queue_start(args, num_files, vals)
 
-		# Iterate other all of the files
-		for x,fl in enumerate(files):
+		import concurrent.futures
+
+		# Resolve the tar once rather than per file
+		try:
+			tar = d.find_tars_by_tape_num(vals['tape'], vals['tar'])
+		except ItemNotFound as e:
+			raise PrintHelpException(str(e))
+
+		next_notify = num_10percent
+
+		# Files are looked up in chunks with one join per chunk, and only those that need it are hashed
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+			for start in range(0, num_files, QUEUE_CHUNK):
+				kls._action_queue_chunk(d, pool, tar, vals, forceupdate, files[start:start+QUEUE_CHUNK])
+
+				# Send notification
+				done = min(num_files, start+QUEUE_CHUNK)
+				if done >= next_notify:
+					send_notification_queue_step(args, done, num_files, vals['tape'], vals['tar'])
+					next_notify = (done // num_10percent + 1) * num_10percent
+
+		# TODO: ensure all files in the same tar have the same base directory
+
+		STATS.print_report()
+		kls._write_prometheus(args)
+
+		# Send completion notification
+		send_notification_queue_done(args, vals['tape'], vals['tar'])
+
+	@classmethod
+	def _action_queue_chunk(kls, d, pool, tar, vals, forceupdate, files):
+		from . import archive
+
+		# Stat everything in the chunk
+		paths = []
+		info = {}
+		for fl in files:
 			# Make it an absolute path
 			fl = os.path.abspath(fl)
 
@@ -690,47 +961,85 @@ class actions:
 			if z.startswith('..'):
 				raise Exception("Should not reach this point as base dir was already checked: %s" % ([fl, vals['basedir'], z]))
 
-			# See if file is already queued
-			res = d.tarfile.select(['rowid','sha256'], 'fullpath=?', [fl])
-			rows = [dict(_) for _ in res]
-			if len(rows):
-				if not forceupdate:
-					print("Skipping: %s" % fl)
-				else:
-
-					oldh = rows[0]['sha256']
+			with STATS.phase('queue.stat'):
+				st = os.stat(fl)
+
+			# Same file listed twice
+			if fl in info: continue
+
+			paths.append( (fl, st.st_size, st.st_mtime) )
+			info[fl] = {'fullpath': fl, 'relpath': z, 'fname': os.path.basename(fl), 'sz': st.st_size, 'mtime': st.st_mtime,
+				'dev': st.st_dev, 'ino': st.st_ino, 'nlink': st.st_nlink, 'alloc': st.st_size, 'extents': None}
+
+			# Holes aren't written, only the allocated extents that tar --sparse stores
+			if archive.is_sparse(st):
+				with STATS.phase('queue.stat'):
+					extents = archive.sparse_map(fl)
+				info[fl].update(alloc=sum(_[1] for _ in extents), extents=len(extents))
+
+		# See which files are already queued
+		with STATS.phase('queue.lookup'):
+			known = d.classify_paths(paths)
+
+		# Start hashing everything that needs it
+		hashes = {}
+		inodes = {}
+		skipped = 0
+		for fl, sz, mtime in paths:
+			k = known[fl]
+			if k['state'] == 'unknown' or forceupdate:
+				# Hard links to one file are hashed once
+				key = (info[fl]['dev'], info[fl]['ino'])
+				if key not in inodes:
+					inodes[key] = pool.submit(kls._hash_timed, fl)
+				hashes[fl] = inodes[key]
+			elif k['state'] == 'changed':
+				print("Changed:  %s (not rehashed, use forceupdate=1)" % fl)
+				STATS.incr('queue.changed')
+			else:
+				skipped += 1
 
-					h = hashfile(fl)
-					sz = os.path.getsize(fl)
-					fname = os.path.basename(fl)
+		if skipped:
+			print("Skipping: %d already queued files" % skipped)
+			STATS.incr('queue.skipped', skipped)
 
-					if oldh == h:
-						print("Unchanged: %s" % fl)
-						continue
+		# Collect in order
+		adds = []
+		updates = []
+		for fl, sz, mtime in paths:
+			if fl not in hashes: continue
 
-					print("Rehashing: %s (%s, %s)" % (fl, oldh, h))
-					#print("\tOld: %s\t\tNew: %s" % (oldh,h))
-					d.begin()
-					d.tarfile.update({"rowid": rows[0]['rowid']}, {"sha256": h, "sz": sz})
-					d.commit()
+			k = known[fl]
+			row = info[fl]
+			row['sha256'] = hashes[fl].result()
+			STATS.incr('queue.hashed_bytes', row['sz'])
 
-			else:
+			if k['state'] == 'unknown':
 				print("Adding:   %s" % fl)
+				adds.append(row)
 
-				h = hashfile(fl)
-				sz = os.path.getsize(fl)
-				fname = os.path.basename(fl)
+			elif k['sha256'] == row['sha256']:
+				print("Unchanged: %s" % fl)
+				STATS.incr('queue.unchanged')
 
-				d.new_tarfile(tape=vals['tape'], tar=vals['tar'], fullpath=fl, relpath=z, fname=fname, sz=sz, sha256=h)
+			else:
+				print("Rehashing: %s (%s, %s)" % (fl, k['sha256'], row['sha256']))
+				row['rowid'] = k['rowid']
+				updates.append(row)
 
-				# Send notification
-				if (x+1) % num_10percent == 0:
-					send_notification_queue_step(args, x+1,num_files,vals['tape'],vals['tar'])
+		with STATS.phase('queue.insert'):
+			if len(adds):
+				d.new_tarfiles(tar['id_tape'], tar['rowid'], adds)
+			if len(updates):
+				d.update_tarfile_hashes(updates)
 
-		# TODO: ensure all files in the same tar have the same base directory
+		STATS.incr('queue.added', len(adds))
+		STATS.incr('queue.rehashed', len(updates))
 
-		# Send completion notification
-		send_notification_queue_done(args, vals['tape'], vals['tar'])
+	@staticmethod
+	def _hash_timed(fl):
+		with STATS.phase('queue.hash'):
+			return hashfile(fl)
 
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
@@ -738,7 +1047,7 @@ class actions:
 	def action_write(kls, args):
 		# 1) Find tape, find tar, find files
 		# 2) Move tape to correct location
-		# 3) Write file list to a temp file
+		# 3) Stream the file list from the catalog to tar
 		# 4) Run tar against the file list to write to tape
 
 
@@ -750,43 +1059,181 @@ class actions:
 		p = DataArgsParser('new tar file')
 		p.add('tape', str, required=True)
 		p.add('tar', rangeint, required=True)
-		vals = p.check(vals)
+		p.add('readrate', float, required=False)
+		p.add('readahead', int, required=False)
+		p.add('rehash', str, required=False)
+		p.add('jobs', int, required=False)
+		p.add('dryrun', str, required=False)
+		p.add('members', str, required=False)
+		p.add('simulate', str, required=False)
+		p.add('simrate', float, required=False)
+		p.add('next', str, required=False)
+		vals = p.check(vals, set_absent_as_none=True)
+
+		rehash = (vals['rehash'] or '').strip().lower()
+		if rehash in ('1', 'true'):
+			vals['rehash'] = True
+		elif rehash in ('', '0', 'false'):
+			vals['rehash'] = False
+		else:
+			raise PrintHelpException("Must provide 1 or true to rehash, unrecognized value '%s'" % vals['rehash'])
 
 		d = kls._db_open(args)
 
 		# 1)
-		# Get tape
-		tape = d.find_tape_by_multi(vals['tape'])
-		if not len(tape):
-			print("Tape not found")
+		# Get tapes, several can be written at once to several drives
+		tapes = []
+		for t in vals['tape'].split(','):
+			tape = d.find_tape_by_multi(t)
+			if not len(tape):
+				print("Tape not found: %s" % t)
+				return
+			tapes.append(tape[0])
+
+		# Cartridges to continue on, in order, when a tape fills up part way through a tar
+		nxt = []
+		for t in (vals['next'] or '').split(','):
+			if not t.strip():
+				continue
+			tape = d.find_tape_by_multi(t.strip())
+			if not len(tape):
+				print("Tape not found: %s" % t)
+				return
+			nxt.append(tape[0])
+		if len(nxt) and len(tapes) > 1:
+			raise PrintHelpException("Can only give next= when writing one tape")
+		vals['next'] = nxt
+
+		if (vals['dryrun'] or '').strip().lower() in ('1', 'true') or vals['simulate'] is not None:
+			kls._action_write_dryrun(args, vals, tapes, d)
 			return
-		tape = tape[0]
 
-		id_tape = tape['rowid']
-		print("Tape: SN=%s, barcode=%s" % (tape['sn'], tape['barcode']))
+		ch = kls._changer(args)
+		# Without a changer each drive writes only the cartridge already in it, a drive moving on
+		# to another tape would write over the one it just finished
+		if ch is None and len(tapes) > len(args.files):
+			raise PrintHelpException("Writing %d tapes needs %d drives (give -f for each) or --changer to swap cartridges" % (len(tapes), len(tapes)))
+		# Nothing would wait for the full cartridge to be swapped, the rest of the tar would go on it
+		if ch is None and len(vals['next']) and not sys.stdin.isatty():
+			raise PrintHelpException("next= needs --changer or a terminal to confirm each cartridge swap")
 
 		# Send start notification
 		send_notification_write_start(args, vals)
 
+		if ch is not None:
+			# Cartridges already in a drive go first
+			loaded = [ch.loaded(_) for _ in range(len(args.files))]
+			tapes.sort(key=lambda _: _['barcode'] not in loaded)
+
+		if len(tapes) == 1 and len(args.files) == 1:
+			kls._action_write_tape(args, vals, tapes[0], d, args.file)
+		else:
+			kls._action_write_scheduled(args, vals, tapes)
+
+		STATS.print_report()
+
+		# Send done notification
+		send_notification_write_done(args, vals)
+
+	@classmethod
+	def _action_write_tape(kls, args, vals, tape, d, dev, lock=None, budget=None, drive=0):
+		"""Write tars in the range vals['tar'] of @tape using drive @dev (number @drive for a changer)"""
+		if kls._changer(args) is not None:
+			dev = kls._mount(args, tape, drive)
+
+		id_tape = tape['rowid']
+		print("Tape: SN=%s, barcode=%s, drive=%s" % (tape['sn'], tape['barcode'], dev))
+
 		# Iterate over tar numbers
 		for num in range(vals['tar'][0], vals['tar'][1]+1):
 			print("-"*80)
 			print("Tar: num=%d" % (num))
 
 			# 2-4)
-			kls._action_write_num(args, vals, id_tape, num, d)
+			if kls._action_write_num(args, vals, id_tape, num, d, dev=dev, lock=lock, budget=budget, drive=drive):
+				# Tape is full, the tar just written continued on the next cartridge
+				if num < vals['tar'][1]:
+					print("Tape SN=%s is full, not writing tars %d to %d" % (tape['sn'], num+1, vals['tar'][1]))
+				break
 
-		# Send done notification
-		send_notification_write_done(args, vals)
+	@classmethod
+	def _action_write_scheduled(kls, args, vals, tapes):
+		"""
+		Write several tapes in parallel, one drive per tape at a time.
+		Each drive takes the next unwritten tape from a shared queue when it finishes one (only with
+		a changer to load it, otherwise there is one tape per drive),
+		source reads are shared fairly under readrate (MB/s) if given, and catalog updates
+		are serialized with a lock as each drive has its own database connection.
+		"""
+		import queue
+		import threading
+		from .stream import ReadBudget
+
+		todo = queue.Queue()
+		for tape in tapes:
+			todo.put(tape)
+
+		lock = threading.Lock()
+		budget = None
+		if vals['readrate'] is not None:
+			budget = ReadBudget(vals['readrate'] * 1e6)
+
+		errors = []
+
+		def worker(drive, dev):
+			# Other drives may be committing too, the catalog's busy timeout covers waiting on them
+			d = kls._db_open(args)
+
+			while True:
+				try:
+					tape = todo.get_nowait()
+				except queue.Empty:
+					return
+
+				print("Drive %s: load tape SN=%s, barcode=%s" % (dev, tape['sn'], tape['barcode']))
+				try:
+					kls._action_write_tape(args, vals, tape, d, dev, lock, budget, drive)
+				except Exception as e:
+					print("Drive %s: failed writing tape SN=%s: %s" % (dev, tape['sn'], e))
+					errors.append( (dev, tape, e) )
+
+		drives = args.files[:len(tapes)]
+		print("Writing %d tapes on %d drives: %s" % (len(tapes), len(drives), ', '.join(drives)))
+
+		threads = [threading.Thread(target=worker, args=(x, dev), name='pymtar-write-%s' % os.path.basename(dev)) for x,dev in enumerate(drives)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		if len(errors):
+			raise Exception("Failed to write %d tapes: %s" % (len(errors), ', '.join("%s on %s (%s)" % (tape['sn'], dev, e) for dev,tape,e in errors)))
 
 	@classmethod
-	def _action_write_num(kls, args, vals, id_tape, num, d):
-		# Beep
-		print('\a')
-		# Check that user wants to continue onward
-		print("Pausing for 30 seconds, ctrl-c to stop writing")
-		# Wait for input
-		time.sleep(30)
+	def _action_write_num(kls, args, vals, id_tape, num, d, dev=None, lock=None, budget=None, drive=0):
+		"""
+		Write tar @num of tape @id_tape with drive @dev (number @drive for a changer).
+		Returns True if the tape filled up and the tar was continued on the cartridges of vals['next'].
+		"""
+		from . import compress
+		from . import digest
+		from . import dryrun
+		from . import stream
+
+		if dev is None:
+			dev = args.file
+		# Several drives writing at once share the catalog through @lock
+		concurrent = lock is not None
+		if lock is None:
+			lock = contextlib.nullcontext()
+
+		if args.pause > 0:
+			# Beep
+			print('\a')
+			# Check that user wants to continue onward
+			print("Pausing for %d seconds, ctrl-c to stop writing" % args.pause)
+			# Wait for input
+			time.sleep(args.pause)
 
 		# Get tar file info
 		tar = d.find_tars_by_tape_num(id_tape, num)
@@ -794,175 +1241,1221 @@ class actions:
 			print("Tar not found")
 			return
 
-		# Get files for this tar file that have been queued
-		files = d.find_tarfiles_by_tar(vals['tape'], num)
+		# Files queued for this tar file are read from the catalog in write order as needed,
+		# never all held at once
+		totals = d.find_tarfile_totals(tar['rowid'])
 
-		print("Found %d files to write" % len(files))
-		if not len(files):
+		print("Found %d files to write" % totals['cnt'])
+		if not totals['cnt']:
 			print("\tNo files found to write, aborint")
 			return
 
-		# Sort by path
-		files = sorted(files, key=lambda _: _['fullpath'])
-		# Check that files are present
-		for fl in files:
-			if not os.path.exists(fl['fullpath']):
-				raise Exception("Could not find file '%s' for tape=%s and tar=%d, aborting" % (fl['fullpath'], id_tape, num))
+		# Check that files are present and unchanged since queueing, before touching the drive
+		kls._action_write_validate(args, vals, d, d.iter_tarfiles_by_tar(tar['rowid']), id_tape, num, lock if concurrent else None)
+		# Sizes of rehashed files changed
+		totals = d.find_tarfile_totals(tar['rowid'])
+
+		# File data tar will store, less than the file sizes with hard links and sparse files
+		with lock:
+			written = d.set_tarfile_written(tar['rowid'])
+			# Progress counts bytes to tape, known ahead only for an uncompressed tar
+			total = None
+			if compress.codec_for_options(tar['options']) is None:
+				total = dryrun.archive_size(dryrun.plan_members(d.iter_tarfiles_by_tar(tar['rowid'])))['bytes']
+		if written['wsz'] < written['sz']:
+			print("Storing %d of %d bytes of file data: %d hard links, %d sparse files" % (written['wsz'], written['sz'], written['links'], written['sparse']))
+		STATS.incr('write.file_bytes', written['wsz'])
 
 		# Get the base directory to change working directory to
-		basedir = files[0]['fullpath'][:-(len(files[0]['relpath']))]
+		first = totals['first']
+		basedir = first['fullpath'][:-(len(first['relpath']))]
+
+		# Writing a tape file erases every later one, which mustn't include part of another tar
+		for span in d.find_tarspans_by_tape(id_tape):
+			if span['num'] >= num and span['id_tar'] != tar['rowid']:
+				raise Exception("Tape file %d holds part of a tar continued across cartridges, writing tar %d would erase it" % (span['num'], num))
 
 		# 2)
 		# Get tape drive controller
-		m = mt(args.file)
+		seek_start = time.monotonic()
+		m = get_tape(dev)
 
-		# Move the tape as appropriate
-		ret = m.status()
-		if ret[0] == -1:
-			raise Exception("no tape present, cannot write")
+		kls._seek_tar(m, num)
+		seek_sec = time.monotonic() - seek_start
+		STATS.add_time('write.seek', seek_sec)
 
-		# Go all the way back to start of the tape
-		elif num == 0:
-			m.rewind()
+		# set start time
+		n = d._now()
+		print("Start: %s" % n)
+		with lock:
+			d.begin()
+			d.tar.update({'rowid': tar['rowid']}, {'stime': n})
+			d.commit()
 
-		# Not the first file, so look for it
-		else:
-			# 3 cases of being at the start, middle, or end of the desired file number
-			if num == ret[0] and ret[1] == 0:
-				# Already there
-				pass
+		try:
+			# 3-4)
+			# Rate and ETA on the console in place of tar's verbose listing
+			# (one line every 10 seconds per drive when several are writing)
+			if concurrent:
+				prog = Progress("%s tar %d" % (dev, num), total, interval=10.0, newline=True)
+			else:
+				prog = Progress("Tar %d" % num, total)
+			spans = []
+			res = {'bytes': 0, 'seconds': 0.0, 'underruns': 0, 'idle': 0.0}
+			with kls._write_source(args, vals, tar, basedir) as (src, comp):
+				# Digest of the tape file as written for quick verification, over the whole tar
+				# if it is continued on other cartridges
+				dg = digest.StreamDigest()
+				pmp = stream.Pump(src, progress=prog, budget=budget, digest=dg)
+				vol_tape, vol_num = id_tape, num
+				while True:
+					with m.open_write() as out:
+						r = pmp.run(out)
+					spans.append({'id_tape': vol_tape, 'num': vol_num, 'offset': pmp.bytes - r['bytes'], 'sz': r['bytes']})
+					for k in res:
+						res[k] += r[k]
+					if not r['eom']:
+						break
+
+					# Cartridge is full: its tape file was closed with a file mark as is, and the tar
+					# goes on from the very next byte on the next cartridge
+					m, vol_tape, vol_num = kls._write_next_volume(args, vals, d, m, drive, tar['rowid'])
+			prog.finish()
+
+			with lock:
+				d.set_tarspans(tar['rowid'], spans)
+			if len(spans) > 1:
+				print("Continued across %d cartridges: %s" % (len(spans), ', '.join("tape %d file %d (%d bytes)" % (_['id_tape'], _['num'], _['sz']) for _ in spans)))
+
+			if comp is not None:
+				print("Compressed %d bytes to %d with %s (%.1f%%), %d of %d blocks stored as incompressible" % (comp.raw_bytes, comp.comp_bytes, comp.codec, 100.0 * comp.comp_bytes / comp.raw_bytes if comp.raw_bytes else 0.0, sum(_['stored'] for _ in comp.blocks), len(comp.blocks)))
+				with lock:
+					d.set_tarblocks(tar['rowid'], comp.blocks)
+
+				# Block offset of each member's header from the same plan as dryrun, so that extract and
+				# verify can start at the compressed block holding the first file they want
+				with lock:
+					files = list(d.iter_tarfiles_by_tar(tar['rowid']))
+				offsets = []
+				off = 0
+				for fl, member in zip(files, dryrun.plan_members(files)):
+					offsets.append((fl['rowid'], off // dryrun.BLOCK))
+					off += dryrun.member_size(*member)
+				off += 2 * dryrun.BLOCK
+				off += (dryrun.RECORD_SIZE - off % dryrun.RECORD_SIZE) % dryrun.RECORD_SIZE
+				if off == comp.raw_bytes:
+					with lock:
+						d.set_tarfile_offsets(offsets)
+				else:
+					print("Archive is %d bytes but %d were planned, not recording member offsets" % (comp.raw_bytes, off))
 
-			elif num == ret[0] and ret[1] > 0:
-				# In the middle of the desired file number, so have to back up and then forward
+			dg.finish()
+			print("sha256: %s (Merkle root %s over %d chunks)" % (dg.sha256, dg.root, len(dg.leaves)))
+			with lock:
+				d.set_tar_digest(tar['rowid'], dg)
 
-				# Back up to (ret[0]-1, -1)
-				m.bsf()
-				# Forward to (ret[0], 0)
-				m.fsf()
+			mbps = res['bytes'] / res['seconds'] / 1e6 if res['seconds'] > 0 else 0.0
+			print("Wrote %d bytes in %.1f seconds (%.1f MB/s), %d underruns totaling %.1f seconds, %.1f seconds seeking" % (res['bytes'], res['seconds'], mbps, res['underruns'], res['idle'], seek_sec))
+			with lock:
+				d.new_tarstat(tar['rowid'], dev, n, res['bytes'], res['seconds'], res['underruns'], res['idle'], seek_sec)
 
-			elif num == ret[0] and ret[1] == -1:
-				# At the end of the desired file number, so have to back up and then forward
+			labels = {'device': dev, 'tape': id_tape, 'num': num}
+			kls._write_prometheus(args, [
+				('pymtar_write_rate_bytes_per_second', labels, res['bytes'] / res['seconds'] if res['seconds'] > 0 else 0.0),
+				('pymtar_write_underruns', labels, res['underruns']),
+				('pymtar_write_seek_seconds', labels, seek_sec),
+			])
 
-				# Back up to (ret[0]-1, -1)
-				m.bsf()
-				# Forward to (ret[0], 0)
-				m.fsf()
+		finally:
+			# set end time
+			n = d._now()
+			print("End: %s" % n)
+			with lock:
+				d.begin()
+				d.tar.update({'rowid': tar['rowid']}, {'etime': n})
+				d.commit()
 
-			# Need to advance a number of files:
-			elif ret[0] < num:
-				m.fsf(num - ret[0])
+		# Send notification of finishing a file
+		send_notification_tar_done(args, id_tape, num)
+		return len(spans) > 1
 
-			# Need to backup a number of files
-			elif num < ret[0]:
-				# Have to back up one more than desired (to end of previous file)
-				m.bsf(ret[0] - num + 1)
-				# then advance one to start of desired file
-				m.fsf(1)
+	@classmethod
+	def _write_next_volume(kls, args, vals, d, m, drive, id_tar):
+		"""
+		Swap the full cartridge in @drive (tape controller @m) for the next one of vals['next'],
+		positioned after the last tape file used on it by anything but an earlier write of tar @id_tar. Returns (tape controller, tape rowid, file number).
+		"""
+		if not len(vals['next']):
+			raise Exception("Tape is full part way through the tar, give the cartridges to continue on with next=")
 
-		ret2 = m.status()
-		if num != ret2[0] and ret2[1] != 0:
-			raise Exception("Failed to seek tape: desired file number %d, was at %s and now at %s" % (num, ret, ret2))
+		if kls._changer(args) is None and not sys.stdin.isatty():
+			raise Exception("Tape is full part way through the tar, swapping cartridges needs --changer or a terminal to confirm it")
 
-		# set start time
-		n = db._now()
-		print("Start: %s" % n)
-		d.begin()
-		d.tar.update({'rowid': tar['rowid']}, {'stime': n})
-		d.commit()
+		tape = vals['next'].pop(0)
+		# File 0 is kept for the catalog copy
+		num = max(1, d.next_tape_file(tape['rowid'], id_tar))
+		print("Tape full, continuing on SN=%s, barcode=%s at file %d" % (tape['sn'], tape['barcode'], num))
+		STATS.incr('write.volumes')
 
+		if kls._changer(args) is None:
+			m.offline()
+		m = get_tape(kls._mount(args, tape, drive))
 		try:
-			# 3)
-			# Write relative file list to a file and tell tar to read from it
-			with tempfile.NamedTemporaryFile() as f:
-				# Write files in sorted order into the temp file
-				for fl in files:
-					f.write( (fl['relpath'] + '\n').encode('utf-8') )
-					print("Preparing: %s" % fl['relpath'])
-				f.seek(0)
-				dat = f.read()
-
-				cur_cwd = os.getcwd()
+			kls._seek_tar(m, num)
+		except Exception as e:
+			raise Exception("Cannot position SN=%s at file %d to continue the tar, a blank cartridge needs file 0 (the catalog copy) written first: %s" % (tape['sn'], num, e))
+
+		return m, tape['rowid'], num
+
+	@classmethod
+	@contextlib.contextmanager
+	def _write_source(kls, args, vals, tar, basedir):
+		"""
+		Archive of the files of tar row @tar as a reader for stream.pump(), made by tar(1) or by
+		archive.ArchiveReader if readahead is given, and compressed here if tar.options asks for it.
+		The file list comes from the catalog a page at a time on its own connection, as it is read
+		in another thread. Yields (reader, compress.CompressedReader or None).
+		"""
+		import subprocess
+		import threading
+		from . import archive
+		from . import compress
+
+		def members():
+			d = kls._db_open(args)
+			yield from d.iter_tarfiles_by_tar(tar['rowid'])
+
+		# tar is run in the base directory rather than changing the working directory
+		# of the whole process, which would affect other drives writing at the same time
+		print("cwd: %s" % basedir)
+
+		errors = []
+		if vals['readahead']:
+			# Archive made here instead, reading small files ahead in parallel
+			print("Archiving with %d read-ahead threads" % vals['readahead'])
+			proc = feeder = None
+			tarsrc = archive.ArchiveReader(((fl['fullpath'], fl['relpath']) for fl in members()), jobs=vals['readahead'])
+		else:
+			# tar writes the archive to stdout and it is streamed to the drive through a buffer,
+			# while the NUL separated file list is fed to its stdin
+			# Hard links are stored as links by default, --sparse stores only the allocated extents of sparse files
+			subargs = ['tar', 'cf', '-', '--sparse', '--null', '--verbatim-files-from', '-T', '-']
+			# print the args for debugging
+			print(subargs)
+			proc = subprocess.Popen(subargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=basedir)
+			tarsrc = proc.stdout
+
+			def feed():
 				try:
-					print("cwd: %s" % basedir)
-					os.chdir(basedir)
-
-					# 4)
-					# Verbose to watch progress on the screen
-					subargs = ['tar', 'vcf', args.file, '--verbatim-files-from', '-T', f.name]
-					# print the args for debugging
-					print(subargs)
-					subprocess.run(subargs)
+					buf = []
+					for fl in members():
+						buf.append(os.fsencode(fl['relpath']) + b'\0')
+						if len(buf) >= 1000:
+							proc.stdin.write(b''.join(buf))
+							buf = []
+					proc.stdin.write(b''.join(buf))
+				except BrokenPipeError:
+					# tar exited early, which its exit code reports
+					pass
+				except Exception as e:
+					errors.append(e)
 				finally:
-					# Move CWD to original location
-					os.chdir(cur_cwd)
+					try:
+						proc.stdin.close()
+					except BrokenPipeError:
+						pass
 
-			# And temp file auto-cleaned up
+			feeder = threading.Thread(target=feed, name='pymtar-write-list', daemon=True)
+			feeder.start()
 
+		# Compression asked for in tar.options is done here in parallel rather than by tar
+		codec = compress.codec_for_options(tar['options'])
+		comp = None
+		if codec is not None:
+			comp = compress.CompressedReader(tarsrc, codec)
+
+		try:
+			yield (comp if comp is not None else tarsrc), comp
 		finally:
-			# set end time
-			n = db._now()
-			print("End: %s" % n)
-			d.begin()
-			d.tar.update({'rowid': tar['rowid']}, {'etime': n})
-			d.commit()
+			if comp is not None:
+				comp.close()
+			tarsrc.close()
+			if proc is not None:
+				proc.wait()
+			if feeder is not None:
+				feeder.join()
+
+		if len(errors):
+			raise Exception("Failed reading the file list of tar %d from the catalog: %s" % (tar['num'], errors[0]))
+		# 1 is files that changed as they were read, so the tape doesn't hold what was hashed either
+		if proc is not None and proc.returncode != 0:
+			raise Exception("tar exited with code %d writing tar %d, the tape file is not a good copy of its files" % (proc.returncode, tar['num']))
 
-		# Send notification of finishing a file
-		send_notification_tar_done(args, id_tape, num)
+	@classmethod
+	def _action_write_dryrun(kls, args, vals, tapes, d):
+		"""
+		Predict writing tars in the range vals['tar'] of @tapes without touching the drives: the exact
+		size of each tar from the catalog, whether they fit on the tape, and how long they'll take.
+		With simulate=DIR each tar is also made and streamed into a file-backed tape at DIR throttled
+		to the predicted drive rate (or simrate MB/s), leaving the catalog untouched.
+		"""
+		from . import compress
+		from . import dryrun
+		from . import stream
+
+		ratios = d.find_compression_ratios()
+		history = d.find_tarstats()
+		# Predicted position of every member, one tab separated line each: tar, block offset, size, relpath
+		members = open(vals['members'], 'w') if vals['members'] is not None else None
+
+		with (members if members is not None else contextlib.nullcontext()):
+			for x, tape in enumerate(tapes):
+				dev = args.files[x] if x < len(args.files) else None
+				cap = dryrun.capacity(tape['gen'])
+
+				tars = {_['num']: _ for _ in d.find_tars_by_tape_multi(tape['rowid'])}
+				# Writing the first tar replaces it and everything after it on the tape
+				first = vals['tar'][0]
+				used = sum(_['sz'] or 0 for _ in tars.values() if _['num'] < first)
+				unsized = [_['num'] for _ in tars.values() if _['num'] < first and _['sz'] is None]
+
+				# Rates of earlier writes, or the drive's native rate without any
+				rates = dryrun.rates(history, dev)
+				if rates is not None:
+					basis = "%d earlier writes" % rates['writes']
+				elif dryrun.native_rate(tape['gen']) is not None:
+					native = dryrun.native_rate(tape['gen'])
+					rates = {'writes': 0, 'effective': native, 'drive': native, 'seek': 0.0}
+					basis = "native rate of %s, no earlier writes" % tape['gen']
+				else:
+					basis = "no earlier writes and unknown generation '%s'" % tape['gen']
+				if rates is not None and vals['readrate'] is not None:
+					rates['effective'] = min(rates['effective'], vals['readrate'] * 1e6)
+
+				print("="*80)
+				print("Tape: SN=%s, barcode=%s, gen=%s, capacity %s" % (tape['sn'], tape['barcode'], tape['gen'], fmt_bytes(cap) if cap else 'unknown'))
+				if rates is not None:
+					print("Rates: %.1f MB/s end to end, drive %.1f MB/s, %.1f seconds seeking (%s)" % (rates['effective'] / 1e6, rates['drive'] / 1e6, rates['seek'], basis))
+				else:
+					print("Rates: unknown (%s), no time predicted" % basis)
+				print("Already on tape before tar %d: %s%s" % (first, fmt_bytes(used), " (tars %s not sized)" % ', '.join(str(_) for _ in unsized) if len(unsized) else ''))
+
+				if vals['simulate'] is not None:
+					simrate = vals['simrate'] * 1e6 if vals['simrate'] is not None else (rates['drive'] if rates is not None else None)
+					sim = filetape(vals['simulate'], rate=simrate)
+					sim.rewind()
+
+				total = 0
+				seconds = 0.0
+				for num in range(vals['tar'][0], vals['tar'][1]+1):
+					print("-"*80)
+					tar = tars.get(num)
+					if tar is None:
+						print("Tar %d: not found" % num)
+						continue
+
+					first = d.find_tarfile_totals(tar['rowid'])['first']
+					if first is None:
+						print("Tar %d: no files queued" % num)
+						continue
+
+					# Same order and sizes as the write, as queued
+					def sizes():
+						off = 0
+						for member in dryrun.plan_members(d.iter_tarfiles_by_tar(tar['rowid'])):
+							if members is not None:
+								members.write("%d\t%d\t%d\t%s\n" % (num, off // dryrun.BLOCK, member[1], member[0]))
+								off += dryrun.member_size(*member)
+							yield member
+					sz = dryrun.archive_size(sizes())
+
+					ontape = sz['bytes']
+					note = ''
+					codec = compress.codec_for_options(tar['options'])
+					if codec is not None:
+						if tar['options'] in ratios:
+							ontape = int(ontape * ratios[tar['options']])
+							note = " (%s at %.1f%% as in earlier writes)" % (codec, 100.0 * ratios[tar['options']])
+						else:
+							note = " (%s with no earlier writes, assuming incompressible)" % codec
+
+					print("Tar %d: %d members, %s of data + %s of headers and padding = %s archive, %s on tape%s" % (num, sz['members'], fmt_bytes(sz['data']), fmt_bytes(sz['overhead']), fmt_bytes(sz['bytes']), fmt_bytes(ontape), note))
+					total += ontape
+
+					if rates is not None:
+						sec = ontape / rates['effective'] + rates['seek']
+						seconds += sec
+						print("Tar %d: predicted %s" % (num, kls._fmt_duration(sec)))
+
+					if vals['simulate'] is not None:
+						basedir = first['fullpath'][:-(len(first['relpath']))]
+						prog = Progress("Simulate tar %d" % num, sz['data'])
+						with sim.open_write() as out, kls._write_source(args, vals, tar, basedir) as (src, comp):
+							res = stream.pump(src, out, progress=prog, prefix='simulate')
+						prog.finish()
+						print("Tar %d: simulated %d bytes (%s predicted) in %s at %.1f MB/s, %d underruns totaling %.1f seconds" % (num, res['bytes'], 'as' if res['bytes'] == ontape else '%d' % ontape, kls._fmt_duration(res['seconds']), res['bytes'] / res['seconds'] / 1e6 if res['seconds'] > 0 else 0.0, res['underruns'], res['idle']))
+
+				print("-"*80)
+				print("Total: %s to write%s" % (fmt_bytes(total), ", predicted %s" % kls._fmt_duration(seconds) if rates is not None else ''))
+				if cap:
+					after = used + total
+					if after <= cap:
+						print("Fits: %s of %s used after writing (%.1f%%), %s free" % (fmt_bytes(after), fmt_bytes(cap), 100.0 * after / cap, fmt_bytes(cap - after)))
+					else:
+						print("DOES NOT FIT: %s needed, %s over the %s capacity" % (fmt_bytes(after), fmt_bytes(after - cap), fmt_bytes(cap)))
+
+		STATS.print_report()
+
+	@staticmethod
+	def _fmt_duration(sec):
+		"""@sec as H:MM:SS"""
+		sec = int(round(sec))
+		return "%d:%02d:%02d" % (sec // 3600, sec % 3600 // 60, sec % 60)
+
+	@classmethod
+	def _action_write_validate(kls, args, vals, d, files, id_tape, num, lock=None):
+		"""
+		Stat every file in @files in parallel and compare size, and mtime where recorded, to the catalog.
+		All missing and changed files are reported together. Changed files are rehashed and updated
+		in the catalog if rehash=1 was given (or confirmed at the terminal), otherwise the write aborts.
+		@files is an iterable of tarfile rows, taken a batch at a time so only the problem files are kept.
+		"""
+		import concurrent.futures
+		import itertools
+		from . import archive
+
+		jobs = vals.get('jobs') or os.cpu_count() or 1
+
+		def check(fl):
+			try:
+				st = os.stat(fl['fullpath'])
+			except FileNotFoundError:
+				return 'missing', None
+			if st.st_size != fl['sz'] or (fl.get('mtime') is not None and st.st_mtime != fl['mtime']):
+				return 'changed', st
+			return 'ok', st
+
+		missing = []
+		changed = []
+		cnt = 0
+		files = iter(files)
+		with STATS.phase('write.validate'):
+			with concurrent.futures.ThreadPoolExecutor(jobs * 4) as pool:
+				while True:
+					batch = list(itertools.islice(files, 65536))
+					if not len(batch):
+						break
+					cnt += len(batch)
+
+					# Many files per task as each stat is quick
+					for fl, (state, st) in zip(batch, pool.map(check, batch, chunksize=256)):
+						if state == 'missing':
+							missing.append(fl)
+						elif state == 'changed':
+							changed.append( (fl, st) )
+
+		print("Validated %d files: %d missing, %d changed since queueing" % (cnt, len(missing), len(changed)))
+		for fl in missing:
+			print("Missing:  %s" % fl['fullpath'])
+		for fl, st in changed:
+			print("Changed:  %s (size %d -> %d)" % (fl['fullpath'], fl['sz'], st.st_size))
+		STATS.incr('write.missing', len(missing))
+		STATS.incr('write.changed', len(changed))
+
+		if len(missing):
+			raise Exception("%d files for tape=%s and tar=%d are missing, aborting" % (len(missing), id_tape, num))
+
+		if not len(changed):
+			return
+
+		rehash = vals['rehash']
+		if not rehash and lock is None and sys.stdin.isatty():
+			rehash = input("Rehash the %d changed files and continue? [y/N] " % len(changed)).strip().lower() in ('y', 'yes')
+		if not rehash:
+			raise Exception("%d files for tape=%s and tar=%d changed since queueing, aborting (use rehash=1 to rehash them)" % (len(changed), id_tape, num))
+
+		# Only the changed files are hashed again
+		with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+			hashes = pool.map(kls._hash_timed, [fl['fullpath'] for fl, st in changed])
+			rows = []
+			for (fl, st), h in zip(changed, hashes):
+				fl.update(sz=st.st_size, mtime=st.st_mtime, sha256=h, dev=st.st_dev, ino=st.st_ino, nlink=st.st_nlink, alloc=st.st_size, extents=None)
+				if archive.is_sparse(st):
+					extents = archive.sparse_map(fl['fullpath'])
+					fl.update(alloc=sum(_[1] for _ in extents), extents=len(extents))
+				rows.append(fl)
+				STATS.incr('write.rehashed_bytes', st.st_size)
+
+		with (lock if lock is not None else contextlib.nullcontext()):
+			d.update_tarfile_hashes(rows)
+		print("Rehashed %d changed files" % len(rows))
 
 	# -------------------------------------------------------------------------
 	# -------------------------------------------------------------------------
 	@classmethod
-	def action_extract(kls, args):
+	def _action_read_jobs(kls, args, name, require_pattern):
+		"""
+		Parse extract/verify parameters and find the matching files.
+		Returns (vals, d, jobs) where jobs has one entry per tar holding matches, see changer.plan().
+		"""
 		vals = dict([_.split('=',1) for _ in args.action[1:]])
 
 		# Parse paramaters
-		p = DataArgsParser('extract')
+		p = DataArgsParser(name)
 		p.add('tape', int, required=False)
 		p.add('tar', int, required=False)
 		p.add('fullpath', str, required=False)
 		p.add('name', str, required=False)
+		if name == 'extract':
+			p.add('dest', str, required=True)
+		if name == 'verify':
+			p.add('quick', str, required=False)
 
 		vals = p.check(vals)
 
-		d = kls._db_open(args)
+		# plan only reads the catalog
+		d = kls._db_open(args, readonly=(name == 'plan'))
 
 		# Filter by tar.num, need to get tar info to get num
 		if 'tape' in vals and 'tar' in vals:
 			tar = d.find_tars_by_tape_num(vals['tape'], vals['tar'])
 			vals['tar'] = tar['num']
 
-		matches = []
-
 		if 'fullpath' in vals and 'name' in vals:
-			raise PrintHelpException("Must provide only one of fullpath or name to extract to match files")
+			raise PrintHelpException("Must provide only one of fullpath or name to %s to match files" % name)
 
 		elif 'fullpath' in vals:
-			raise NotImplementedError
+			rows = d.find_tarfiles_by_fullpath(vals['fullpath'])
 
 		elif 'name' in vals:
 			rows = d.find_tarfiles_by_name(vals['name'])
+
+		elif not require_pattern:
+			rows = d.find_tarfiles_by_fullpath('*')
+
+		else:
+			raise PrintHelpException("Must provide fullpath or name to %s to match files" % name)
+
+		rows = [_ for _ in rows if ('tape' not in vals or _['id_tape'] == vals['tape']) and ('tar' not in vals or _['tar']['num'] == vals['tar'])]
+
+		tapes = {}
+		for row in rows:
+			if row['id_tape'] not in tapes:
+				tapes[row['id_tape']] = d.find_tape_by_id(row['id_tape'])[0]
+
+		# Tars never started aren't on tape to read (as for next_tape_file())
+		written = {}
+		for row in rows:
+			if row['id_tar'] not in written:
+				written[row['id_tar']] = row['tar']['stime'] is not None
+				if not written[row['id_tar']] and not args.json:
+					print("Not written: tape SN=%s tar num=%d, skipping its files" % (tapes[row['id_tape']]['sn'], row['tar']['num']))
+		rows = [_ for _ in rows if written[_['id_tar']]]
+
+		# A replicated tape catalogs every file again, extract needs only one copy of each,
+		# preferably on a cartridge already in a drive and otherwise the original
+		if name in ('extract', 'plan'):
+			loaded = set()
+			ch = kls._changer(args)
+			if ch is not None:
+				loaded = {ch.loaded(_) for _ in range(len(args.files))} - {None}
+
+			best = {}
 			for row in rows:
-				if 'tape' in vals and row['id_tape'] != vals['tape']: continue
-				if 'tar' in vals and row['tar']['num'] != vals['tar']: continue
-				matches.append(row)
+				rank = (tapes[row['id_tape']]['barcode'] not in loaded, row['id_tape'], row['id_tar'])
+				if row['fullpath'] not in best or rank < best[row['fullpath']][0]:
+					best[row['fullpath']] = (rank, row)
+			rows = [row for rank, row in best.values()]
+
+		# Group matches into one job per tar
+		jobs = {}
+		for row in rows:
+			if row['id_tar'] not in jobs:
+				tape = tapes[row['id_tape']]
+				jobs[row['id_tar']] = {
+					'id_tape': row['id_tape'],
+					'barcode': tape['barcode'],
+					'tape': tape,
+					'tar': row['tar'],
+					'num': row['tar']['num'],
+					'blk_offset': row['tar']['blk_offset'],
+					'files': [],
+				}
+			jobs[row['id_tar']]['files'].append(row)
+
+		return vals, d, list(jobs.values())
+
+	@classmethod
+	def _action_run_jobs(kls, args, jobs, func):
+		"""
+		Run func(m, job) for each job with tape controller @m positioned at the job's tar.
+		Jobs are batched by cartridge so each is loaded (or inserted) once and read in tape order.
+		A job whose tar can't be positioned at or read is reported and skipped.
+		Returns the jobs that failed.
+		"""
+		from . import changer
+
+		ch = kls._changer(args)
+		if ch is not None:
+			batches = changer.plan(jobs, loaded=[ch.loaded(0)], key='barcode')
+		else:
+			batches = changer.plan(jobs, key='id_tape')
+
+		print("Reading %d tars from %d tapes" % (len(jobs), len(batches)))
+
+		failed = []
+
+		for cartridge, batch in batches:
+			dev = kls._mount(args, batch[0]['tape'])
+			m = get_tape(dev)
+
+			for x, job in enumerate(batch):
+				# A tar continued on other cartridges left the last of them in the drive
+				if x and batch[x-1].get('moved'):
+					m = get_tape(kls._mount(args, batch[0]['tape']))
+
+				print("-"*80)
+				print("Tape SN=%s, tar num=%d: %d files" % (job['tape']['sn'], job['num'], len(job['files'])))
+
+				try:
+					seek_start = time.monotonic()
+					kls._seek_tar(m, job['num'])
+					STATS.add_time('read.seek', time.monotonic() - seek_start)
+
+					func(m, job)
+				except Exception as e:
+					print("Failed to read tape SN=%s tar num=%d, skipping it: %s" % (job['tape']['sn'], job['num'], e))
+					STATS.incr('read.failed')
+					failed.append(job)
+
+		return failed
+
+	@classmethod
+	@contextlib.contextmanager
+	def _open_tar(kls, args, d, m, job):
+		"""
+		Open the tar of @job to read with tape controller @m positioned at it. A tar continued on
+		other cartridges reads through to its end, loading each of them in turn into the drive,
+		and sets job['moved'] as the drive then holds the last of them.
+		"""
+		from . import stream
+
+		spans = d.find_tarspans(job['tar']['rowid'])
+		if len(spans) <= 1:
+			with m.open_read() as f:
+				yield f
+			return
+
+		print("Tar continues on %d more cartridges" % (len(spans) - 1))
+
+		def opener(span):
+			def open_span():
+				tape = d.find_tape_by_id(span['id_tape'])[0]
+				job['moved'] = True
+				if kls._changer(args) is None:
+					m.offline()
+				m2 = get_tape(kls._mount(args, tape))
+				kls._seek_tar(m2, span['num'])
+				return m2.open_read()
+			return open_span
+
+		f = stream.ConcatReader([m.open_read] + [opener(_) for _ in spans[1:]])
+		try:
+			yield f
+		finally:
+			f.close()
+
+	@classmethod
+	def _tar_start(kls, d, job):
+		"""
+		Uncompressed offset of the first member of the block compressed tar of @job that it needs,
+		with the tar's blocks, for compress.open_at(). None to read the tar from its start.
+		"""
+		from . import compress
+		from . import dryrun
+
+		if compress.codec_for_options(job['tar']['options']) is None:
+			return None
+
+		# Hard links need the member they link to
+		offs = []
+		for fl in job['files']:
+			offs.append(fl.get('blk_offset'))
+			target = d.find_hardlink_target(fl)
+			if target is not None:
+				offs.append(target['blk_offset'])
+		if None in offs:
+			return None
+
+		blocks = d.find_tarblocks(job['tar']['rowid'])
+		if not len(blocks):
+			return None
+
+		start = min(offs) * dryrun.BLOCK
+		if compress.find_block(blocks, start) is blocks[0]:
+			return None
+		return start, blocks
+
+	@classmethod
+	def action_replicate(kls, args):
+		"""
+		Copy a tape file by file from one drive to another and add the copy to the catalog,
+		verifying each tar against its write-time digest as it streams.
+		"""
+		from . import digest
+		from . import stream
+
+		vals = dict([_.split('=',1) for _ in args.action[1:]])
+
+		# Parse paramaters
+		p = DataArgsParser('replicate')
+		p.add('tape', str, required=True)
+		p.add('sn', str, required=True)
+		p.add('barcode', str, required=False)
+		p.add('files', int, required=False)
+		vals = p.check(vals, set_absent_as_none=True)
+
+		d = kls._db_open(args)
+
+		rows = d.find_tape_by_multi(vals['tape'])
+		if not len(rows):
+			raise PrintHelpException("Tape with rowid, serial number, or barcode '%s' not found" % vals['tape'])
+		src = rows[0]
+		dst = dict(src, sn=vals['sn'], barcode=vals['barcode'])
+
+		if len(d.find_tape_by_sn(dst['sn'])) or (dst['barcode'] and len(d.find_tape_by_barcode(dst['barcode']))):
+			raise PrintHelpException("Tape with serial number '%s' or barcode '%s' already exists" % (dst['sn'], dst['barcode']))
+
+		if kls._changer(args) is None and len(args.files) < 2:
+			raise PrintHelpException("replicate needs two drives, give -f twice (source then destination)")
+
+		tars = {_['num']: _ for _ in d.find_tars_by_tape_multi(src['rowid'])}
+		if len(d.find_tarspans_by_tape(src['rowid'])):
+			raise PrintHelpException("Tape SN=%s holds part of a tar continued across cartridges, which can't be copied on its own" % src['sn'])
+		# File 0 and any tape files between tars (eg, catalog copies) are copied too
+		nfiles = vals['files'] if vals['files'] is not None else max(list(tars) + [0]) + 1
+
+		sm = get_tape(kls._mount(args, src, 0))
+		dm = get_tape(kls._mount(args, dst, 1))
+		sm.rewind()
+		dm.rewind()
+
+		digests = {}
+		total = 0
+		for num in range(nfiles):
+			tar = tars.get(num)
+			print("-"*80)
+			print("Tape file %d%s" % (num, '' if tar is None else ' (tar)'))
+
+			# Checked chunk by chunk as it streams so a bad read stops the copy early
+			expected = None
+			if tar is not None and tar.get('sha256'):
+				expected = d.find_tarchunks(tar['rowid'])
+				dg = digest.StreamDigest(tar['chunk_sz'], expected)
+			else:
+				dg = digest.StreamDigest()
+
+			prog = Progress("File %d" % num, tar['sz'] if tar is not None else None)
+			with sm.open_read() as f, dm.open_write() as out:
+				try:
+					res = stream.pump(f, out, progress=prog, prefix='replicate', digest=dg)
+					dg.finish()
+				except digest.DigestMismatch as e:
+					raise Exception("Tape file %d of SN=%s failed verification, replica is incomplete and not cataloged: %s" % (num, src['sn'], e))
+			prog.finish()
+
+			if expected is not None and dg.sha256 != tar['sha256']:
+				raise Exception("Tape file %d of SN=%s has sha256 %s but %s was written, replica is incomplete and not cataloged" % (num, src['sn'], dg.sha256, tar['sha256']))
+
+			if tar is not None:
+				if expected is not None:
+					print("Verified: sha256 %s" % dg.sha256)
+				else:
+					# Written before digests were kept, record the one just computed
+					print("No write-time digest to verify against, recording sha256 %s" % dg.sha256)
+					digests[tar['rowid']] = dg
+
+			total += res['bytes']
+			print("Copied %d bytes in %.1f seconds (%.1f MB/s)" % (res['bytes'], res['seconds'], res['bytes'] / res['seconds'] / 1e6 if res['seconds'] > 0 else 0.0))
+
+		new_tape = d.clone_tape(src['rowid'], src['manufacturer'], src['model'], src['gen'], dst['sn'], dst['barcode'], src['ptime'], digests)
+		print("Replicated %d tape files (%d bytes) of SN=%s to SN=%s (rowid=%d)" % (nfiles, total, src['sn'], dst['sn'], new_tape))
+		STATS.print_report()
+
+	@classmethod
+	def action_import(kls, args):
+		"""
+		Catalog tars written without pymtar by reading them back in one pass.
+		Member data is hashed as the headers are parsed, nothing is staged to disk.
+		"""
+		import datetime
+		import hashlib
+		import tarfile
+		from . import compress
+		from . import digest
+		from . import stream
+
+		vals = dict([_.split('=',1) for _ in args.action[1:]])
+
+		# Parse paramaters
+		p = DataArgsParser('import')
+		p.add('tape', str, required=True)
+		p.add('tar', int, required=True)
+		p.add('files', int, required=False)
+		p.add('basedir', str, required=False)
+		p.add('options', str, required=False)
+		p.add('file', str, required=False)
+		vals = p.check(vals, set_absent_as_none=True)
+
+		if vals['files'] is None:
+			vals['files'] = 1
+		if vals['basedir'] is None:
+			vals['basedir'] = '/'
+
+		if not os.path.isabs(vals['basedir']):
+			raise PrintHelpException("basedir must be an absolute path")
+		if vals['file'] is not None and vals['files'] != 1:
+			raise PrintHelpException("Only one tape file can be imported from file=%s" % vals['file'])
+
+		d = kls._db_open(args)
+
+		rows = d.find_tape_by_multi(vals['tape'])
+		if not len(rows):
+			raise PrintHelpException("Tape with rowid, serial number, or barcode '%s' not found" % vals['tape'])
+		tape = rows[0]
+
+		# Check before spending hours reading the tape
+		nums = range(vals['tar'], vals['tar'] + vals['files'])
+		existing = [_['num'] for _ in d.find_tars_by_tape_multi(tape['rowid']) if _['num'] in nums]
+		if len(existing):
+			raise PrintHelpException("Tape SN=%s already has tar %s in the catalog" % (tape['sn'], ', '.join(str(_) for _ in existing)))
+
+		def read_tar(f, num):
+			"""Catalog the tar in open tape file @f, returns the number of files or None at end of data"""
+			dg = digest.StreamDigest()
+			raw = digest.DigestReader(f, dg)
+			if not raw.peek(1):
+				return None
+
+			# Legacy tapes were usually made with tar -z and friends, recognize it if not told
+			options = vals['options']
+			if options is None:
+				codec = compress.codec_for_magic(raw.peek(8))
+				options = compress.options_for_codec(codec) if codec is not None else None
+			else:
+				codec = compress.codec_for_options(options)
+
+			src = raw
+			if codec is not None:
+				src = compress.DecompressedReader(raw, codec)
+
+			files = []
+			skipped = 0
+			prog = Progress("Tar %d" % num)
+			try:
+				tf = tarfile.open(fileobj=src, mode='r|', bufsize=stream.CHUNK_SIZE)
+				names = {}
+				for ti in tf:
+					# Hard link to a file above is another name for it, as queue catalogs it, with
+					# device 0 and the member's block as inode standing in for the original file
+					if ti.islnk() and ti.linkname in names:
+						target = names[ti.linkname]
+						target['nlink'] = 2
+						files.append(dict(target, fullpath=os.path.normpath(os.path.join(vals['basedir'], ti.name)), relpath=ti.name,
+							fname=os.path.basename(ti.name), blk_offset=ti.offset // tarfile.BLOCKSIZE))
+						continue
+
+					# Directories, symbolic links, and devices aren't cataloged (as with queue)
+					if not ti.isreg():
+						skipped += 1
+						continue
+
+					h = hashlib.sha256()
+					member = tf.extractfile(ti)
+					with STATS.phase('import.hash'):
+						while True:
+							chunk = member.read(stream.CHUNK_SIZE)
+							if not chunk: break
+							h.update(chunk)
+							prog.update(len(chunk))
+
+					files.append({
+						'fullpath': os.path.normpath(os.path.join(vals['basedir'], ti.name)),
+						'relpath': ti.name,
+						'fname': os.path.basename(ti.name),
+						'sz': ti.size,
+						'sha256': h.hexdigest(),
+						'mtime': ti.mtime,
+						'blk_offset': ti.offset // tarfile.BLOCKSIZE,
+						'dev': 0,
+						'ino': ti.offset // tarfile.BLOCKSIZE,
+						'nlink': 1,
+						'alloc': ti.size,
+						'extents': None,
+					})
+					if ti.issparse():
+						extents = [_ for _ in ti.sparse if _[1]]
+						files[-1].update(alloc=sum(_[1] for _ in extents), extents=len(extents))
+					names[ti.name] = files[-1]
+			except tarfile.ReadError as e:
+				raise Exception("Tape file %d of SN=%s is not a readable tar: %s" % (num, tape['sn'], e))
+
+			# Rest of the tape file (end of archive and record padding) so the digest covers all of it
+			while True:
+				with STATS.phase('import.read'):
+					chunk = raw.read(stream.CHUNK_SIZE)
+				if not chunk: break
+			prog.finish()
+			dg.finish()
+
+			# No write time is known, the newest member is the closest bound on it
+			newest = max([_['mtime'] for _ in files] + [0])
+			t = datetime.datetime.fromtimestamp(newest) if newest else None
+
+			id_tar = d.import_tar(tape['rowid'], num, t, t, options, None, files, dg)
+			d.set_tarfile_written(id_tar)
+			STATS.incr('import.files', len(files))
+			print("Tar %d: %d files (%s), %d other members skipped, sha256 %s" % (num, len(files), fmt_bytes(sum(_['sz'] for _ in files)), skipped, dg.sha256))
+			return len(files)
+
+		total = 0
+		if vals['file'] is not None:
+			with open(vals['file'], 'rb') as f:
+				total += read_tar(f, vals['tar']) or 0
+		else:
+			m = get_tape(kls._mount(args, tape, 0))
+			kls._seek_tar(m, vals['tar'])
+			for num in nums:
+				try:
+					with m.open_read() as f:
+						cnt = read_tar(f, num)
+				except FileNotFoundError:
+					# File-backed tape past the last file
+					cnt = None
+				if cnt is None:
+					print("End of data at tape file %d" % num)
+					break
+				total += cnt
+
+		print("Imported %d files into tape SN=%s" % (total, tape['sn']))
+		STATS.print_report()
+
+	@classmethod
+	def action_checkpoint(kls, args):
+		"""
+		Fold the write-ahead log into the catalog file so it can be copied (eg, to tape file 0),
+		or with dest=PATH make a consistent single-file copy even while queue or write are running.
+		"""
+		vals = dict([_.split('=',1) for _ in args.action[1:]])
+
+		# Parse paramaters
+		p = DataArgsParser('checkpoint')
+		p.add('dest', str, required=False)
+		vals = p.check(vals, set_absent_as_none=True)
+
+		d = kls._db_open(args)
+
+		if vals['dest'] is not None:
+			if os.path.exists(vals['dest']):
+				raise PrintHelpException("Copy destination already exists: %s" % vals['dest'])
+			with STATS.phase('checkpoint.backup'):
+				d.backup(vals['dest'])
+			print("Copied catalog to %s (%s)" % (vals['dest'], fmt_bytes(os.path.getsize(vals['dest']))))
+			return
 
+		# Readers still on old pages keep the log from being emptied, wait them out for a while
+		for attempt in range(30):
+			with STATS.phase('checkpoint'):
+				busy, log, done = d.checkpoint()
+			if not busy:
+				break
+			time.sleep(1)
 		else:
-			raise PrintHelpException("Must provide fullpath or name to extract to match files")
-
-		# TODO:
-		# 1) Query user for base path
-		# 2) Ask if full path, relative path, or files-only should be extracted
-		#      fullpath = the entire full path is replicated on base path
-		#      relpath = the relative path is replicated on base path
-		#      files-only = files are put directly into base path (risk of duplicate file names)
-		# 3) Make directory structure
-		# 4) Split matches by tape
-		# 5) For each tape, ask user to insert tape
-		# 5a) mt status shouldn't be (-1,-1,-1)
-		# 5b) mt fsf to each tar
-		# 5c) Invoke tar to extract files
-		# 5d) Increment access counter
-		# 6) Hash files and match in database
-
-		raise NotImplementedError
+			raise Exception("Catalog is still busy after 30 attempts, %d of %d log pages checkpointed; stop queue and write or use dest= to copy it" % (done, log))
 
+		print("Checkpointed %s, %s is complete on its own" % (args.db, args.db))
+
+	@classmethod
+	def action_plan(kls, args):
+		"""Print the cartridges and tars that extract would read, in order, without reading them"""
+		from . import changer
+
+		vals, d, jobs = kls._action_read_jobs(args, 'plan', True)
+		if not len(jobs):
+			print("No matching files found")
+			return
+
+		batches = changer.plan(jobs, key='id_tape')
+
+		if args.json:
+			import json
+			print(json.dumps([
+				{'sn': batch[0]['tape']['sn'], 'barcode': batch[0]['tape']['barcode'], 'tars': [
+					{'num': job['num'], 'files': [fl['fullpath'] for fl in job['files']]} for job in batch
+				]} for cartridge, batch in batches
+			]))
+			return
+
+		print("%d files in %d tars on %d tapes" % (sum(len(_['files']) for _ in jobs), len(jobs), len(batches)))
+		for cartridge, batch in batches:
+			print("Tape SN=%s, barcode=%s" % (batch[0]['tape']['sn'], batch[0]['tape']['barcode']))
+			for job in batch:
+				print("\ttar num=%d: %d files, %s" % (job['num'], len(job['files']), fmt_bytes(sum(_['sz'] or 0 for _ in job['files']))))
+
+	@classmethod
+	def action_daemon(kls, args):
+		from . import daemon
+
+		vals = dict([_.split('=',1) for _ in args.action[1:]])
+
+		p = DataArgsParser('daemon')
+		p.add('workers', int, required=False, default=8)
+		vals = p.check(vals, set_absent_as_none=True)
+
+		daemon.Daemon(args, daemon.socket_path(args), vals['workers'] or 8).serve()
+
+	@classmethod
+	def action_extract(kls, args):
+		import subprocess
+		import tempfile
+		from . import compress
+		from . import dryrun
+		from . import stream
+
+		vals, d, jobs = kls._action_read_jobs(args, 'extract', True)
+		if not len(jobs):
+			print("No matching files found")
+			return
+
+		dest = os.path.abspath(vals['dest'])
+		os.makedirs(dest, exist_ok=True)
+
+		results = {'ok': 0, 'bad': 0, 'missing': 0, 'cached': 0}
+
+		# Serve what is cached first so only tars with files left need a tape
+		cache = kls._cache(args)
+		if cache is not None:
+			for job in jobs:
+				left = []
+				for fl in job['files']:
+					path = os.path.join(dest, fl['relpath'])
+					if cache.get(fl['sha256'], path):
+						print("Cached:    %s" % path)
+						results['ok'] += 1
+						results['cached'] += 1
+					else:
+						left.append(fl)
+				job['files'] = left
+
+			jobs = [_ for _ in jobs if len(_['files'])]
+
+		def extract(m, job):
+			# Relative paths are replicated under the destination
+			with tempfile.NamedTemporaryFile() as lst:
+				names = set()
+				for fl in job['files']:
+					names.add(fl['relpath'])
+					# A hard link can only be extracted along with the member it links to
+					target = d.find_hardlink_target(fl)
+					if target is not None:
+						names.add(target['relpath'])
+				for name in sorted(names):
+					lst.write(name.encode('utf-8') + b'\0')
+				lst.flush()
+
+				# Starting part way through a compressed tar it is decompressed here, tar(1) can't
+				# start from a block in the middle
+				start = kls._tar_start(d, job)
+
+				subargs = ['tar', 'xf', '-', '-C', dest, '--null', '--verbatim-files-from', '-T', lst.name]
+				if job['tar']['options']:
+					subargs += [_ for _ in job['tar']['options'].split() if start is None or _ not in compress.OPTIONS]
+				print(subargs)
+
+				with kls._open_tar(args, d, m, job) as f:
+					if start is not None:
+						print("Starting at tar block %d" % (start[0] // dryrun.BLOCK))
+						f = compress.open_at(f, compress.codec_for_options(job['tar']['options']), start[1], start[0])
+					proc = subprocess.Popen(subargs, stdin=subprocess.PIPE)
+					try:
+						stream.pump(f, proc.stdin, prefix='extract')
+					except BrokenPipeError:
+						pass
+					finally:
+						try:
+							proc.stdin.close()
+						except BrokenPipeError:
+							pass
+						proc.wait()
+
+				if proc.returncode != 0:
+					print("tar exited with code %d" % proc.returncode)
+
+			d.incr_tar_access(job['tar']['rowid'])
+
+			# Check extracted files against the catalog
+			for fl in job['files']:
+				path = os.path.join(dest, fl['relpath'])
+				if not os.path.exists(path):
+					print("Missing:  %s" % path)
+					results['missing'] += 1
+				elif hashfile(path) != fl['sha256']:
+					print("Mismatch: %s" % path)
+					results['bad'] += 1
+				else:
+					print("Extracted: %s" % path)
+					results['ok'] += 1
+					if cache is not None:
+						cache.put(fl['sha256'], path)
+
+		failed = []
+		if len(jobs):
+			failed = kls._action_run_jobs(args, jobs, extract)
+
+		print("Extracted %d files: %d ok, %d hash mismatches, %d missing" % (results['ok'] + results['bad'] + results['missing'], results['ok'], results['bad'], results['missing']))
+		if len(failed):
+			print("Could not read %d of %d tars" % (len(failed), len(jobs)))
+		if cache is not None:
+			print("Cache: %d of %d files served without tape, %s of %s used" % (results['cached'], results['ok'] + results['bad'] + results['missing'], fmt_bytes(cache.size), fmt_bytes(cache.max_bytes)))
+		STATS.print_report()
+
+		if results['bad'] or results['missing'] or len(failed):
+			raise Exception("Extracted files failed verification")
+
+	@classmethod
+	def action_verify(kls, args):
+		import hashlib
+		import tarfile
+		from . import compress
+		from . import stream
+
+		vals, d, jobs = kls._action_read_jobs(args, 'verify', False)
+		if not len(jobs):
+			print("No matching files found")
+			return
+
+		if (vals.get('quick') or '').strip().lower() in ('1', 'true'):
+			return kls._action_verify_quick(args, d, jobs)
+
+		results = {'ok': 0, 'bad': 0, 'missing': 0}
+
+		def verify(m, job):
+			wanted = {fl['relpath']: fl for fl in job['files']}
+
+			# Hard links are checked against the hash of the member they link to
+			targets = set()
+			for fl in job['files']:
+				target = d.find_hardlink_target(fl)
+				if target is not None:
+					targets.add(target['relpath'])
+			hashes = {}
+
+			# Hash members straight from the tape stream without extracting them
+			start = kls._tar_start(d, job)
+			with kls._open_tar(args, d, m, job) as f:
+				# Block compressed tars are concatenated members, which tarfile doesn't follow
+				codec = compress.codec_for_options(job['tar']['options'])
+				if start is not None:
+					print("Starting at tar block %d" % (start[0] // tarfile.BLOCKSIZE))
+					f = compress.open_at(f, codec, start[1], start[0])
+				elif codec is not None:
+					f = compress.DecompressedReader(f, codec)
+				tf = tarfile.open(fileobj=f, mode='r|*', bufsize=stream.CHUNK_SIZE)
+				for ti in tf:
+					fl = wanted.pop(ti.name, None)
+					if ti.islnk():
+						if fl is None: continue
+						h = hashes.get(ti.linkname)
+						if h is None:
+							# Linked to a member not known to be one, reported missing
+							wanted[ti.name] = fl
+							continue
+					elif ti.isreg() and (fl is not None or ti.name in targets):
+						h = hashlib.sha256()
+						src = tf.extractfile(ti)
+						with STATS.phase('verify.hash'):
+							while True:
+								chunk = src.read(stream.CHUNK_SIZE)
+								if not chunk: break
+								h.update(chunk)
+						h = h.hexdigest()
+						if ti.name in targets:
+							hashes[ti.name] = h
+						if fl is None: continue
+					else:
+						continue
+
+					if h == fl['sha256']:
+						results['ok'] += 1
+					else:
+						print("Mismatch: %s" % fl['fullpath'])
+						results['bad'] += 1
+
+					# Don't read the rest of the tape file if everything is found
+					if not len(wanted):
+						break
+
+			for fl in wanted.values():
+				print("Missing:  %s" % fl['fullpath'])
+				results['missing'] += 1
+
+			d.incr_tar_access(job['tar']['rowid'])
+
+		failed = kls._action_run_jobs(args, jobs, verify)
+
+		print("Verified %d files: %d ok, %d hash mismatches, %d missing" % (sum(results.values()), results['ok'], results['bad'], results['missing']))
+		if len(failed):
+			print("Could not read %d of %d tars" % (len(failed), len(jobs)))
+		STATS.print_report()
+
+		if results['bad'] or results['missing'] or len(failed):
+			raise Exception("Verification failed")
+
+	@classmethod
+	def _action_verify_quick(kls, args, d, jobs):
+		"""
+		Verify whole tape files against their write-time sha256 rather than member by member.
+		On a mismatch the chunk hashes give the damaged byte ranges.
+		"""
+		from . import digest
+		from . import stream
+
+		results = {'ok': 0, 'bad': 0, 'nodigest': 0}
+
+		def verify(m, job):
+			tar = job['tar']
+			if not tar.get('sha256'):
+				print("No write-time digest recorded, skipping (verify without quick=1 instead)")
+				results['nodigest'] += 1
+				return
+
+			dg = digest.StreamDigest(tar['chunk_sz'])
+			with kls._open_tar(args, d, m, job) as f:
+				while True:
+					with STATS.phase('verify.read'):
+						chunk = f.read(stream.CHUNK_SIZE)
+					if not chunk: break
+					dg.update(chunk)
+			dg.finish()
+
+			d.incr_tar_access(tar['rowid'])
+
+			if dg.sha256 == tar['sha256'] and dg.bytes == tar['sz']:
+				print("OK: %d bytes, sha256 %s" % (dg.bytes, dg.sha256))
+				results['ok'] += 1
+				return
+
+			print("Mismatch: read %d bytes with sha256 %s, wrote %d bytes with sha256 %s" % (dg.bytes, dg.sha256, tar['sz'], tar['sha256']))
+			for start, end in digest.damaged_ranges(d.find_tarchunks(tar['rowid']), dg.leaves, tar['chunk_sz']):
+				print("\tDamaged: bytes %d to %d (records %d to %d)" % (start, min(end, max(tar['sz'], dg.bytes)), start // stream.RECORD_SIZE, min(end, max(tar['sz'], dg.bytes)) // stream.RECORD_SIZE))
+			results['bad'] += 1
+
+		failed = kls._action_run_jobs(args, jobs, verify)
+
+		print("Verified %d tars: %d ok, %d damaged, %d without a write-time digest" % (sum(results.values()), results['ok'], results['bad'], results['nodigest']))
+		if len(failed):
+			print("Could not read %d of %d tars" % (len(failed), len(jobs)))
+		STATS.print_report()
+
+		if results['bad'] or len(failed):
+			raise Exception("Verification failed")
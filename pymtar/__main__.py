@@ -1,28 +1,14 @@
 
 # Global libraries
 import argparse
-import datetime
-import json
-import os
-import subprocess
 import sys
-import tempfile
 
 # This library
 import pymtar
+import pymtar.profiling
 
 
-def main():
-	p = argparse.ArgumentParser(add_help=False)
-	p.add_argument('-h', '--help', action='store_true', default=False, help='Show usage information')
-	p.add_argument('-f', '--file', default='/dev/nst0', help='Device file path')
-	p.add_argument('-j', '--json', default=False, action='store_true', help="Print responses, where appropriate, in JSON instead")
-	p.add_argument('-d', '--db', nargs='?', required=True, help="Database file to use, will be created if not found")
-	p.add_argument('--notify', choices=('all','limited','none'), default=None, help="Use pushover.net to send notifications to your devices. Default is none.")
-	p.add_argument('action', nargs=argparse.REMAINDER, help='Action/command to execute')
-
-
-	action_help = """
+ACTION_HELP = """
   Notifications help:
     none                Do not send any notifications
     limited             This will send limited notifications:
@@ -32,17 +18,35 @@ def main():
                            Everything under "limited"
                            Individual tar writes
                            Every 100 queued files or every 10% of the files, whichever is larger
+    Notifications are sent in the background and never block queueing or writing.
+    Messages waiting behind a slow endpoint are batched together into one message.
+
+  Profiling help:
+    --profile=OUT       Profile the action, view cProfile output with `python3 -m pstats OUT`
+                        or feed sampled stacks to flamegraph.pl
+    SIGUSR1             `kill -USR1 <pid>` prints the stack of every thread and all counters
+                        to stderr without interrupting the running action
+
+  Notification transports (--notify-to):
+    pushover            Send through pushover.net (requires the pushover library)
+    file:PATH           Append each notification as a JSON line to PATH
+    socket:PATH         Send each notification as a JSON line to a Unix socket
+
   Actions help:
     find tape.barcode   Find tapes by barcode
     find tape.sn        Find tapes by serial number
     find tarfile.name   Find tarfiles by name using fnmatch (case-insensitive) on just the file name
-    list tapes          List all tapes
-    list tars           List all tars
+    list tapes          List all tapes, with the number, total bytes, and largest of their files and when
+                        one was last queued (file_cnt, file_sz, file_max, qtime)
+    list tars           List all tars, with the same totals per tar
                             tape          Tape rowid, serial number, or barcode to limit search by
     list files          List all files
                             tape          Tape rowid, serial number, or barcode to limit search by
                             tar           Tar rowid to limit search by
                             tarnum        Tar num to limit search by
+    list stats          List per-tar write statistics (bytes, MB/s, underruns, seek time)
+                            tape          Tape rowid, serial number, or barcode to limit search by
+    list shards         List the catalog shards searched along with this catalog and their tapes
     new tape            Create a new tape record
                             manufacturer  Manufacturer of the cartridge
                             model         Model number of catridge
@@ -57,7 +61,12 @@ def main():
                             etime         End time of write (YYYY-MM-DD HH:MM:SS)
                             access_cnt    Access count (optional, default is zero)
                             options       Options passed to tar (eg, '-z')
+                                          -z, -j, and -J are done by pymtar in parallel blocks on all CPUs, which
+                                          gzip, bzip2, and xz still read as one file
                             uname         Value of `uname -a` (optional, uname invoked if not provided)
+    new shard           Add another catalog (eg, a per-tape database) to search with this one, or refresh
+                        its list of tapes
+                            path          Path of the catalog database
     new file            Create a new file within a tar file
                             tape          Tape rowid, serial number, or barcode
                             tar           Tar rowid or tar.num on this cartridge
@@ -71,43 +80,193 @@ def main():
                             tar           Tar file to add files to
                             basedir       Directory path to truncate off for the relative path to supply to tar
                             forceupdate   If file is known, rehash and update database (pass "1" or "true" (case-insensitive) to enable)
+                                          Known files whose size or mtime changed are reported but only rehashed with forceupdate
+                            jobs          Number of files to hash concurrently (default is the number of CPUs)
                             *             List of files to add
     write               Write a tar file to the tape drive
-                            tape          Tape identifier
+                            tape          Tape identifier, or several separated by commas to write in parallel
+                                          on the drives given by repeating -f (eg, -f /dev/nst0 -f /dev/nst1),
+                                          more tapes than drives needs --changer to swap them
                             tar           Tar file to write
-    extract             Extract files from a tape
+                            readrate      Limit in MB/s on reading sources, shared fairly by all drives (optional)
+                            readahead     Make the tar in pymtar rather than with tar(1), reading files of up to 64 KiB
+                                          this many at a time ahead of the stream (optional, for many small files)
+                            rehash        Rehash files whose size or mtime changed since queueing and write them
+                                          (pass "1" or "true"), otherwise the write stops after listing them all
+                            jobs          Number of files to stat and rehash concurrently (default is the number of CPUs)
+                            dryrun        Only predict the write (pass "1" or "true"): exact tar sizes from the catalog,
+                                          tape usage against the capacity of the LTO generation, and time from the
+                                          rates of earlier writes
+                            members       With dryrun, write each member's tar, block offset, bytes of data stored, and relpath to this file
+                            simulate      Also make each tar and stream it into a file-backed tape in this directory,
+                                          throttled to the predicted drive rate, without changing the catalog
+                            simrate       Rate in MB/s to throttle simulate to (optional)
+                            next          Tapes to continue on, in order and separated by commas, if the tape fills up
+                                          part way through a tar (optional, one tape only); the rest of the tar goes
+                                          after the last tape file used on the next one (file 1, after the catalog copy,
+                                          on one with no tars) and later tars aren't written; needs --changer or a
+                                          terminal to confirm each swap
+    extract             Extract files from a tape and check them against the catalog hashes
+                        (a file on several tapes, eg a replica, is read from one: a loaded one or the original)
                             tape          Tape identifier (optional to limit search)
                             tar           Tar file to read from (optional to limit search)
                             fullpath      fnmatch on full path (exclusive with 'name')
                             name          fnmatch on just the filename (exclusive with 'fullpath')
+                            dest          Directory to extract into, relative paths are kept
+    plan                Print the tapes and tars extract would read for the same matches, in order
+                            tape, tar, fullpath, name as for extract
+    import              Catalog tars written without pymtar by reading them back (from -f, positioned at tar,
+                        or from a tar file on disk), hashing every file in one pass without extracting anything
+                            tape          Tape rowid, serial number, or barcode the tars are on (must already exist)
+                            tar           Tape file number of the first tar
+                            files         Number of consecutive tape files to import (optional, default 1)
+                            basedir       Directory the tars were made from, for fullpath (optional, default /)
+                            options       tar options the tars were made with (optional, eg -z, recognized if absent)
+                            file          Read the tar from this file rather than the tape (optional)
+                        stime and etime are set to the newest member's mtime as the write time isn't known
+    checkpoint          Fold the write-ahead log into the database file so the file alone is the whole catalog,
+                        run before copying it (eg, onto a tape)
+                            dest          Instead write a consistent copy of the catalog to this new file, which works
+                                          while queue or write are running (optional)
+    replicate           Copy a tape to a new cartridge drive to drive (first -f is the source, second the destination,
+                        or drives 0 and 1 of --changer) and add the copy to the catalog
+                            tape          Tape rowid, serial number, or barcode to copy
+                            sn            Serial number of the new cartridge
+                            barcode       Barcode of the new cartridge (optional)
+                            files         Number of tape files to copy (optional, default is through the last tar)
+                        Tars are checked against their write-time sha256 as they stream and nothing is cataloged
+                        if any fails
+    daemon              Keep the catalog open and serve find, list, and plan on a Unix socket (see --socket)
+                            workers       Number of requests run at once (default is 8), any number of clients can stay connected
+                        While a daemon is running find, list, and plan are sent to it (unless --no-daemon)
     verify              Verify contents of a tape without extracting
                             tape          Tape identifier (optional to limit search)
                             tar           Tar file to read from (optional to limit search)
-                            fullpath      fnmatch on full path (exclusive with 'name')
+                            fullpath      fnmatch on full path (exclusive with 'name', default is all files)
                             name          fnmatch on just the filename (exclusive with 'fullpath')
+                            quick         Check whole tape files against the sha256 recorded when written instead of each
+                                          file (pass "1" or "true"), damaged byte ranges are narrowed to 64 MiB chunks
+
+  Once shards are added, find and list tapes/tars/files search this catalog and all shards with
+  results merged in order; tapes are shown by serial number as rowids are per shard.
+  Matches of extract and verify are read one tape at a time, each tape once and in file order.
+  With --cache, extract copies files found in the cache (checked against the catalog hash) and
+  only reads the tars holding the rest, which are then added to the cache.
+  With --changer, write, extract, and verify load cartridges by barcode instead of asking for them.
 """
 
-	args = p.parse_args()
+def get_parser():
+	"""Command line parser, also used by the benchmarks to build arguments"""
+	p = argparse.ArgumentParser(add_help=False)
+	p.add_argument('-h', '--help', action='store_true', default=False, help='Show usage information')
+	p.add_argument('-f', '--file', action='append', default=None, help='Device file path, or a directory to use a file-backed tape stand-in. Repeat to write several tapes on several drives at once. Default is /dev/nst0.')
+	p.add_argument('-j', '--json', default=False, action='store_true', help="Print responses, where appropriate, in JSON instead")
+	p.add_argument('-d', '--db', nargs='?', required=True, help="Database file to use, will be created if not found")
+	p.add_argument('--db-profile', choices=('wal','legacy'), default='wal', help="Catalog connection settings: wal lets queries run during queue and write (run checkpoint before copying the database), legacy uses a rollback journal for catalogs on network filesystems. Default is wal.")
+	p.add_argument('--notify', choices=('all','limited','none'), default=None, help="Use pushover.net to send notifications to your devices. Default is none.")
+	p.add_argument('--notify-to', default='pushover', help="Notification transport: pushover, file:PATH, or socket:PATH. Default is pushover.")
+	p.add_argument('--notify-timeout', type=float, default=10.0, help="Seconds to wait on a notification send before giving up. Default is 10.")
+	p.add_argument('--prom-textfile', default=None, help="Write counters and write rates in Prometheus text format to this file (eg, for the node_exporter textfile collector)")
+	p.add_argument('--changer', default=None, help="Tape library to load cartridges by barcode: mtx:/dev/sgN (drives are the -f devices in order) or emu:DIR for an emulated library")
+	p.add_argument('--cache', default=None, help="Directory to keep restored files in, keyed by sha256, so later extracts of the same content need no tape")
+	p.add_argument('--cache-size', type=int, default=10240, help="Size limit of --cache in MiB, least recently used files are evicted beyond it. Default is 10240.")
+	p.add_argument('--socket', default=None, help="Unix socket of the catalog daemon. Default is the database path with .sock appended.")
+	p.add_argument('--no-daemon', default=False, action='store_true', help="Run find, list, and plan here even if a daemon is running")
+	p.add_argument('--pause', type=int, default=30, help="Seconds to pause before writing each tar to allow ctrl-c. Default is 30.")
+	p.add_argument('--profile', default=None, metavar='OUT', help="Profile the action and write the profile to OUT")
+	p.add_argument('--profile-mode', choices=('cprofile','sample'), default='cprofile', help="cprofile writes pstats data, sample writes collapsed stacks of all threads. Default is cprofile.")
+	p.add_argument('--profile-interval', type=float, default=0.01, help="Seconds between stack samples for --profile-mode=sample. Default is 0.01.")
+	p.add_argument('--sql-timing', default=False, action='store_true', help="Time every SQL statement and print a summary at exit (implied by --profile)")
+	p.add_argument('action', nargs=argparse.REMAINDER, help='Action/command to execute')
+
+	return p
+
+def parse_args(p, argv=None):
+	"""Parse arguments, args.files is every drive given and args.file is the first"""
+	args = p.parse_args(argv)
+
+	args.files = args.file or ['/dev/nst0']
+	args.file = args.files[0]
+
+	return args
+
+def run_client(args):
+	"""
+	Send the action to the catalog daemon if it serves it and one is running.
+	Returns the exit code, or None to run the action here.
+	"""
+	import os
+
+	# Cheap checks first so that not using a daemon costs nothing
+	if args.action[0] not in ('find', 'list', 'plan'):
+		return None
+	path = args.socket or (os.path.abspath(args.db) + '.sock')
+	if not os.path.exists(path):
+		return None
+
+	from pymtar import daemon
+
+	resp = daemon.request(path, args.action, args.json)
+	if resp is None:
+		return None
+
+	sys.stdout.write(resp.get('output', ''))
+	if resp['ok']:
+		return 0
+
+	if resp.get('help'):
+		get_parser().print_help()
+		print(ACTION_HELP)
+	print("Error: %s" % resp['error'])
+	return 2 if resp.get('help') else 1
+
+def main():
+	p = get_parser()
+
+	args = parse_args(p)
 	if args.help:
 		p.print_help()
-		print(action_help)
+		print(ACTION_HELP)
 		sys.exit(2)
 
-	if args.notify != 'none' and pymtar.pushover is None:
-		p.print_help()
-		print(action_help)
+	if args.notify not in (None, 'none'):
+		try:
+			pymtar.get_notifier(args)
+		except ImportError:
+			p.print_help()
+			print(ACTION_HELP)
 
-		print("Pushover is not configured, cannot send notifications")
-		sys.exit(2)
+			print("Pushover is not configured, cannot send notifications")
+			sys.exit(2)
+		except ValueError as e:
+			p.print_help()
+			print(ACTION_HELP)
+
+			print("Error: %s" % str(e))
+			sys.exit(2)
+
+	# Thin client: hand queries to a running daemon rather than opening the catalog here
+	if len(args.action) and not args.no_daemon and args.profile is None and not args.sql_timing:
+		ret = run_client(args)
+		if ret is not None:
+			sys.exit(ret)
+
+	pymtar.profiling.install_signal_handler()
+
+	if args.profile is not None or args.sql_timing:
+		pymtar.profiling.SQL_TIMING = True
 
 	try:
-		return pymtar.actions.action(args)
+		return pymtar.profiling.run(args, pymtar.actions.action)
 	except pymtar.PrintHelpException as e:
 		p.print_help()
-		print(action_help)
+		print(ACTION_HELP)
 
 		print("Error: %s" % str(e))
 		sys.exit(2)
+	finally:
+		if pymtar.profiling.SQL_TIMING:
+			pymtar.STATS.print_report()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,293 @@
+"""
+Tar stream made by pymtar with concurrent read-ahead of small files.
+
+GNU tar reads each member serially, so a tar of millions of small files spends its time in
+open/read/close latency rather than moving data. ArchiveReader stats upcoming members and
+reads the small ones on a thread pool into a bounded staging area, while emitting them in
+the order given (catalog order) so the archive is the same as tar(1) would make from the list.
+
+Like tar --sparse, a file linked to one already archived is stored as a hard link to it, and a
+file with fewer blocks allocated than its size is stored as an old GNU sparse member holding
+only its allocated extents.
+"""
+
+# Global libraries
+import collections
+import functools
+import itertools
+import os
+import stat
+import tarfile
+
+# This library
+from .stats import STATS
+from .stream import RECORD_SIZE, CHUNK_SIZE
+
+# Files up to this size are read ahead whole, larger ones are streamed when their turn comes
+SMALL_SIZE = 64 * 1024
+
+# Limits on read-ahead: bytes staged in memory and members in flight
+STAGING_BYTES = 64 * 1024 * 1024
+STAGING_MEMBERS = 4096
+
+# Members handed to a read-ahead thread at a time
+BATCH = 32
+
+BLOCK = tarfile.BLOCKSIZE
+
+
+@functools.lru_cache(maxsize=None)
+def _uname(uid):
+	try:
+		import pwd
+		return pwd.getpwuid(uid)[0]
+	except (ImportError, KeyError):
+		return ''
+
+@functools.lru_cache(maxsize=None)
+def _gname(gid):
+	try:
+		import grp
+		return grp.getgrgid(gid)[0]
+	except (ImportError, KeyError):
+		return ''
+
+def tarinfo(fullpath, relpath, st):
+	"""TarInfo for @fullpath stored as @relpath with lstat result @st, like TarFile.gettarinfo()"""
+	ti = tarfile.TarInfo(relpath)
+	ti.mode = stat.S_IMODE(st.st_mode)
+	ti.uid = st.st_uid
+	ti.gid = st.st_gid
+	ti.mtime = st.st_mtime
+	ti.uname = _uname(st.st_uid)
+	ti.gname = _gname(st.st_gid)
+
+	if stat.S_ISREG(st.st_mode):
+		ti.type = tarfile.REGTYPE
+		ti.size = st.st_size
+	elif stat.S_ISLNK(st.st_mode):
+		ti.type = tarfile.SYMTYPE
+		ti.linkname = os.readlink(fullpath)
+	elif stat.S_ISDIR(st.st_mode):
+		ti.type = tarfile.DIRTYPE
+	else:
+		raise Exception("Cannot archive special file '%s'" % fullpath)
+
+	return ti
+
+def is_sparse(st):
+	"""True if stat result @st is of a file with fewer bytes allocated than its size, which tar --sparse looks for holes in"""
+	return stat.S_ISREG(st.st_mode) and st.st_blocks * 512 < st.st_size
+
+def sparse_map(fullpath):
+	"""Allocated extents of @fullpath as a list of (offset, length), found with SEEK_DATA and SEEK_HOLE like tar --sparse"""
+	ret = []
+	fd = os.open(fullpath, os.O_RDONLY)
+	try:
+		off = 0
+		while True:
+			try:
+				start = os.lseek(fd, off, os.SEEK_DATA)
+			except OSError:
+				# ENXIO, no data after @off
+				break
+			off = os.lseek(fd, start, os.SEEK_HOLE)
+			if off > start:
+				ret.append( (start, off - start) )
+	finally:
+		os.close(fd)
+	return ret
+
+def sparse_header(ti, extents):
+	"""
+	Header blocks of regular file @ti as an old GNU sparse member holding @extents, a list of
+	(offset, length), the same as tar --sparse makes. ti.size is set to the bytes of data stored.
+	"""
+	realsize = ti.size
+	ti.type = tarfile.GNUTYPE_SPARSE
+	ti.size = sum(_[1] for _ in extents)
+	buf = bytearray(ti.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+
+	# Map ends with an empty extent at the end of the file, 4 entries fit in the header
+	entries = list(extents) + [(realsize, 0)]
+	hdr = len(buf) - BLOCK
+	for x, (off, n) in enumerate(entries[:4]):
+		buf[hdr+386+24*x:hdr+398+24*x] = tarfile.itn(off, 12, tarfile.GNU_FORMAT)
+		buf[hdr+398+24*x:hdr+410+24*x] = tarfile.itn(n, 12, tarfile.GNU_FORMAT)
+	buf[hdr+482] = 1 if len(entries) > 4 else 0
+	buf[hdr+483:hdr+495] = tarfile.itn(realsize, 12, tarfile.GNU_FORMAT)
+	buf[hdr+148:hdr+155] = b"%06o\0" % tarfile.calc_chksums(bytes(buf[hdr:]))[0]
+
+	# and the rest in following blocks of 21
+	rest = entries[4:]
+	for x in range(0, len(rest), 21):
+		ext = bytearray(BLOCK)
+		for y, (off, n) in enumerate(rest[x:x+21]):
+			ext[24*y:24*y+12] = tarfile.itn(off, 12, tarfile.GNU_FORMAT)
+			ext[24*y+12:24*y+24] = tarfile.itn(n, 12, tarfile.GNU_FORMAT)
+		ext[504] = 1 if x + 21 < len(rest) else 0
+		buf += ext
+
+	return bytes(buf)
+
+def _read_extents(fullpath, extents):
+	"""Data of @extents of @fullpath joined, zero padded if the file shrank"""
+	parts = []
+	with open(fullpath, 'rb') as f:
+		for off, n in extents:
+			f.seek(off)
+			data = f.read(n)
+			parts.append(data + tarfile.NUL * (n - len(data)))
+	return b''.join(parts)
+
+def _prefetch(fullpath, relpath, small):
+	"""
+	Stat a member and, if a regular file no larger than @small, read it whole (or the allocated
+	extents of a sparse one). ti.sparse holds the extents of a sparse file, None otherwise.
+	"""
+	st = os.lstat(fullpath)
+	ti = tarinfo(fullpath, relpath, st)
+	ti.sparse = sparse_map(fullpath) if is_sparse(st) else None
+
+	data = None
+	if ti.sparse is not None:
+		if sum(_[1] for _ in ti.sparse) <= small:
+			data = _read_extents(fullpath, ti.sparse)
+	elif ti.type == tarfile.REGTYPE and ti.size <= small:
+		with open(fullpath, 'rb') as f:
+			data = f.read()
+		# Whatever was read is what gets archived, even if the file changed since the stat
+		ti.size = len(data)
+
+	return ti, data, st
+
+def _prefetch_batch(files, small):
+	"""Worker: _prefetch() each of @files, a list of (full path, relative path)"""
+	return [_prefetch(fullpath, relpath, small) for fullpath, relpath in files]
+
+
+class ArchiveReader:
+	"""
+	File-like reader of a GNU format tar of @files, for stream.pump().
+	@files is an iterable of (full path, relative path to store it as) in the order to archive them,
+	consumed only as far as the read-ahead window.
+	Small files are read ahead on @jobs threads.
+	"""
+
+	def __init__(self, files, *, jobs=8, small=SMALL_SIZE, staging_bytes=STAGING_BYTES, staging_members=STAGING_MEMBERS):
+		import concurrent.futures
+
+		self.files = iter(files)
+		self.small = small
+		self.staging_bytes = staging_bytes
+		self.staging_members = staging_members
+
+		self._pool = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix='pymtar-readahead')
+		self._gen = self._generate()
+		self._buf = b''
+
+		# Relative path each multiply linked file was first archived as, by (device, inode)
+		self._links = {}
+
+		# Bytes written into the archive so far
+		self.bytes = 0
+
+	def _generate(self):
+		"""Yield the archive in chunks"""
+		pending = collections.deque()
+		more = True
+
+		while True:
+			# Keep the read-ahead window full, at most @small bytes are staged per member
+			while more and len(pending) * BATCH < min(self.staging_members, self.staging_bytes // self.small):
+				batch = list(itertools.islice(self.files, BATCH))
+				if not len(batch):
+					more = False
+					break
+				pending.append( (batch, self._pool.submit(_prefetch_batch, batch, self.small)) )
+
+			if not pending:
+				break
+
+			batch, fut = pending.popleft()
+			with STATS.phase('archive.wait'):
+				members = fut.result()
+
+			# Small members are joined into one chunk to keep per-member overhead down
+			parts = []
+			for (fullpath, relpath), (ti, data, st) in zip(batch, members):
+				# Another name of a file already archived is stored as a hard link to it
+				if ti.type == tarfile.REGTYPE and st.st_nlink > 1:
+					key = (st.st_dev, st.st_ino)
+					if key in self._links:
+						STATS.incr('archive.hardlinks')
+						ti.type = tarfile.LNKTYPE
+						ti.linkname = self._links[key]
+						ti.size = 0
+						ti.sparse = data = None
+					else:
+						self._links[key] = relpath
+
+				if ti.sparse is not None:
+					STATS.incr('archive.sparse')
+					parts.append(sparse_header(ti, ti.sparse))
+				else:
+					parts.append(ti.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+
+				if data is not None:
+					STATS.incr('archive.readahead')
+					parts.append(data)
+				elif ti.type in (tarfile.REGTYPE, tarfile.GNUTYPE_SPARSE):
+					STATS.incr('archive.streamed')
+					yield b''.join(parts)
+					parts = []
+					if ti.sparse is not None:
+						for off, n in ti.sparse:
+							yield from self._stream_file(fullpath, n, off)
+					else:
+						yield from self._stream_file(fullpath, ti.size)
+
+				if ti.size % BLOCK:
+					parts.append(tarfile.NUL * (BLOCK - ti.size % BLOCK))
+
+			yield b''.join(parts)
+
+		# End of archive is two zero blocks, padded out to a full record like tar(1)
+		end = 2 * BLOCK
+		end += (RECORD_SIZE - (self.bytes + end) % RECORD_SIZE) % RECORD_SIZE
+		yield tarfile.NUL * end
+
+	def _stream_file(self, fullpath, size, offset=0):
+		"""Yield exactly @size bytes of @fullpath from @offset, zero padded like tar(1) if it shrank"""
+		left = size
+		with open(fullpath, 'rb') as f:
+			if offset:
+				f.seek(offset)
+			while left > 0:
+				with STATS.phase('archive.read'):
+					chunk = f.read(min(left, CHUNK_SIZE))
+				if not chunk:
+					print("Warning: %s shrank by %d bytes, padding with zeros" % (fullpath, left))
+					while left > 0:
+						yield tarfile.NUL * min(left, CHUNK_SIZE)
+						left -= min(left, CHUNK_SIZE)
+					break
+				left -= len(chunk)
+				yield chunk
+
+	def read(self, n=-1):
+		while not self._buf:
+			try:
+				self._buf = next(self._gen)
+			except StopIteration:
+				return b''
+			self.bytes += len(self._buf)
+
+		if n is None or n < 0:
+			n = len(self._buf)
+		ret, self._buf = self._buf[:n], self._buf[n:]
+		return ret
+
+	def close(self):
+		self._gen.close()
+		self._pool.shutdown(cancel_futures=True)
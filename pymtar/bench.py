@@ -0,0 +1,376 @@
+"""
+Reproducible benchmarks for queue, search, write, and extract.
+
+	python3 -m pymtar.bench --out results.json
+	python3 -m pymtar.bench --rows 1000000 search
+	python3 -m pymtar.bench --compare old.json --out new.json
+	python3 -m pymtar.bench --check
+
+Synthetic file trees and catalogs are generated from a fixed random seed into a scratch
+directory and writes go to a file-backed tape stand-in (see pymtar.filetape), so no drive is needed.
+Results are machine-readable JSON so runs from different versions can be compared.
+--check only checks that importing pymtar leaves the lazily imported modules unloaded, and exits
+with 1 if not, for CI or a pre-commit hook.
+"""
+
+# Global libraries
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# This library
+import pymtar
+from pymtar.__main__ import get_parser, parse_args
+from pymtar import stream
+from pymtar.stats import STATS
+
+
+# Synthetic file trees: name -> list of (count, minimum size, maximum size)
+TREES = {
+	'small': [(2000, 1024, 64*1024)],
+	'huge': [(3, 64*1024*1024, 64*1024*1024)],
+	'mixed': [(500, 1024, 64*1024), (20, 1024*1024, 4*1024*1024), (2, 16*1024*1024, 16*1024*1024)],
+}
+
+SUITES = ('importtime', 'queue', 'search', 'write', 'extract')
+
+# Startup budget for `python -m pymtar`: cumulative microseconds to import pymtar.__main__,
+# and modules that must not be imported until an action needs them
+IMPORT_BUDGET_US = 100000
+IMPORT_FORBIDDEN = ('pymtar.catalog', 'sqlitehelper', 'sqlite3', 'pushover', 'subprocess', 'tempfile', 'json', 'socket')
+
+# Patterns searched in the synthetic catalog: exact name, common extension, no match
+SEARCH_PATTERNS = ('file00000125.jpg', '*.jpg', 'nomatch*')
+EXTENSIONS = ('jpg', 'txt', 'dat', 'mkv', 'pdf')
+
+
+def _args(db, *action, dev=None):
+	"""Build parsed command line arguments as if invoked from the shell"""
+	argv = ['-d', db, '--pause', '0']
+	if dev is not None:
+		argv += ['-f', dev]
+	return parse_args(get_parser(), argv + list(action))
+
+def _run(*action, db, dev=None):
+	"""Run an action quietly, returning wall clock seconds"""
+	args = _args(db, *action, dev=dev)
+	with contextlib.redirect_stdout(io.StringIO()):
+		t0 = time.monotonic()
+		pymtar.actions.action(args)
+		return time.monotonic() - t0
+
+def make_tree(path, spec, rnd, scale):
+	"""Make files under @path per @spec, returning (list of paths, total bytes)"""
+	os.makedirs(path, exist_ok=True)
+
+	files = []
+	total = 0
+	for count, lo, hi in spec:
+		for x in range(max(1, int(count * scale))):
+			# Spread over sub-directories like a real tree
+			d = os.path.join(path, 'd%03d' % (len(files) // 1000))
+			os.makedirs(d, exist_ok=True)
+
+			fname = os.path.join(d, 'f%07d' % len(files))
+			sz = rnd.randint(lo, hi)
+			with open(fname, 'wb') as f:
+				f.write(rnd.randbytes(sz))
+
+			files.append(fname)
+			total += sz
+
+	return files, total
+
+def make_catalog(fname, rows, rnd):
+	"""Make a catalog at @fname with @rows tarfile rows spread over tapes of 1M rows and tars of 1000 rows"""
+	d = pymtar.db(fname)
+	d.open()
+
+	per_tar = 1000
+	per_tape = 1000000
+	batch = 100000
+
+	d.begin()
+	for x in range(rows // per_tape + 1):
+		d.tape.insert(manufacturer='ACME', model='Q123', gen='LTO8RW', sn='SN%06d' % x, barcode='BC%04dL8' % x, ptime=datetime.date(2020,1,1))
+	for x in range(rows // per_tar + 1):
+		d.tar.insert(id_tape=x*per_tar // per_tape + 1, num=x+1, stime=None, etime=None, access_cnt=0, options=None, uname=None)
+	d.commit()
+
+	for start in range(0, rows, batch):
+		vals = []
+		for x in range(start, min(rows, start+batch)):
+			fname = 'file%08d.%s' % (x, EXTENSIONS[x % len(EXTENSIONS)])
+			relpath = 'd%05d/%s' % (x // per_tar, fname)
+			vals.append( (x // per_tape + 1, x // per_tar + 1, '/data/' + relpath, relpath, fname, rnd.randint(0, 1 << 30), '%064x' % rnd.getrandbits(256)) )
+
+		d.begin()
+		d._executemany("insert into `tarfile` (`id_tape`,`id_tar`,`fullpath`,`relpath`,`fname`,`sz`,`sha256`) values (?,?,?,?,?,?,?)", vals)
+		d.commit()
+
+	return d
+
+
+def check_imports():
+	"""
+	Modules of IMPORT_FORBIDDEN loaded by importing pymtar and pymtar.__main__ in a fresh
+	interpreter, which should be none. Unlike the import time this doesn't vary between machines.
+	"""
+	r = subprocess.run([sys.executable, '-c', "import sys, pymtar, pymtar.__main__; print('\\n'.join(sys.modules))"], stdout=subprocess.PIPE, check=True)
+	loaded = r.stdout.decode('utf-8').split()
+	return sorted(_ for _ in loaded if _ in IMPORT_FORBIDDEN or _.split('.')[0] in IMPORT_FORBIDDEN)
+
+def bench_importtime(work, opts, rnd):
+	"""
+	Measure startup with -X importtime and check it against IMPORT_BUDGET_US and IMPORT_FORBIDDEN.
+	The best of @opts.repeat runs is used to reduce noise.
+	"""
+	best = None
+	for x in range(max(1, opts.repeat)):
+		r = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pymtar.__main__'], stderr=subprocess.PIPE, check=True)
+
+		# Lines are "import time: self | cumulative | module" with nesting shown by indenting the name
+		total = None
+		for line in r.stderr.decode('utf-8').split('\n'):
+			parts = line.split('|')
+			if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+
+			name = parts[2].strip()
+			if name == 'pymtar.__main__':
+				total = int(parts[1])
+
+		if total is not None and (best is None or total < best):
+			best = total
+
+	forbidden = check_imports()
+
+	# No timing line for pymtar.__main__ (eg, a Python whose -X importtime output differs)
+	if best is None:
+		return {
+			'microseconds': None,
+			'seconds': None,
+			'budget_microseconds': IMPORT_BUDGET_US,
+			'forbidden_imported': forbidden,
+			'ok': False,
+			'error': "No import time reported for pymtar.__main__",
+		}
+
+	return {
+		'microseconds': best,
+		'seconds': best / 1e6,
+		'budget_microseconds': IMPORT_BUDGET_US,
+		'forbidden_imported': forbidden,
+		'ok': best <= IMPORT_BUDGET_US and not forbidden,
+	}
+
+def bench_queue(work, opts, rnd):
+	ret = {}
+	for name, spec in TREES.items():
+		files, total = make_tree(os.path.join(work, 'tree', name), spec, rnd, opts.scale)
+
+		db = os.path.join(work, 'queue-%s.db' % name)
+		_run('new', 'tape', 'manufacturer=ACME', 'model=Q123', 'gen=LTO8RW', 'sn=1', 'ptime=2020-01-01', db=db)
+		_run('new', 'tar', 'tape=1', 'num=1', 'stime=now', 'etime=now', db=db)
+
+		STATS.reset()
+		secs = _run('queue', 'tape=1', 'tar=1', 'basedir=' + os.path.join(work, 'tree', name), *files, db=db)
+
+		ret[name] = {
+			'files': len(files),
+			'bytes': total,
+			'seconds': secs,
+			'files_per_sec': len(files) / secs,
+			'mb_per_sec': total / secs / 1e6,
+			'phases': STATS.snapshot()['timers'],
+		}
+	return ret
+
+def bench_search(work, opts, rnd):
+	fname = os.path.join(work, 'catalog-%d.db' % opts.rows)
+
+	t0 = time.monotonic()
+	if os.path.exists(fname):
+		d = pymtar.db(fname)
+		d.open()
+	else:
+		d = make_catalog(fname, opts.rows, rnd)
+	build = time.monotonic() - t0
+
+	ret = {'rows': opts.rows, 'build_seconds': build, 'patterns': {}}
+	for pattern in SEARCH_PATTERNS:
+		times = []
+		for x in range(opts.repeat):
+			t0 = time.monotonic()
+			cnt = sum(1 for _ in d.find_tarfiles_by_name(pattern))
+			times.append(time.monotonic() - t0)
+
+		ret['patterns'][pattern] = {'matches': cnt, 'seconds': statistics.median(times), 'min_seconds': min(times)}
+	return ret
+
+def bench_write(work, opts, rnd):
+	ret = {}
+	for name in TREES:
+		db = os.path.join(work, 'queue-%s.db' % name)
+		if not os.path.exists(db):
+			raise Exception("Write benchmark needs the queue benchmark to run first")
+
+		# Fresh tape with a stand-in for file 0 (the metadata copy)
+		dev = os.path.join(work, 'tape-%s' % name)
+		shutil.rmtree(dev, ignore_errors=True)
+		os.makedirs(dev)
+		with open(os.path.join(dev, 'file00000'), 'wb') as f:
+			f.write(b'\0' * stream.RECORD_SIZE)
+
+		# Same tar made by tar(1) and by pymtar with read-ahead, the latter rewriting file 1
+		for variant, extra in (('', []), ('-readahead', ['readahead=16'])):
+			STATS.reset()
+			secs = _run('write', 'tape=1', 'tar=1', *extra, db=db, dev=dev)
+
+			d = pymtar.db(db)
+			d.open()
+			stat = d.find_tarstats()[-1]
+
+			ret[name + variant] = {
+				'bytes': stat['bytes'],
+				'seconds': secs,
+				'stream_seconds': stat['seconds'],
+				'mb_per_sec': stat['mbps'],
+				'underruns': stat['underruns'],
+				'phases': STATS.snapshot()['timers'],
+			}
+	return ret
+
+def bench_extract(work, opts, rnd):
+	ret = {}
+	for name in TREES:
+		dev = os.path.join(work, 'tape-%s' % name)
+		if not os.path.exists(dev):
+			raise Exception("Extract benchmark needs the write benchmark to run first")
+
+		out = os.path.join(work, 'extract-%s' % name)
+		shutil.rmtree(out, ignore_errors=True)
+		os.makedirs(out)
+
+		m = pymtar.get_tape(dev)
+		m.asf(1)
+
+		t0 = time.monotonic()
+		with m.open_read() as f:
+			proc = subprocess.Popen(['tar', 'xf', '-', '-C', out], stdin=subprocess.PIPE)
+			total = 0
+			while True:
+				chunk = f.read(stream.CHUNK_SIZE)
+				if not chunk: break
+				proc.stdin.write(chunk)
+				total += len(chunk)
+			proc.stdin.close()
+			proc.wait()
+		secs = time.monotonic() - t0
+
+		ret[name] = {'bytes': total, 'seconds': secs, 'mb_per_sec': total / secs / 1e6}
+	return ret
+
+
+def _flatten(d, prefix=''):
+	"""Flatten nested results into {'a.b.c': number}"""
+	ret = {}
+	for k,v in d.items():
+		if isinstance(v, dict):
+			ret.update(_flatten(v, prefix + k + '.'))
+		elif isinstance(v, (int, float)):
+			ret[prefix + k] = v
+	return ret
+
+def compare(old, new):
+	"""Print metrics present in both results with the ratio of new to old"""
+	a = _flatten(old['results'])
+	b = _flatten(new['results'])
+
+	print("%-60s %14s %14s %8s" % ('METRIC', 'OLD', 'NEW', 'NEW/OLD'))
+	for k in sorted(set(a) & set(b)):
+		if not (k.endswith('seconds') or k.endswith('per_sec')): continue
+		ratio = b[k] / a[k] if a[k] else float('nan')
+		print("%-60s %14.4f %14.4f %8.3f" % (k, a[k], b[k], ratio))
+
+
+def main():
+	p = argparse.ArgumentParser(description="pymtar benchmarks")
+	p.add_argument('--out', default=None, help="Write JSON results to this file (default is stdout)")
+	p.add_argument('--compare', default=None, help="Previous JSON results to compare against")
+	p.add_argument('--workdir', default=None, help="Scratch directory, kept afterward so catalogs can be reused (default is a temporary directory)")
+	p.add_argument('--seed', type=int, default=1, help="Random seed for synthetic data")
+	p.add_argument('--scale', type=float, default=1.0, help="Multiplier on the number of files in each synthetic tree")
+	p.add_argument('--rows', type=int, default=100000, help="Rows in the synthetic catalog for search (eg, 1000000 or 10000000)")
+	p.add_argument('--repeat', type=int, default=3, help="Repetitions of each search, median is reported")
+	p.add_argument('suites', nargs='*', default=list(SUITES), help="Suites to run (%s), default is all" % ', '.join(SUITES))
+	p.add_argument('--check', default=False, action='store_true', help="Only check that importing pymtar loads none of IMPORT_FORBIDDEN, exit 1 if it does")
+	opts = p.parse_args()
+
+	if opts.check:
+		forbidden = check_imports()
+		if len(forbidden):
+			print("Imported by pymtar before an action needs them: %s" % ', '.join(forbidden), file=sys.stderr)
+			sys.exit(1)
+		return
+
+	for suite in opts.suites:
+		if suite not in SUITES:
+			p.error("Unrecognized suite '%s'" % suite)
+
+	if opts.workdir is None:
+		work = tempfile.mkdtemp(prefix='pymtar-bench-')
+	else:
+		work = os.path.abspath(opts.workdir)
+		os.makedirs(work, exist_ok=True)
+
+	funcs = {'importtime': bench_importtime, 'queue': bench_queue, 'search': bench_search, 'write': bench_write, 'extract': bench_extract}
+
+	out = {
+		'time': str(datetime.datetime.utcnow()),
+		'python': sys.version.split()[0],
+		'platform': platform.platform(),
+		'params': {'seed': opts.seed, 'scale': opts.scale, 'rows': opts.rows, 'repeat': opts.repeat},
+		'results': {},
+	}
+
+	try:
+		for suite in SUITES:
+			if suite not in opts.suites: continue
+
+			print("Running %s" % suite, file=sys.stderr)
+			rnd = random.Random(opts.seed)
+			out['results'][suite] = funcs[suite](work, opts, rnd)
+	finally:
+		if opts.workdir is None:
+			shutil.rmtree(work, ignore_errors=True)
+
+	if opts.out is None:
+		json.dump(out, sys.stdout, indent=2)
+		print()
+	else:
+		with open(opts.out, 'w') as f:
+			json.dump(out, f, indent=2)
+
+	if opts.compare is not None:
+		with open(opts.compare, 'r') as f:
+			compare(json.load(f), out)
+
+	# Fail so that the startup budget can be checked from CI or a script
+	if 'importtime' in out['results'] and not out['results']['importtime']['ok']:
+		res = out['results']['importtime']
+		print("%s: %s" % (res.get('error', "Import time budget exceeded"), res), file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
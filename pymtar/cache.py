@@ -0,0 +1,130 @@
+"""
+Local cache of restored files keyed by sha256.
+
+	--cache DIR              Keep a copy of every restored file under DIR
+	--cache-size MB          Evict least recently used files beyond this size
+
+Files are stored by content as DIR/<first two hex digits>/<sha256> so any catalog path with
+the same hash is served from one copy without mounting a tape.
+The modification time of each file is its last use, which orders eviction.
+"""
+
+# Global libraries
+import os
+import shutil
+
+# This library
+from .stats import STATS
+from .util import hashfile
+
+
+class RestoreCache:
+	"""
+	Size-bounded on-disk cache of file contents.
+		cache = RestoreCache('/var/cache/pymtar', 50*1024**3)
+		if not cache.get(sha256, dest):
+			... restore from tape ...
+			cache.put(sha256, dest)
+	"""
+
+	def __init__(self, path, max_bytes):
+		self.path = os.path.abspath(path)
+		self.max_bytes = max_bytes
+
+		os.makedirs(self.path, exist_ok=True)
+
+		# Current size and sha256 -> (size, last use), from a scan so that the cache survives between runs
+		self._entries = {}
+		for sub in os.scandir(self.path):
+			if not sub.is_dir(): continue
+			for ent in os.scandir(sub.path):
+				if ent.name.endswith('.tmp'):
+					# Left over from an interrupted put
+					os.unlink(ent.path)
+					continue
+				st = ent.stat()
+				self._entries[ent.name] = (st.st_size, st.st_mtime)
+		self.size = sum(_[0] for _ in self._entries.values())
+
+	def _path(self, sha256):
+		return os.path.join(self.path, sha256[:2], sha256)
+
+	def __contains__(self, sha256):
+		return sha256 in self._entries
+
+	def get(self, sha256, dest):
+		"""
+		Copy the cached file with hash @sha256 to @dest.
+		The copy is hashed and a mismatch drops the entry, so a damaged cache never serves bad data.
+		Returns True on a hit.
+		"""
+		if sha256 not in self._entries:
+			STATS.incr('cache.misses')
+			return False
+
+		src = self._path(sha256)
+		os.makedirs(os.path.dirname(dest), exist_ok=True)
+		with STATS.phase('cache.copy'):
+			shutil.copyfile(src, dest)
+
+		with STATS.phase('cache.hash'):
+			h = hashfile(dest)
+		if h != sha256:
+			print("Cache: dropping damaged entry %s" % sha256)
+			STATS.incr('cache.damaged')
+			STATS.incr('cache.misses')
+			os.unlink(dest)
+			self._remove(sha256)
+			return False
+
+		# Mark as recently used
+		os.utime(src)
+		self._entries[sha256] = (self._entries[sha256][0], os.stat(src).st_mtime)
+
+		STATS.incr('cache.hits')
+		STATS.incr('cache.hit_bytes', self._entries[sha256][0])
+		return True
+
+	def put(self, sha256, src):
+		"""Add file @src, already checked to have hash @sha256, then evict down to the size limit"""
+		if sha256 in self._entries:
+			return
+
+		sz = os.stat(src).st_size
+		if sz > self.max_bytes:
+			# Would just evict everything else and then itself
+			return
+
+		dst = self._path(sha256)
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+		# Copy to a temporary name so an interrupted copy is never taken as an entry
+		with STATS.phase('cache.copy'):
+			shutil.copyfile(src, dst + '.tmp')
+		os.replace(dst + '.tmp', dst)
+
+		self._entries[sha256] = (sz, os.stat(dst).st_mtime)
+		self.size += sz
+		STATS.incr('cache.puts')
+
+		self.evict()
+
+	def _remove(self, sha256):
+		sz, _ = self._entries.pop(sha256)
+		self.size -= sz
+		try:
+			os.unlink(self._path(sha256))
+		except FileNotFoundError:
+			pass
+
+	def evict(self):
+		"""Remove least recently used entries until the cache fits in max_bytes"""
+		if self.size <= self.max_bytes:
+			return
+
+		for sha256, (sz, used) in sorted(self._entries.items(), key=lambda _: _[1][1]):
+			if self.size <= self.max_bytes:
+				break
+			self._remove(sha256)
+			STATS.incr('cache.evictions')
+			STATS.incr('cache.evicted_bytes', sz)
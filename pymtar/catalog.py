@@ -0,0 +1,923 @@
+"""
+Catalog database of tapes, tars, and the files in them.
+
+Kept separate from the rest of pymtar so that sqlitehelper is only imported by actions that use the catalog.
+"""
+
+# Global libraries
+import datetime
+import fnmatch
+import os
+import sys
+
+# My installed libraries
+from sqlitehelper import SH, DBTable, DBCol, DBColROWID
+
+# This library
+from .util import ItemExists, ItemNotFound
+from . import profiling
+
+# Connection settings applied by db.open(), selected with --db-profile
+PROFILES = {
+	# Write-ahead log so queries run while queue or write commit, and commits only sync at checkpoints.
+	# The catalog must be checkpointed before copying it (see db.checkpoint()).
+	'wal': (
+		('journal_mode', 'WAL'),
+		('synchronous', 'NORMAL'),
+		('mmap_size', 256 * 1024 * 1024),
+		('cache_size', -64 * 1024), # KiB
+		('temp_store', 'MEMORY'),
+		('busy_timeout', 60000),
+	),
+	# Rollback journal, for catalogs on network filesystems where WAL's shared memory doesn't work
+	'legacy': (
+		('journal_mode', 'DELETE'),
+		('busy_timeout', 60000),
+	),
+}
+
+
+class db(SH):
+	"""DB schema"""
+
+	__schema__ = [
+		DBTable('tape',
+			DBColROWID(),
+			DBCol('manufacturer', 'text'), # Tape manufacturer
+			DBCol('model', 'text'), # Tape model number
+			DBCol('gen', 'text'), # Generation (eg, "LTO8RW")
+			DBCol('sn', 'text'), # Serial number on cartridge
+			DBCol('barcode', 'text'), # Standard LTO barcode, null if not used
+			DBCol('ptime', 'date'), # Purchase date and time
+			DBCol('file_cnt', 'integer'), # Number of files on the tape, kept by the tarfile triggers
+			DBCol('file_sz', 'integer'), # Total bytes of those files
+			DBCol('file_max', 'integer'), # Size of the largest of them
+			DBCol('qtime', 'datetime'), # Last time a file was added or changed (UTC), null if not since these were kept
+		),
+		# A tape "file" equivalent to a tar file
+		DBTable('tar',
+			DBColROWID(),
+			DBCol('id_tape', 'integer'), # Tape this tar belongs to
+			DBCol('num', 'integer'), # File number on the tape
+			DBCol('stime', 'datetime'), # Star write time
+			DBCol('etime', 'datetime'), # End write time
+			DBCol('access_cnt', 'integer'), # Read counter
+			DBCol('blk_offset', 'integer'), # Block offset on tape
+			DBCol('options', 'text'), # Options supplied to tar (eg, z, j)
+			DBCol('uname', 'text'), # uname -a value at time of write
+			DBCol('sz', 'integer'), # Bytes in the tape file as written, null if not recorded
+			DBCol('sha256', 'text'), # sha256 hash of the tape file as written
+			DBCol('merkle', 'text'), # Merkle root over the tarchunk hashes
+			DBCol('chunk_sz', 'integer'), # Bytes covered by each tarchunk hash
+			DBCol('file_cnt', 'integer'), # Number of files in the tar, kept by the tarfile triggers
+			DBCol('file_sz', 'integer'), # Total bytes of those files
+			DBCol('file_max', 'integer'), # Size of the largest of them
+			DBCol('qtime', 'datetime'), # Last time a file was added or changed (UTC), null if not since these were kept
+		),
+		# One row per file stored in a tar file
+		DBTable('tarfile',
+			DBColROWID(),
+			DBCol('id_tape', 'integer'), # Tape this file belongs to
+			DBCol('id_tar', 'integer'), # tar file this file belongs to
+			DBCol('fullpath', 'text'), # Full, absolute path
+			DBCol('relpath', 'text'), # Relative path as supplied to tar
+			DBCol('fname', 'text'), # File name
+			DBCol('sz', 'integer'), # Size of file in bytes
+			DBCol('sha256', 'text'), # sha256 hash
+			DBCol('mtime', 'real'), # Modification time when hashed, null if not recorded
+			DBCol('blk_offset', 'integer'), # 512 byte block of the member's header in the (uncompressed) tar, null if not recorded
+			DBCol('dev', 'integer'), # Device of the file when queued, with ino finds hard links, null if not recorded
+			DBCol('ino', 'integer'), # Inode of the file when queued
+			DBCol('nlink', 'integer'), # Number of hard links to the file when queued
+			DBCol('alloc', 'integer'), # Bytes in the allocated extents of a sparse file, sz otherwise
+			DBCol('extents', 'integer'), # Number of allocated extents of a sparse file, null if not sparse
+			DBCol('wsz', 'integer'), # Bytes of file data the tar stores for it (0 for a hard link to an earlier member), null if not written since kept
+		),
+		# One row per write of a tar to tape
+		DBTable('tarstat',
+			DBColROWID(),
+			DBCol('id_tar', 'integer'), # tar file written
+			DBCol('device', 'text'), # Device written to
+			DBCol('stime', 'datetime'), # Start of the write
+			DBCol('bytes', 'integer'), # Bytes written to tape
+			DBCol('seconds', 'real'), # Wall clock seconds of streaming data
+			DBCol('mbps', 'real'), # Average MB/s (10^6 bytes) over the write
+			DBCol('underruns', 'integer'), # Times the drive waited on the source
+			DBCol('idle_sec', 'real'), # Total seconds the drive waited on the source
+			DBCol('seek_sec', 'real'), # Seconds spent positioning the tape before writing
+		),
+		# One row per independently compressed block of a tar written with compression
+		DBTable('tarblock',
+			DBColROWID(),
+			DBCol('id_tar', 'integer'), # tar file the block belongs to
+			DBCol('idx', 'integer'), # Block number within the tar
+			DBCol('raw_offset', 'integer'), # Offset of the block in the uncompressed tar stream
+			DBCol('raw_size', 'integer'), # Uncompressed size of the block
+			DBCol('comp_offset', 'integer'), # Offset of the block's member in the compressed tape file
+			DBCol('comp_size', 'integer'), # Compressed size of the block
+			DBCol('stored', 'integer'), # 1 if judged incompressible and stored with the cheapest setting
+		),
+		# sha256 of each chunk of a tape file as written, see digest.py
+		DBTable('tarchunk',
+			DBColROWID(),
+			DBCol('id_tar', 'integer'), # tar file the chunk belongs to
+			DBCol('idx', 'integer'), # Chunk number, the chunk starts at byte idx*tar.chunk_sz
+			DBCol('sha256', 'text'), # sha256 hash of the chunk
+		),
+		# One row per piece of a tar continued across cartridges after the first filled up, none for a tar on one cartridge
+		DBTable('tarspan',
+			DBColROWID(),
+			DBCol('id_tar', 'integer'), # tar file the piece belongs to
+			DBCol('idx', 'integer'), # Piece number, 0 is on the tar's own tape at tar.num
+			DBCol('id_tape', 'integer'), # Tape holding the piece
+			DBCol('num', 'integer'), # File number of the piece on that tape
+			DBCol('offset', 'integer'), # Offset of the piece in the whole tar stream
+			DBCol('sz', 'integer'), # Bytes in the piece
+		),
+		# Manifest of other catalog databases (shards) searched along with this one, one row per tape in a shard
+		DBTable('shard',
+			DBColROWID(),
+			DBCol('path', 'text'), # Absolute path of the shard database
+			DBCol('id_tape', 'integer'), # Tape rowid within the shard
+			DBCol('sn', 'text'), # Serial number of the tape
+			DBCol('barcode', 'text'), # Barcode of the tape
+		),
+	]
+
+	# Trigger bodies keeping tar and tape file_cnt, file_sz, file_max, and qtime up to date as tarfile
+	# rows come and go, so totals are read from one row rather than summed over tarfile.
+	# The largest file only has to be looked for again when the largest is removed or shrinks.
+	_AGG_ADD = (
+		"update `tar` set `file_cnt`=coalesce(`file_cnt`,0)+1, `file_sz`=coalesce(`file_sz`,0)+coalesce(new.`sz`,0), "
+			"`file_max`=max(coalesce(`file_max`,0), coalesce(new.`sz`,0)), `qtime`=strftime('%Y-%m-%d %H:%M:%f','now') where `rowid`=new.`id_tar`; "
+		"update `tape` set `file_cnt`=coalesce(`file_cnt`,0)+1, `file_sz`=coalesce(`file_sz`,0)+coalesce(new.`sz`,0), "
+			"`file_max`=max(coalesce(`file_max`,0), coalesce(new.`sz`,0)), `qtime`=strftime('%Y-%m-%d %H:%M:%f','now') where `rowid`=new.`id_tape`;"
+	)
+	_AGG_SUB = (
+		"update `tar` set `file_cnt`=`file_cnt`-1, `file_sz`=`file_sz`-coalesce(old.`sz`,0), "
+			"`file_max`=case when coalesce(old.`sz`,0) < `file_max` then `file_max` else (select max(f.`sz`) from `tarfile` f where f.`id_tar`=old.`id_tar`) end "
+			"where `rowid`=old.`id_tar`; "
+		"update `tape` set `file_cnt`=`file_cnt`-1, `file_sz`=`file_sz`-coalesce(old.`sz`,0), "
+			"`file_max`=case when coalesce(old.`sz`,0) < `file_max` then `file_max` else (select max(t.`file_max`) from `tar` t where t.`id_tape`=old.`id_tape`) end "
+			"where `rowid`=old.`id_tape`;"
+	)
+
+	# Aggregates of files already cataloged, computed once when the triggers that keep them are added
+	_AGG_BACKFILL = [
+		"update `tar` set `file_cnt`=(select count(*) from `tarfile` f where f.`id_tar`=`tar`.`rowid`), `file_sz`=(select coalesce(sum(f.`sz`),0) from `tarfile` f where f.`id_tar`=`tar`.`rowid`), `file_max`=(select max(f.`sz`) from `tarfile` f where f.`id_tar`=`tar`.`rowid`)",
+		"update `tape` set `file_cnt`=(select coalesce(sum(t.`file_cnt`),0) from `tar` t where t.`id_tape`=`tape`.`rowid`), `file_sz`=(select coalesce(sum(t.`file_sz`),0) from `tar` t where t.`id_tape`=`tape`.`rowid`), `file_max`=(select max(t.`file_max`) from `tar` t where t.`id_tape`=`tape`.`rowid`)",
+	]
+
+	# Tables, columns, and indices added after the original schema.
+	# Each is (name of table or index, name of column or None, SQL to create it) and is applied
+	# when opening a database made before it existed. Tables are created with the same columns
+	# as their DBTable in __schema__, including the rowid column of DBColROWID.
+	__upgrades__ = [
+		('tarfile', 'mtime', "alter table `tarfile` add column `mtime` real"),
+		('tarfile_fullpath', None, "create index `tarfile_fullpath` on `tarfile` (`fullpath`)"),
+		('tarstat', None, "create table `tarstat` (`rowid` integer primary key, `id_tar` integer, `device` text, `stime` datetime, `bytes` integer, `seconds` real, `mbps` real, `underruns` integer, `idle_sec` real, `seek_sec` real)"),
+		('tarblock', None, "create table `tarblock` (`rowid` integer primary key, `id_tar` integer, `idx` integer, `raw_offset` integer, `raw_size` integer, `comp_offset` integer, `comp_size` integer, `stored` integer)"),
+		('tarblock_id_tar', None, "create index `tarblock_id_tar` on `tarblock` (`id_tar`, `raw_offset`)"),
+		('tar', 'sz', "alter table `tar` add column `sz` integer"),
+		('tar', 'sha256', "alter table `tar` add column `sha256` text"),
+		('tar', 'merkle', "alter table `tar` add column `merkle` text"),
+		('tar', 'chunk_sz', "alter table `tar` add column `chunk_sz` integer"),
+		('tarchunk', None, "create table `tarchunk` (`rowid` integer primary key, `id_tar` integer, `idx` integer, `sha256` text)"),
+		('tarchunk_id_tar', None, "create index `tarchunk_id_tar` on `tarchunk` (`id_tar`, `idx`)"),
+		('shard', None, "create table `shard` (`rowid` integer primary key, `path` text, `id_tape` integer, `sn` text, `barcode` text)"),
+		('tarfile', 'blk_offset', "alter table `tarfile` add column `blk_offset` integer"),
+		('tarfile_id_tar_fullpath', None, "create index `tarfile_id_tar_fullpath` on `tarfile` (`id_tar`, `fullpath`)"),
+		('tar', 'file_cnt', "alter table `tar` add column `file_cnt` integer"),
+		('tar', 'file_sz', "alter table `tar` add column `file_sz` integer"),
+		('tar', 'file_max', "alter table `tar` add column `file_max` integer"),
+		('tar', 'qtime', "alter table `tar` add column `qtime` datetime"),
+		('tape', 'file_cnt', "alter table `tape` add column `file_cnt` integer"),
+		('tape', 'file_sz', "alter table `tape` add column `file_sz` integer"),
+		('tape', 'file_max', "alter table `tape` add column `file_max` integer"),
+		('tape', 'qtime', "alter table `tape` add column `qtime` datetime"),
+		('tarfile', 'dev', "alter table `tarfile` add column `dev` integer"),
+		('tarfile', 'ino', "alter table `tarfile` add column `ino` integer"),
+		('tarfile', 'nlink', "alter table `tarfile` add column `nlink` integer"),
+		('tarfile', 'alloc', "alter table `tarfile` add column `alloc` integer"),
+		('tarfile', 'extents', "alter table `tarfile` add column `extents` integer"),
+		('tarfile', 'wsz', "alter table `tarfile` add column `wsz` integer"),
+		('tarfile_id_tar_ino', None, "create index `tarfile_id_tar_ino` on `tarfile` (`id_tar`, `ino`, `dev`)"),
+		('tarspan', None, "create table `tarspan` (`rowid` integer primary key, `id_tar` integer, `idx` integer, `id_tape` integer, `num` integer, `offset` integer, `sz` integer)"),
+		('tarspan_id_tar', None, "create index `tarspan_id_tar` on `tarspan` (`id_tar`, `idx`)"),
+		('tarspan_id_tape', None, "create index `tarspan_id_tape` on `tarspan` (`id_tape`, `num`)"),
+		('tarfile_agg_insert', None, "create trigger `tarfile_agg_insert` after insert on `tarfile` begin " + _AGG_ADD + " end"),
+		('tarfile_agg_delete', None, "create trigger `tarfile_agg_delete` after delete on `tarfile` begin " + _AGG_SUB + " end"),
+		('tarfile_agg_update', None, "create trigger `tarfile_agg_update` after update of `sz`, `id_tar`, `id_tape` on `tarfile` begin " + _AGG_SUB + " " + _AGG_ADD + " end"),
+	]
+
+	def open(self, rowfactory=None, profile='wal', readonly=False):
+		"""
+		Open the catalog with the connection settings of PROFILES[@profile].
+		A @readonly connection, for actions that only query, opens the file read-only and never
+		creates it or changes its journal mode, so it also works on read-only media (eg, the copy
+		in tape file 0). A catalog from an older version is upgraded first if the file is writable.
+		"""
+		ex = os.path.exists(self.Filename)
+
+		if readonly:
+			import sqlite3
+			import urllib.parse
+
+			if not ex:
+				raise Exception("Catalog not found: %s" % self.Filename)
+
+			self.db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(self.Filename), uri=True, isolation_level=None, check_same_thread=False)
+			self.db.row_factory = sqlite3.Row
+
+			if self._pending_upgrades():
+				# WAL and rollback journals are created next to the file
+				if os.access(self.Filename, os.W_OK) and os.access(os.path.dirname(os.path.abspath(self.Filename)), os.W_OK):
+					self.db.close()
+					self.open(rowfactory, profile)
+					self.db.close()
+					self.db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(self.Filename), uri=True, isolation_level=None, check_same_thread=False)
+					self.db.row_factory = sqlite3.Row
+				else:
+					print("Catalog %s is from an older version and not writable to upgrade it, some queries may fail" % self.Filename, file=sys.stderr)
+		else:
+			super().open()
+
+		# Time every SQL statement (set by --sql-timing or --profile)
+		if profiling.SQL_TIMING:
+			self.db = profiling.TimedConnection(self.db)
+
+		for name, val in PROFILES[profile]:
+			# Journal mode is a property of the file, left as it is by readers
+			if readonly and name == 'journal_mode': continue
+			self._execute("pragma %s=%s" % (name, val))
+
+		if readonly:
+			self._execute("pragma query_only=1")
+			return
+
+		if not ex:
+			self.MakeDatabaseSchema()
+
+		# Only writes if the catalog is from an older version
+		self._upgrade_schema()
+
+	def checkpoint(self):
+		"""
+		Copy everything in the write-ahead log into the catalog file and empty the log, so the file
+		alone is the whole catalog. Returns (busy, log pages, checkpointed pages) as SQLite reports,
+		busy is 1 if another connection's reads or writes kept it from finishing.
+		"""
+		return tuple(self._execute("pragma wal_checkpoint(TRUNCATE)").fetchone())
+
+	def backup(self, dest):
+		"""
+		Copy the catalog to @dest as a single file with no log, consistent even while others write.
+		"""
+		import sqlite3
+
+		conn = sqlite3.connect(dest)
+		try:
+			self.db.backup(conn)
+			conn.execute("pragma journal_mode=DELETE")
+		finally:
+			conn.close()
+
+	def _execute(self, sql, vals=None):
+		"""Run raw SQL for the few queries that sqlitehelper doesn't cover"""
+		return self.db.execute(sql, vals or [])
+
+	def _executemany(self, sql, vals):
+		return self.db.executemany(sql, vals)
+
+	def _has_table(self, name):
+		"""True if table @name exists, for reads of a catalog that couldn't be upgraded"""
+		return self._execute("select 1 from `sqlite_master` where `type`='table' and `name`=?", [name]).fetchone() is not None
+
+	def _upgrade_schema(self):
+		todo = self._pending_upgrades()
+		if len(todo):
+			self.begin()
+			for sql in todo:
+				self._execute(sql)
+			self.commit()
+
+	def _pending_upgrades(self):
+		"""SQL of the entries of __upgrades__ not yet applied, in order"""
+		names = [_[0] for _ in self._execute("select `name` from `sqlite_master`")]
+
+		todo = []
+		for name, col, sql in self.__upgrades__:
+			if col is None:
+				if name in names: continue
+			else:
+				cols = [_[1] for _ in self._execute("pragma table_info(`%s`)" % name)]
+				if col in cols: continue
+
+			# Existing rows get their aggregates before the triggers keep them up to date
+			if name == 'tarfile_agg_insert':
+				todo += self._AGG_BACKFILL
+			todo.append(sql)
+
+		return todo
+
+	def reopen(self):
+		super().reopen()
+
+	@staticmethod
+	def _now():
+		return datetime.datetime.utcnow()
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tapes
+
+	def find_tapes(self):
+		res = self.tape.select('*')
+		return [dict(_) for _ in res]
+
+	def find_tape_by_id(self, rowid):
+		res = self.tape.select('*', 'rowid=?', [rowid])
+		return [dict(_) for _ in res]
+
+	def find_tape_by_sn(self, sn):
+		res = self.tape.select('*', 'sn=?', [sn])
+		return [dict(_) for _ in res]
+
+	def find_tape_by_barcode(self, bcode):
+		res = self.tape.select('*', 'barcode=?', [bcode])
+		return [dict(_) for _ in res]
+
+	def find_tape_by_multi(self, val):
+		res = self.tape.select('*', 'rowid=? or sn=? or barcode=?', [val,val,val])
+		return [dict(_) for _ in res]
+
+	def new_tape(self, manufacturer, model, gen, sn, barcode, ptime):
+		rows = self.find_tape_by_sn(sn)
+		if len(rows):
+			raise ItemExists("Tape with serial number '%s' already exists, cannot add it again" % sn)
+
+		if barcode is not None:
+			rows = self.find_tape_by_barcode(barcode)
+			if len(rows):
+				raise ItemExists("Tape with barcode '%s' already exists, cannot add it again" % barcode)
+
+		# TODO: validate gen
+		# TODO: validate ptime
+
+		self.begin()
+		ret = self.tape.insert(manufacturer=manufacturer, model=model, gen=gen, sn=sn, barcode=barcode, ptime=ptime)
+		self.commit()
+		return ret
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tars
+
+	def find_tars(self):
+		res = self.tar.select('*')
+		return [dict(_) for _ in res]
+
+	def find_tars_by_tape_multi(self, val):
+		rows = self.find_tape_by_multi(val)
+		if not len(rows):
+			return None
+
+		res = self.tar.select('*', 'id_tape=?', [rows[0]['rowid']])
+		return [dict(_) for _ in res]
+
+	def find_tars_by_tape_num(self, tape, num):
+		rows = self.find_tape_by_multi(tape)
+		if not len(rows):
+			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
+
+		id_tape = rows[0]['rowid']
+
+		res = self.tar.select('*', 'id_tape=? and num=?', [id_tape, num])
+		rows = [dict(_) for _ in res]
+		if not len(rows):
+			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d)" % (num, tape, id_tape))
+
+		return rows[0]
+
+	def new_tar(self, tape, num, stime, etime, access_cnt, options, uname):
+		rows = self.find_tape_by_multi(tape)
+		if not len(rows):
+			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
+
+		id_tape = rows[0]['rowid']
+
+		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, num])
+		rows = res.fetchall()
+		if len(rows):
+			raise ItemExists("Tar file num %d with tape '%s' (rowid=%d) already exists, cannot add it again" % (num, tape, id_tape))
+
+		self.begin()
+		ret = self.tar.insert(id_tape=id_tape, num=num, stime=stime, etime=etime, access_cnt=access_cnt, options=options, uname=uname)
+		self.commit()
+		return ret
+
+	def get_tar(self, id_tar):
+		res = self.tar.select('*', '`rowid`=?', [id_tar])
+		if res is None:
+			return None
+		else:
+			return res.fetchone()
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tar write statistics
+
+	def find_tarstats(self):
+		if not self._has_table('tarstat'):
+			return []
+		res = self.tarstat.select('*')
+		return [dict(_) for _ in res]
+
+	def find_tarstats_by_tape_multi(self, val):
+		rows = self.find_tape_by_multi(val)
+		if not len(rows):
+			return None
+
+		if not self._has_table('tarstat'):
+			return []
+		res = self._execute("select s.`rowid`, s.* from `tarstat` s join `tar` t on s.`id_tar`=t.`rowid` where t.`id_tape`=? order by s.`rowid`", [rows[0]['rowid']])
+		return [dict(_) for _ in res]
+
+	def new_tarstat(self, id_tar, device, stime, bytes, seconds, underruns, idle_sec, seek_sec):
+		mbps = bytes / seconds / 1e6 if seconds > 0 else 0.0
+
+		self.begin()
+		ret = self.tarstat.insert(id_tar=id_tar, device=device, stime=stime, bytes=bytes, seconds=seconds, mbps=mbps, underruns=underruns, idle_sec=idle_sec, seek_sec=seek_sec)
+		self.commit()
+		return ret
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Shards
+
+	def find_shards(self):
+		if not self._has_table('shard'):
+			return []
+		res = self.shard.select('*', None, None, '`path` asc, `id_tape` asc')
+		return [dict(_) for _ in res]
+
+	def find_shard_paths(self):
+		if not self._has_table('shard'):
+			return []
+		return [_[0] for _ in self._execute("select distinct `path` from `shard` order by `path`")]
+
+	def find_shards_by_tape_multi(self, val):
+		"""Shard rows of tapes with serial number or barcode @val (rowids aren't unique across shards)"""
+		if not self._has_table('shard'):
+			return []
+		res = self.shard.select('*', 'sn=? or barcode=?', [val,val])
+		return [dict(_) for _ in res]
+
+	def new_shard(self, path):
+		"""Add (or refresh) catalog @path to the manifest with the tapes it currently holds"""
+		path = os.path.abspath(path)
+		if path == os.path.abspath(self.Filename):
+			raise ItemExists("Cannot add the catalog itself as a shard")
+		if not os.path.exists(path):
+			raise ItemNotFound("Shard catalog '%s' not found" % path)
+
+		sh = db(path)
+		sh.open()
+		tapes = sh.find_tapes()
+
+		self.begin()
+		self._execute("delete from `shard` where `path`=?", [path])
+		self._executemany(
+			"insert into `shard` (`path`,`id_tape`,`sn`,`barcode`) values (?,?,?,?)",
+			[(path, _['rowid'], _['sn'], _['barcode']) for _ in tapes]
+		)
+		self.commit()
+
+		return len(tapes)
+
+	def federated(self, sql, vals=None, order=('rowid',), paths=None):
+		"""
+		Run query @sql on this catalog and every shard, merging the results by the columns in @order.
+		Tables in @sql are written as {s}.`table` to be qualified with each database's schema name,
+		and every row gets a `shard` column with the path of the database it came from.
+		@paths limits the shards searched (eg, to those of one tape) and doesn't include this catalog.
+
+		Shards are ATTACHed to extra connections in groups within SQLite's attached database limit,
+		each group runs one UNION ALL query ordered by @order, and the groups are merged lazily.
+		"""
+		import heapq
+		import operator
+		import sqlite3
+		import urllib.parse
+
+		vals = list(vals or [])
+
+		def fnmatch_(pattern, val):
+			return val is not None and fnmatch.fnmatch(val, pattern)
+
+		def group_query(conn, dbs):
+			parts = []
+			params = []
+			for schema, path in dbs:
+				parts.append("select ? as `shard`, * from (%s)" % sql.format(s='`%s`' % schema))
+				params += [path] + vals
+			q = ' union all '.join(parts) + ' order by ' + ', '.join('`%s`' % _ for _ in order)
+
+			conn.row_factory = sqlite3.Row
+			for row in conn.execute(q, params):
+				yield dict(row)
+
+		if paths is None:
+			paths = [os.path.abspath(self.Filename)] + self.find_shard_paths()
+
+		# One connection per group of shards, each attached read-only
+		conns = []
+		groups = []
+		limit = None
+		for x in range(len(paths)):
+			if limit is None or x % limit == 0:
+				conn = sqlite3.connect(':memory:', uri=True)
+				conn.create_function('fnmatch', 2, fnmatch_)
+				conns.append(conn)
+				if limit is None:
+					try:
+						limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+					except AttributeError:
+						# Python before 3.11, SQLite default
+						limit = 10
+				dbs = []
+				groups.append( (conn, dbs) )
+
+			schema = 'shard%d' % len(dbs)
+			conn.execute("attach database ? as `%s`" % schema, ['file:%s?mode=ro' % urllib.parse.quote(paths[x])])
+			dbs.append( (schema, paths[x]) )
+
+		groups = [group_query(conn, dbs) for conn, dbs in groups]
+
+		try:
+			yield from heapq.merge(*groups, key=operator.itemgetter(*order))
+		finally:
+			for conn in conns:
+				conn.close()
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tape file digests
+
+	def find_tarchunks(self, id_tar):
+		"""Chunk hashes of tar @id_tar in order"""
+		res = self.tarchunk.select('sha256', 'id_tar=?', [id_tar], '`idx` asc')
+		return [_['sha256'] for _ in res]
+
+	def set_tar_digest(self, id_tar, dg):
+		"""Record finished digest.StreamDigest @dg of tar @id_tar, replacing any earlier one"""
+		self.begin()
+		self.tar.update({'rowid': id_tar}, {'sz': dg.bytes, 'sha256': dg.sha256, 'merkle': dg.root, 'chunk_sz': dg.chunk_size})
+		self._execute("delete from `tarchunk` where `id_tar`=?", [id_tar])
+		self._executemany("insert into `tarchunk` (`id_tar`,`idx`,`sha256`) values (?,?,?)", [(id_tar, x, h) for x,h in enumerate(dg.leaves)])
+		self.commit()
+
+	def clone_tape(self, id_tape, manufacturer, model, gen, sn, barcode, ptime, digests=None):
+		"""
+		Add a new tape that is a copy of tape @id_tape with all of its tar, tarfile, tarchunk, and
+		tarblock rows, in one transaction. File hashes are copied, not recomputed.
+		@digests is an optional dictionary of source tar rowid to finished digest.StreamDigest for
+		tars that had no digest recorded when written.
+		Returns the rowid of the new tape.
+		"""
+		if len(self.find_tape_by_sn(sn)):
+			raise ItemExists("Tape with serial number '%s' already exists, cannot add it again" % sn)
+		if barcode is not None and len(self.find_tape_by_barcode(barcode)):
+			raise ItemExists("Tape with barcode '%s' already exists, cannot add it again" % barcode)
+
+		tars = self.tar.select('rowid', 'id_tape=?', [id_tape]).fetchall()
+
+		self.begin()
+		new_tape = self.tape.insert(manufacturer=manufacturer, model=model, gen=gen, sn=sn, barcode=barcode, ptime=ptime)
+
+		for row in tars:
+			id_tar = row['rowid']
+			cur = self._execute(
+				"insert into `tar` (`id_tape`,`num`,`stime`,`etime`,`access_cnt`,`blk_offset`,`options`,`uname`,`sz`,`sha256`,`merkle`,`chunk_sz`) "
+				"select ?,`num`,`stime`,`etime`,0,`blk_offset`,`options`,`uname`,`sz`,`sha256`,`merkle`,`chunk_sz` from `tar` where `rowid`=?",
+				[new_tape, id_tar])
+			new_tar = cur.lastrowid
+
+			self._execute(
+				"insert into `tarfile` (`id_tape`,`id_tar`,`fullpath`,`relpath`,`fname`,`sz`,`sha256`,`mtime`,`blk_offset`,`dev`,`ino`,`nlink`,`alloc`,`extents`,`wsz`) "
+				"select ?,?,`fullpath`,`relpath`,`fname`,`sz`,`sha256`,`mtime`,`blk_offset`,`dev`,`ino`,`nlink`,`alloc`,`extents`,`wsz` from `tarfile` where `id_tar`=?",
+				[new_tape, new_tar, id_tar])
+			# The copy was queued when the original was, not now
+			self._execute("update `tar` set `qtime`=(select `qtime` from `tar` where `rowid`=?) where `rowid`=?", [id_tar, new_tar])
+			self._execute(
+				"insert into `tarblock` (`id_tar`,`idx`,`raw_offset`,`raw_size`,`comp_offset`,`comp_size`,`stored`) "
+				"select ?,`idx`,`raw_offset`,`raw_size`,`comp_offset`,`comp_size`,`stored` from `tarblock` where `id_tar`=?",
+				[new_tar, id_tar])
+
+			dg = (digests or {}).get(id_tar)
+			if dg is None:
+				self._execute("insert into `tarchunk` (`id_tar`,`idx`,`sha256`) select ?,`idx`,`sha256` from `tarchunk` where `id_tar`=?", [new_tar, id_tar])
+			else:
+				# Digest of the copy is also the digest of the source, record it for both
+				for t in (id_tar, new_tar):
+					self._execute("update `tar` set `sz`=?, `sha256`=?, `merkle`=?, `chunk_sz`=? where `rowid`=?", [dg.bytes, dg.sha256, dg.root, dg.chunk_size, t])
+					self._execute("delete from `tarchunk` where `id_tar`=?", [t])
+					self._executemany("insert into `tarchunk` (`id_tar`,`idx`,`sha256`) values (?,?,?)", [(t, x, h) for x,h in enumerate(dg.leaves)])
+
+		self._execute("update `tape` set `qtime`=(select `qtime` from `tape` where `rowid`=?) where `rowid`=?", [id_tape, new_tape])
+		self.commit()
+		return new_tape
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tars continued across cartridges
+
+	def find_tarspans(self, id_tar):
+		"""Pieces of tar @id_tar in order, empty if it is all in its own tape file"""
+		res = self.tarspan.select('*', 'id_tar=?', [id_tar], '`idx` asc')
+		return [dict(_) for _ in res]
+
+	def find_tarspans_by_tape(self, id_tape):
+		"""Pieces of any tar that are on tape @id_tape, by file number"""
+		res = self.tarspan.select('*', 'id_tape=?', [id_tape], '`num` asc')
+		return [dict(_) for _ in res]
+
+	def set_tarspans(self, id_tar, spans):
+		"""
+		Replace the pieces of tar @id_tar with @spans, a list of dictionaries of id_tape, num,
+		offset, and sz in order. A single piece is the tar's own tape file and isn't recorded.
+		"""
+		self.begin()
+		self._execute("delete from `tarspan` where `id_tar`=?", [id_tar])
+		if len(spans) > 1:
+			self._executemany(
+				"insert into `tarspan` (`id_tar`,`idx`,`id_tape`,`num`,`offset`,`sz`) values (?,?,?,?,?,?)",
+				[(id_tar, x, _['id_tape'], _['num'], _['offset'], _['sz']) for x,_ in enumerate(spans)]
+			)
+		self.commit()
+
+	def next_tape_file(self, id_tape, id_tar=None):
+		"""
+		File number after the last one used on tape @id_tape by a tar or a piece of one, not counting
+		pieces of tar @id_tar from an earlier write of it.
+		"""
+		res = self._execute(
+			"select max(`num`) as `num` from (select `num` from `tar` where `id_tape`=? and `stime` is not null "
+			"union all select `num` from `tarspan` where `id_tape`=? and `id_tar`<>coalesce(?,0))", [id_tape, id_tape, id_tar]).fetchone()
+		return 0 if res['num'] is None else res['num'] + 1
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Compressed blocks
+
+	def find_tarblocks(self, id_tar):
+		res = self.tarblock.select('*', 'id_tar=?', [id_tar], '`raw_offset` asc')
+		return [dict(_) for _ in res]
+
+	def find_compression_ratios(self):
+		"""Compressed size over uncompressed size of everything written so far, by tar.options"""
+		res = self._execute("select t.`options` as `options`, sum(b.`raw_size`) as `raw`, sum(b.`comp_size`) as `comp` from `tarblock` b join `tar` t on b.`id_tar`=t.`rowid` group by t.`options`")
+		return {_['options']: _['comp'] / _['raw'] for _ in res if _['raw']}
+
+	def set_tarblocks(self, id_tar, blocks):
+		"""
+		Replace the compressed block table of tar @id_tar with @blocks, a list of dictionaries
+		from compress.CompressedReader.blocks.
+		"""
+		self.begin()
+		self._execute("delete from `tarblock` where `id_tar`=?", [id_tar])
+		self._executemany(
+			"insert into `tarblock` (`id_tar`,`idx`,`raw_offset`,`raw_size`,`comp_offset`,`comp_size`,`stored`) values (?,?,?,?,?,?,?)",
+			[(id_tar, x, _['raw_offset'], _['raw_size'], _['comp_offset'], _['comp_size'], int(_['stored'])) for x,_ in enumerate(blocks)]
+		)
+		self.commit()
+
+	# -------------------------------------------------------------------------
+	# -------------------------------------------------------------------------
+	# Tar files
+
+	def find_tarfiles(self):
+		res = self.tar.select('*')
+		return [dict(_) for _ in res]
+
+	def find_tarfiles_by_tape(self, val):
+		rows = self.find_tape_by_multi(val)
+		if not len(rows):
+			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
+
+		id_tape = rows[0]['rowid']
+
+		res = self.tarfile.select('*', 'id_tape=?', [id_tape])
+		return [dict(_) for _ in res]
+
+	def find_tarfiles_by_tar(self, tape, tar):
+		rows = self.find_tape_by_multi(tape)
+		if not len(rows):
+			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
+
+		id_tape = rows[0]['rowid']
+
+		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, int(tar)])
+		rows = res.fetchall()
+		if not len(rows):
+			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d), cannot add tar file" % (tar, tape, id_tape))
+
+		id_tar = rows[0]['rowid']
+
+		res = self.tarfile.select('*', 'id_tape=? and id_tar=?', [id_tape, id_tar])
+		return [dict(_) for  _ in res]
+
+	def iter_tarfiles_by_tar(self, id_tar, page=10000):
+		"""
+		Files of tar @id_tar in write order (by fullpath) as dictionaries.
+		Read @page rows at a time, each page picking up after the last, so memory doesn't grow with
+		the size of the tar and no read is left open on the catalog between pages.
+		"""
+		last = ('', 0)
+		while True:
+			res = self._execute("select `rowid`, * from `tarfile` where `id_tar`=? and (`fullpath`, `rowid`) > (?, ?) order by `fullpath`, `rowid` limit ?", [id_tar, last[0], last[1], page])
+			rows = [dict(_) for _ in res]
+			if not len(rows):
+				return
+
+			yield from rows
+			last = (rows[-1]['fullpath'], rows[-1]['rowid'])
+
+	def find_tarfile_totals(self, id_tar):
+		"""Number of files in tar @id_tar, their total size, and the first in write order (None if empty)"""
+		row = self._execute("select coalesce(`file_cnt`, 0) as `cnt`, coalesce(`file_sz`, 0) as `sz` from `tar` where `rowid`=?", [id_tar]).fetchone()
+		first = self._execute("select `rowid`, * from `tarfile` where `id_tar`=? order by `fullpath`, `rowid` limit 1", [id_tar]).fetchone()
+		return {'cnt': row['cnt'], 'sz': row['sz'], 'first': dict(first) if first is not None else None}
+
+	def find_hardlink_target(self, fl):
+		"""
+		Row of the file that tarfile row @fl is stored as a hard link to in its tar, the first in write
+		order with the same dev and ino, or None if @fl is stored with its own data.
+		"""
+		if (fl.get('nlink') or 1) < 2 or fl.get('ino') is None:
+			return None
+
+		row = self._execute("select `rowid`, * from `tarfile` where `id_tar`=? and `ino`=? and `dev`=? order by `fullpath`, `rowid` limit 1", [fl['id_tar'], fl['ino'], fl['dev']]).fetchone()
+		if row is None or row['rowid'] == fl['rowid']:
+			return None
+		return dict(row)
+
+	def set_tarfile_offsets(self, offsets):
+		"""Record the block offset of each file in its tar, @offsets is a list of (tarfile rowid, blk_offset)"""
+		self.begin()
+		self._executemany("update `tarfile` set `blk_offset`=? where `rowid`=?", [(off, rowid) for rowid, off in offsets])
+		self.commit()
+
+	def set_tarfile_written(self, id_tar):
+		"""
+		Record in wsz the bytes of file data each file of tar @id_tar has in the tar written by
+		tar --sparse: none for a hard link to a file earlier in write order, the allocated extents of a
+		sparse file, and the whole file otherwise.
+		Returns a dictionary of the totals: cnt, sz, wsz, links, and sparse.
+		"""
+		self.begin()
+		self._execute(
+			"update `tarfile` set `wsz`=case "
+				"when coalesce(`nlink`,1) > 1 and exists (select 1 from `tarfile` f where f.`id_tar`=`tarfile`.`id_tar` and f.`ino`=`tarfile`.`ino` and f.`dev`=`tarfile`.`dev` "
+					"and (f.`fullpath` < `tarfile`.`fullpath` or (f.`fullpath`=`tarfile`.`fullpath` and f.`rowid` < `tarfile`.`rowid`))) then 0 "
+				"when `extents` is not null then `alloc` "
+				"else `sz` end "
+			"where `id_tar`=?", [id_tar])
+		self.commit()
+
+		row = self._execute(
+			"select count(*) as `cnt`, coalesce(sum(`sz`),0) as `sz`, coalesce(sum(`wsz`),0) as `wsz`, "
+			"coalesce(sum(`wsz`=0 and `sz`>0 and coalesce(`nlink`,1)>1),0) as `links`, coalesce(sum(`extents` is not null and not (`wsz`=0 and `sz`>0 and coalesce(`nlink`,1)>1)),0) as `sparse` from `tarfile` where `id_tar`=?", [id_tar]).fetchone()
+		return dict(row)
+
+	def new_tarfile(self, tape, tar, fullpath, relpath, fname, sz, sha256):
+		rows = self.find_tape_by_multi(tape)
+		if not len(rows):
+			raise ItemNotFound("Unable to find tape with rowid, serial number, or barcode '%s', cannot create tar" % tape)
+
+		id_tape = rows[0]['rowid']
+
+		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, int(tar)])
+		rows = res.fetchall()
+		if not len(rows):
+			raise ItemNotFound("Unable to find tar with num %d for tape '%s' (rowid=%d), cannot add tar file" % (tar, tape, id_tape))
+
+		id_tar = rows[0]['rowid']
+
+		self.begin()
+		ret = self.tarfile.insert(id_tape=id_tape, id_tar=id_tar, fullpath=fullpath, relpath=relpath, fname=fname, sz=sz, sha256=sha256)
+		self.commit()
+		return ret
+
+	def new_tarfiles(self, id_tape, id_tar, rows):
+		"""
+		Add many files to tar @id_tar in one transaction.
+		@rows is a list of dictionaries with fullpath, relpath, fname, sz, sha256, mtime, and optionally
+		dev, ino, nlink, alloc, and extents.
+		"""
+		vals = [(id_tape, id_tar, _['fullpath'], _['relpath'], _['fname'], _['sz'], _['sha256'], _['mtime'], _.get('dev'), _.get('ino'), _.get('nlink'), _.get('alloc'), _.get('extents')) for _ in rows]
+
+		self.begin()
+		self._executemany("insert into `tarfile` (`id_tape`,`id_tar`,`fullpath`,`relpath`,`fname`,`sz`,`sha256`,`mtime`,`dev`,`ino`,`nlink`,`alloc`,`extents`) values (?,?,?,?,?,?,?,?,?,?,?,?,?)", vals)
+		self.commit()
+
+	def import_tar(self, id_tape, num, stime, etime, options, uname, rows, dg):
+		"""
+		Add tar @num of tape @id_tape read back from an existing tape file, with its files and digest,
+		in one transaction.
+		@rows is a list of dictionaries with fullpath, relpath, fname, sz, sha256, mtime, blk_offset, dev,
+		ino, nlink, alloc, and extents.
+		@dg is the finished digest.StreamDigest of the tape file.
+		Returns the rowid of the new tar.
+		"""
+		res = self.tar.select('rowid', 'id_tape=? and num=?', [id_tape, num])
+		if len(res.fetchall()):
+			raise ItemExists("Tar file num %d with tape rowid=%d already exists, cannot import it again" % (num, id_tape))
+
+		self.begin()
+		id_tar = self.tar.insert(id_tape=id_tape, num=num, stime=stime, etime=etime, access_cnt=0, options=options, uname=uname,
+			sz=dg.bytes, sha256=dg.sha256, merkle=dg.root, chunk_sz=dg.chunk_size)
+
+		vals = [(id_tape, id_tar, _['fullpath'], _['relpath'], _['fname'], _['sz'], _['sha256'], _['mtime'], _['blk_offset'], _['dev'], _['ino'], _['nlink'], _['alloc'], _['extents']) for _ in rows]
+		self._executemany("insert into `tarfile` (`id_tape`,`id_tar`,`fullpath`,`relpath`,`fname`,`sz`,`sha256`,`mtime`,`blk_offset`,`dev`,`ino`,`nlink`,`alloc`,`extents`) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", vals)
+		self._executemany("insert into `tarchunk` (`id_tar`,`idx`,`sha256`) values (?,?,?)", [(id_tar, x, h) for x,h in enumerate(dg.leaves)])
+		self.commit()
+		return id_tar
+
+	def update_tarfile_hashes(self, rows):
+		"""
+		Update many files in one transaction, @rows is a list of dictionaries with rowid, sz, sha256,
+		mtime, and optionally dev, ino, nlink, alloc, and extents.
+		"""
+		vals = [(_['sha256'], _['sz'], _['mtime'], _.get('dev'), _.get('ino'), _.get('nlink'), _.get('alloc'), _.get('extents'), _['rowid']) for _ in rows]
+
+		self.begin()
+		self._executemany("update `tarfile` set `sha256`=?, `sz`=?, `mtime`=?, `dev`=?, `ino`=?, `nlink`=?, `alloc`=?, `extents`=? where `rowid`=?", vals)
+		self.commit()
+
+	def classify_paths(self, paths):
+		"""
+		Look up many paths at once to see if they are already in the catalog.
+		@paths is a list of (fullpath, sz, mtime) as currently found on disk.
+
+		The paths are loaded into a temporary table and resolved with a single join rather than
+		one query per file. Returns a dictionary of fullpath to a dictionary with:
+			state      'unknown' if not in the catalog, 'changed' if size (or mtime, if recorded) differs, otherwise 'known'
+			rowid      tarfile rowid, None if unknown
+			sha256     Catalogued hash, None if unknown
+		"""
+		self._execute("create temp table if not exists `_qpath` (`fullpath` text primary key, `sz` integer, `mtime` real)")
+		self._execute("delete from `_qpath`")
+		self._executemany("insert or ignore into `_qpath` (`fullpath`,`sz`,`mtime`) values (?,?,?)", paths)
+
+		res = self._execute("select q.`fullpath`, q.`sz`, q.`mtime`, t.`rowid` as `rowid`, t.`sha256` as `sha256`, t.`sz` as `old_sz`, t.`mtime` as `old_mtime` from `_qpath` q left join `tarfile` t on t.`fullpath`=q.`fullpath`")
+
+		ret = {}
+		for row in res:
+			# Same as a per-file lookup, the first match wins if a path is catalogued twice
+			if row['fullpath'] in ret: continue
+
+			if row['rowid'] is None:
+				state = 'unknown'
+			elif row['old_sz'] != row['sz']:
+				state = 'changed'
+			elif row['old_mtime'] is not None and row['old_mtime'] != row['mtime']:
+				state = 'changed'
+			else:
+				state = 'known'
+
+			ret[row['fullpath']] = {'state': state, 'rowid': row['rowid'], 'sha256': row['sha256']}
+
+		self._execute("delete from `_qpath`")
+		return ret
+
+	def find_tarfiles_by_fullpath(self, pattern):
+		res = self.tarfile.select('*', None, None, '`id_tape` asc, `id_tar` asc')
+		for row in res:
+			# Match pattern on the full path
+			if fnmatch.fnmatch(row['fullpath'], pattern):
+				row = dict(row)
+				tar_row = self.get_tar(row['id_tar'])
+				row['tar'] = dict(tar_row)
+				yield row
+
+	def incr_tar_access(self, id_tar):
+		"""Count a read of tar @id_tar"""
+		self.begin()
+		self._execute("update `tar` set `access_cnt`=coalesce(`access_cnt`,0)+1 where `rowid`=?", [id_tar])
+		self.commit()
+
+	def find_tarfiles_by_name(self, pattern):
+		res = self.tarfile.select('*', None, None, '`id_tape` asc, `id_tar` asc')
+		for row in res:
+			# Get the full path
+			path = row['fullpath']
+			# And get just the filename
+			parts = path.split('/')
+
+			# Match pattern on just the file name itself, not full path
+			if fnmatch.fnmatch(parts[-1], pattern):
+				row = dict(row)
+				tar_row = self.get_tar(row['id_tar'])
+				row['tar'] = dict(tar_row)
+				yield row
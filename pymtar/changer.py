@@ -0,0 +1,200 @@
+"""
+Tape changer (library) support.
+
+	--changer mtx:/dev/sg3      Library controlled with mtx(1), drives are the -f devices in order
+	--changer emu:/path/lib     Emulated library for testing, see EmulatedChanger
+
+Cartridges are found by barcode.
+Jobs are batched with plan() so that each cartridge is loaded once and the jobs on it run in
+tape order, as a load/unload cycle takes minutes on a real library.
+"""
+
+# Global libraries
+import os
+import re
+import threading
+import time
+
+# This library
+from .stats import STATS
+
+
+class Changer:
+	"""
+	Base class for a tape library.
+	Robot moves are serialized with a lock as a library has one picker.
+	"""
+
+	def __init__(self, devices):
+		# Drive number -> device file of that drive
+		self.devices = devices
+		self._lock = threading.Lock()
+
+	def device(self, drive):
+		"""Device file (or directory for a file-backed tape) for @drive"""
+		return self.devices[drive]
+
+	def load(self, barcode, drive=0):
+		"""Load cartridge @barcode into @drive, unloading whatever is in it first"""
+		with self._lock:
+			cur = self._loaded(drive)
+			if cur == barcode:
+				return
+
+			if cur is not None:
+				with STATS.phase('changer.unload'):
+					self._unload(drive)
+				STATS.incr('changer.unloads')
+
+			print("Changer: loading %s into drive %d" % (barcode, drive))
+			with STATS.phase('changer.load'):
+				self._load(barcode, drive)
+			STATS.incr('changer.loads')
+
+	def unload(self, drive=0):
+		"""Return the cartridge in @drive to its slot"""
+		with self._lock:
+			if self._loaded(drive) is not None:
+				with STATS.phase('changer.unload'):
+					self._unload(drive)
+				STATS.incr('changer.unloads')
+
+	def _loaded(self, drive):
+		raise NotImplementedError
+
+	def _load(self, barcode, drive):
+		raise NotImplementedError
+
+	def _unload(self, drive):
+		raise NotImplementedError
+
+	def loaded(self, drive=0):
+		"""Barcode of the cartridge in @drive, None if empty"""
+		with self._lock:
+			return self._loaded(drive)
+
+class MtxChanger(Changer):
+	"""Library controlled with mtx(1)"""
+
+	def __init__(self, dev, devices):
+		super().__init__(devices)
+		self._dev = dev
+
+	def _run(self, *args):
+		import subprocess
+
+		r = subprocess.run(('mtx', '-f', self._dev) + args, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+		return r.stdout.decode('ascii', 'replace')
+
+	def status(self):
+		"""
+		Parse `mtx status` into (drives, slots) where drives is {drive: barcode or None}
+		and slots is {slot: barcode or None}.
+		"""
+		drives = {}
+		slots = {}
+		for line in self._run('status').split('\n'):
+			m = re.match(r'\s*Data Transfer Element (\d+):(Full|Empty)(.*)', line)
+			if m:
+				tag = re.search(r'VolumeTag\s*=\s*(\S+)', m.group(3))
+				drives[int(m.group(1))] = tag.group(1) if tag else ('' if m.group(2) == 'Full' else None)
+				continue
+
+			m = re.match(r'\s*Storage Element (\d+)( IMPORT/EXPORT)?:(Full|Empty)(.*)', line)
+			if m:
+				tag = re.search(r'VolumeTag\s*=\s*(\S+)', m.group(4))
+				slots[int(m.group(1))] = tag.group(1) if tag else None
+
+		return drives, slots
+
+	def _loaded(self, drive):
+		drives, slots = self.status()
+		return drives.get(drive)
+
+	def _load(self, barcode, drive):
+		drives, slots = self.status()
+		for slot, tag in slots.items():
+			if tag == barcode:
+				self._run('load', str(slot), str(drive))
+				return
+
+		raise Exception("Cartridge with barcode '%s' not found in the library" % barcode)
+
+	def _unload(self, drive):
+		# Most drives must eject the cartridge before the robot can take it
+		from . import get_tape
+		get_tape(self.device(drive)).offline()
+
+		self._run('unload', '0', str(drive))
+
+class EmulatedChanger(Changer):
+	"""
+	Library emulated with directories for testing.
+	Each cartridge is a file-backed tape directory @path/<barcode>/ and drive N is the
+	symbolic link @path/driveN pointing at the loaded cartridge.
+	@delay seconds are slept on each load and unload to mimic a robot.
+	"""
+
+	def __init__(self, path, ndrives, delay=0.0):
+		self._path = os.path.abspath(path)
+		super().__init__([os.path.join(self._path, 'drive%d' % _) for _ in range(ndrives)])
+		self.delay = delay
+
+		if not os.path.isdir(self._path):
+			raise Exception("Emulated changer is not a directory: %s" % self._path)
+
+	def _loaded(self, drive):
+		link = self.device(drive)
+		if not os.path.islink(link):
+			return None
+		return os.path.basename(os.readlink(link))
+
+	def _load(self, barcode, drive):
+		slot = os.path.join(self._path, barcode)
+		if not os.path.isdir(slot):
+			raise Exception("Cartridge with barcode '%s' not found in the library" % barcode)
+
+		for x in range(len(self.devices)):
+			if self._loaded(x) == barcode:
+				raise Exception("Cartridge '%s' is already loaded in drive %d" % (barcode, x))
+
+		time.sleep(self.delay)
+		os.symlink(barcode, self.device(drive))
+
+		# Loading always leaves the head at the beginning of the tape
+		from . import filetape
+		filetape(self.device(drive)).rewind()
+
+	def _unload(self, drive):
+		time.sleep(self.delay)
+		os.unlink(self.device(drive))
+
+def get_changer(spec, devices):
+	"""Make a changer from a command line specification, see module docstring"""
+	if spec.startswith('mtx:'):
+		return MtxChanger(spec[4:], devices)
+	elif spec.startswith('emu:'):
+		return EmulatedChanger(spec[4:], len(devices))
+	else:
+		raise ValueError("Unrecognized changer '%s'" % spec)
+
+
+def plan(jobs, loaded=None, key='barcode'):
+	"""
+	Batch @jobs by cartridge to minimize load/unload cycles.
+	Each job is a dictionary with at least @key identifying the cartridge and 'num' (tape file number),
+	and optionally 'blk_offset'.
+	Returns a list of (cartridge, [jobs]) with each cartridge once and its jobs in tape order.
+	The cartridges in @loaded (eg, already in a drive) go first as they need no load.
+	"""
+	batches = {}
+	for job in jobs:
+		batches.setdefault(job[key], []).append(job)
+
+	for barcode in batches:
+		batches[barcode].sort(key=lambda _: (_['num'], _.get('blk_offset') or 0))
+
+	loaded = [_ for _ in (loaded or []) if _ in batches]
+	order = loaded + sorted(_ for _ in batches if _ not in loaded)
+
+	return [(barcode, batches[barcode]) for barcode in order]
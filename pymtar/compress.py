@@ -0,0 +1,279 @@
+"""
+Parallel block compression of tar streams.
+
+The archive from tar(1) is cut into BLOCK_SIZE blocks that are compressed independently on a
+process pool and written as concatenated members of the codec's format. Concatenated gzip, bzip2,
+and xz members are a valid single file to their command line tools (and so to `tar xzf`,
+`tar xjf`, and `tar xJf`), while each block can also be decompressed on its own starting from its
+compressed offset, which is recorded in the catalog.
+
+Blocks that sampling shows to be incompressible (already compressed media, encrypted data) are
+written with the cheapest setting of the codec rather than spending CPU on them.
+"""
+
+# Global libraries
+import collections
+
+# This library
+from .stats import STATS
+
+# Uncompressed bytes per independently compressed block
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Sample SAMPLE_COUNT slices of SAMPLE_SIZE bytes from each block to judge compressibility
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_COUNT = 4
+
+# Blocks whose sample doesn't compress below this ratio are stored
+STORE_RATIO = 0.97
+
+# Codec -> (module name, normal level, level for incompressible blocks)
+CODECS = {
+	'gzip': ('gzip', 6, 0),
+	'bzip2': ('bz2', 9, 1),
+	'xz': ('lzma', 6, 0),
+}
+
+# tar(1) options that select each codec
+OPTIONS = {
+	'-z': 'gzip', '--gzip': 'gzip', '--gunzip': 'gzip',
+	'-j': 'bzip2', '--bzip2': 'bzip2',
+	'-J': 'xz', '--xz': 'xz',
+}
+
+# Leading bytes of each codec's format, to recognize archives compressed elsewhere
+MAGIC = {
+	b'\x1f\x8b': 'gzip',
+	b'BZh': 'bzip2',
+	b'\xfd7zXZ\x00': 'xz',
+}
+
+
+def codec_for_options(options):
+	"""Codec selected by tar @options (eg, "-z"), None if no compression"""
+	for opt in (options or '').split():
+		if opt in OPTIONS:
+			return OPTIONS[opt]
+	return None
+
+def codec_for_magic(data):
+	"""Codec that @data (the start of a file) is compressed with, None if not recognized"""
+	for magic, codec in MAGIC.items():
+		if data.startswith(magic):
+			return codec
+	return None
+
+def options_for_codec(codec):
+	"""tar(1) option selecting @codec, inverse of codec_for_options()"""
+	for opt, c in OPTIONS.items():
+		if c == codec and len(opt) == 2:
+			return opt
+	raise ValueError("Unrecognized codec '%s'" % codec)
+
+def _compress(codec, data, level):
+	if codec == 'gzip':
+		import gzip
+		# Fixed mtime so identical data gives identical members
+		return gzip.compress(data, level, mtime=0)
+	elif codec == 'bzip2':
+		import bz2
+		return bz2.compress(data, level)
+	elif codec == 'xz':
+		import lzma
+		return lzma.compress(data, preset=level)
+	else:
+		raise ValueError("Unrecognized codec '%s'" % codec)
+
+def incompressible(data):
+	"""Guess from a few cheap samples whether @data is worth compressing"""
+	import zlib
+
+	if len(data) <= SAMPLE_SIZE * SAMPLE_COUNT:
+		samples = [data]
+	else:
+		step = (len(data) - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+		samples = [data[_*step:_*step + SAMPLE_SIZE] for _ in range(SAMPLE_COUNT)]
+
+	raw = sum(len(_) for _ in samples)
+	comp = sum(len(zlib.compress(_, 1)) for _ in samples)
+	return raw == 0 or comp >= raw * STORE_RATIO
+
+def compress_block(codec, data):
+	"""Compress one block, returns (compressed bytes, True if stored as incompressible)"""
+	mod, level, store_level = CODECS[codec]
+	if incompressible(data):
+		return _compress(codec, data, store_level), True
+	return _compress(codec, data, level), False
+
+
+class CompressedReader:
+	"""
+	File-like reader of the compressed form of @src, for stream.pump().
+	Blocks are compressed on a pool of @jobs processes with a bounded number in flight,
+	and come out in order.
+
+	After reading to the end, blocks is a list of dictionaries of
+		raw_offset, raw_size        Position of the block in the uncompressed tar
+		comp_offset, comp_size      Position of its member in the compressed output
+		stored                      True if judged incompressible
+	"""
+
+	def __init__(self, src, codec, *, jobs=None, block_size=BLOCK_SIZE):
+		import concurrent.futures
+		import os
+
+		if codec not in CODECS:
+			raise ValueError("Unrecognized codec '%s'" % codec)
+
+		self.src = src
+		self.codec = codec
+		self.block_size = block_size
+		self.jobs = jobs or os.cpu_count() or 1
+
+		self.blocks = []
+		self.raw_bytes = 0
+		self.comp_bytes = 0
+
+		self._pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+		self._pending = collections.deque()
+		self._buf = b''
+		self._eof = False
+
+	def _read_block(self):
+		"""Read a full block from src (short only at the end)"""
+		parts = []
+		n = 0
+		while n < self.block_size:
+			chunk = self.src.read(self.block_size - n)
+			if not chunk:
+				self._eof = True
+				break
+			parts.append(chunk)
+			n += len(chunk)
+		return b''.join(parts)
+
+	def _fill(self):
+		"""Keep twice as many blocks in flight as there are workers"""
+		while not self._eof and len(self._pending) < 2 * self.jobs:
+			data = self._read_block()
+			if not data:
+				break
+			self._pending.append( (len(data), self._pool.submit(compress_block, self.codec, data)) )
+
+	def read(self, n=-1):
+		while not self._buf:
+			self._fill()
+			if not self._pending:
+				return b''
+
+			raw_size, fut = self._pending.popleft()
+			with STATS.phase('compress.wait'):
+				comp, stored = fut.result()
+
+			self.blocks.append({
+				'raw_offset': self.raw_bytes, 'raw_size': raw_size,
+				'comp_offset': self.comp_bytes, 'comp_size': len(comp),
+				'stored': stored,
+			})
+			self.raw_bytes += raw_size
+			self.comp_bytes += len(comp)
+			STATS.incr('compress.blocks')
+			if stored:
+				STATS.incr('compress.stored_blocks')
+
+			self._buf = comp
+
+		if n is None or n < 0:
+			n = len(self._buf)
+		ret, self._buf = self._buf[:n], self._buf[n:]
+		return ret
+
+	def close(self):
+		self._pool.shutdown(cancel_futures=True)
+
+
+def _decompressor(codec):
+	if codec == 'gzip':
+		import zlib
+		return zlib.decompressobj(wbits=31)
+	elif codec == 'bzip2':
+		import bz2
+		return bz2.BZ2Decompressor()
+	elif codec == 'xz':
+		import lzma
+		return lzma.LZMADecompressor()
+	else:
+		raise ValueError("Unrecognized codec '%s'" % codec)
+
+class DecompressedReader:
+	"""
+	File-like reader of the uncompressed form of @src, a stream of concatenated members of @codec.
+	@src may start at any block's comp_offset to read from that block's raw_offset on.
+	"""
+
+	def __init__(self, src, codec, *, chunk_size=1024*1024):
+		self.src = src
+		self.codec = codec
+		self.chunk_size = chunk_size
+
+		self._d = _decompressor(codec)
+		self._in = b''
+
+	def _needs_input(self):
+		# zlib leaves unused input in unconsumed_tail (kept in _in), bz2 and lzma keep it internally
+		if self.codec == 'gzip':
+			return not self._in
+		return self._d.needs_input
+
+	def read(self, n=-1):
+		if n is None or n < 0:
+			n = self.chunk_size
+
+		while True:
+			if self._d.eof:
+				# Next member starts with what the last one didn't use
+				# (for zlib this is also still in unconsumed_tail)
+				self._in = self._d.unused_data + (b'' if self.codec == 'gzip' else self._in)
+				self._d = _decompressor(self.codec)
+
+			if not self._in and self._needs_input():
+				self._in = self.src.read(self.chunk_size)
+				if not self._in:
+					return b''
+
+			with STATS.phase('decompress'):
+				out = self._d.decompress(self._in, n)
+			self._in = self._d.unconsumed_tail if self.codec == 'gzip' else b''
+
+			if out:
+				return out
+
+def find_block(blocks, raw_offset):
+	"""Block of @blocks (sorted by raw_offset) holding uncompressed tar offset @raw_offset"""
+	import bisect
+
+	idx = bisect.bisect_right([_['raw_offset'] for _ in blocks], raw_offset) - 1
+	if idx < 0:
+		raise ValueError("Offset %d is before the first block" % raw_offset)
+	return blocks[idx]
+
+def _skip(src, n):
+	"""Read and drop @n bytes of @src"""
+	while n > 0:
+		chunk = src.read(min(n, 1024*1024))
+		if not chunk:
+			raise EOFError("%d bytes short of the offset" % n)
+		n -= len(chunk)
+
+def open_at(src, codec, blocks, raw_offset):
+	"""
+	Reader of the uncompressed form of @src (at the start of a tape file of @blocks, as recorded
+	in tarblock) from uncompressed offset @raw_offset on. The blocks before the one holding it
+	are read past without decompressing them.
+	"""
+	blk = find_block(blocks, raw_offset)
+	with STATS.phase('decompress.skip'):
+		_skip(src, blk['comp_offset'])
+	f = DecompressedReader(src, codec)
+	_skip(f, raw_offset - blk['raw_offset'])
+	return f
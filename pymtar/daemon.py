@@ -0,0 +1,205 @@
+"""
+Catalog daemon for low-latency queries.
+
+	python3 -m pymtar -d archive.db daemon
+
+keeps the catalog open and answers find, list, and plan over the Unix socket archive.db.sock
+(or --socket). While it runs, `python3 -m pymtar -d archive.db find ...` sends the action to
+it instead of opening the catalog itself, skipping the catalog import and a cold page cache.
+
+Protocol is one JSON object per line each way:
+	request     {"argv": ["find", "tarfile.name", "*.jpg"], "json": false}
+	response    {"ok": true, "output": "..."}
+	            {"ok": false, "error": "...", "help": true}
+"help" is true if the error is a usage error (PrintHelpException).
+A connection may send several requests, each answered in order.
+"""
+
+# Global libraries
+import contextlib
+import json
+import os
+import socket
+import sys
+import threading
+
+# This library
+from .stats import STATS
+
+# Actions that the daemon serves, anything else runs in the client
+ACTIONS = ('find', 'list', 'plan')
+
+
+def socket_path(args):
+	"""Socket of the daemon for the catalog in @args"""
+	if args.socket is not None:
+		return args.socket
+	return os.path.abspath(args.db) + '.sock'
+
+
+class _ThreadStdout:
+	"""
+	sys.stdout stand-in that sends each thread's output to its own buffer while a request is
+	handled, so actions can print as usual and several clients can be served at once.
+	"""
+
+	def __init__(self, default):
+		self._default = default
+		self._local = threading.local()
+
+	@contextlib.contextmanager
+	def capture(self, buf):
+		self._local.buf = buf
+		try:
+			yield
+		finally:
+			self._local.buf = None
+
+	def _target(self):
+		return getattr(self._local, 'buf', None) or self._default
+
+	def write(self, s):
+		return self._target().write(s)
+
+	def flush(self):
+		return self._target().flush()
+
+	def __getattr__(self, name):
+		return getattr(self._default, name)
+
+
+class Daemon:
+	"""
+	Serves catalog queries on a Unix socket, running requests on @workers threads.
+	Each connection has its own thread that only reads requests and writes responses, so idle
+	clients don't hold a worker. Each worker opens the catalog once and keeps it, so its page
+	cache and sqlite3's statement cache stay warm between requests.
+	"""
+
+	def __init__(self, args, path, workers=8):
+		self.args = args
+		self.path = path
+		self.workers = workers
+
+		self._local = threading.local()
+		self._stdout = None
+		self._pool = None
+
+	def _db(self, args):
+		"""Catalog of this worker thread, in place of actions._db_open()"""
+		d = getattr(self._local, 'db', None)
+		if d is None:
+			from .catalog import db
+			d = self._local.db = db(os.path.abspath(self.args.db))
+			# Only queries are served
+			d.open(profile=self.args.db_profile, readonly=True)
+		return d
+
+	def handle(self, req):
+		"""Run one request, returning the response dictionary"""
+		import io
+		from . import PrintHelpException, actions
+		from .__main__ import get_parser, parse_args
+
+		argv = req.get('argv')
+		if not isinstance(argv, list) or not len(argv) or argv[0] not in ACTIONS:
+			return {'ok': False, 'error': "Only %s are served by the daemon" % ', '.join(ACTIONS), 'help': True}
+
+		opts = ['-d', self.args.db]
+		if req.get('json'):
+			opts.append('-j')
+
+		buf = io.StringIO()
+		try:
+			args = parse_args(get_parser(), opts + [str(_) for _ in argv])
+			with self._stdout.capture(buf):
+				actions.action(args)
+		except PrintHelpException as e:
+			return {'ok': False, 'error': str(e), 'help': True, 'output': buf.getvalue()}
+		except Exception as e:
+			return {'ok': False, 'error': "%s: %s" % (type(e).__name__, e), 'help': False, 'output': buf.getvalue()}
+
+		STATS.incr('daemon.requests')
+		return {'ok': True, 'output': buf.getvalue()}
+
+	def _serve_conn(self, conn):
+		with conn, conn.makefile('rwb') as f:
+			for line in f:
+				try:
+					req = json.loads(line)
+				except ValueError as e:
+					resp = {'ok': False, 'error': "Bad request: %s" % e, 'help': False}
+				else:
+					with STATS.phase('daemon.request'):
+						resp = self._pool.submit(self.handle, req).result()
+
+				f.write(json.dumps(resp).encode('utf-8') + b'\n')
+				f.flush()
+
+	def serve(self):
+		import concurrent.futures
+		from . import actions
+
+		# Stale socket from a daemon that didn't exit cleanly
+		if os.path.exists(self.path):
+			try:
+				with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+					s.connect(self.path)
+				raise Exception("A daemon is already listening on %s" % self.path)
+			except ConnectionRefusedError:
+				os.unlink(self.path)
+
+		# Clean up the socket on kill as well as ctrl-c
+		import signal
+		signal.signal(signal.SIGTERM, lambda s, f: sys.exit(0))
+
+		self._stdout = _ThreadStdout(sys.stdout)
+		sys.stdout = self._stdout
+		actions._db_provider = self._db
+
+		srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# Only this user can query the catalog, from the moment the socket exists
+		umask = os.umask(0o177)
+		try:
+			srv.bind(self.path)
+		finally:
+			os.umask(umask)
+		srv.listen(64)
+
+		print("Serving %s on %s with %d workers" % (self.args.db, self.path, self.workers))
+		sys.stdout.flush()
+
+		try:
+			with concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='pymtar-daemon') as self._pool:
+				while True:
+					conn, _ = srv.accept()
+					STATS.incr('daemon.connections')
+					threading.Thread(target=self._serve_conn, args=(conn,), name='pymtar-daemon-conn', daemon=True).start()
+		finally:
+			self._pool = None
+			srv.close()
+			os.unlink(self.path)
+			actions._db_provider = None
+			sys.stdout = self._stdout._default
+
+
+def request(path, argv, json_out=False, timeout=None):
+	"""
+	Send one request to the daemon at @path.
+	Returns the response dictionary, or None if no daemon is listening.
+	"""
+	try:
+		s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		s.settimeout(timeout)
+		s.connect(path)
+	except (FileNotFoundError, ConnectionRefusedError):
+		return None
+
+	with s, s.makefile('rwb') as f:
+		f.write(json.dumps({'argv': argv, 'json': json_out}).encode('utf-8') + b'\n')
+		f.flush()
+		line = f.readline()
+
+	if not line:
+		return None
+	return json.loads(line)
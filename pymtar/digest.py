@@ -0,0 +1,159 @@
+"""
+Digests of whole tape files.
+
+As a tar is written, a SHA-256 of the entire byte stream and of each CHUNK_SIZE chunk of it is
+computed and kept in the catalog (tar.sha256, tar.merkle, and the tarchunk table).
+Checking a tape file is then one sequential read compared against one digest, and if it
+doesn't match the chunk hashes narrow the damage down to byte ranges.
+The Merkle root over the chunk hashes lets a copy of the catalog without the tarchunk rows
+still confirm a full set of chunk hashes read back from elsewhere.
+"""
+
+# Global libraries
+import hashlib
+
+# This library
+from .stats import STATS
+
+# Bytes of the tape file covered by each leaf of the Merkle tree
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def merkle_root(leaves):
+	"""
+	Root of the binary hash tree over @leaves (hex SHA-256 digests), each level hashing
+	concatenated pairs of the level below with an odd last node carried up unchanged.
+	"""
+	if not len(leaves):
+		return hashlib.sha256(b'').hexdigest()
+
+	level = [bytes.fromhex(_) for _ in leaves]
+	while len(level) > 1:
+		nxt = []
+		for i in range(0, len(level) - 1, 2):
+			nxt.append(hashlib.sha256(level[i] + level[i+1]).digest())
+		if len(level) % 2:
+			nxt.append(level[-1])
+		level = nxt
+
+	return level[0].hex()
+
+def damaged_ranges(expected, actual, chunk_size=CHUNK_SIZE):
+	"""
+	Compare chunk hashes @expected (from the catalog) with @actual (read back) and return a
+	list of (start byte, end byte) ranges of the tape file that differ, adjacent chunks merged.
+	Chunks missing from @actual (a short read) count as damaged.
+	"""
+	ranges = []
+	for i, h in enumerate(expected):
+		if i < len(actual) and actual[i] == h:
+			continue
+
+		start = i * chunk_size
+		if len(ranges) and ranges[-1][1] == start:
+			ranges[-1] = (ranges[-1][0], start + chunk_size)
+		else:
+			ranges.append( (start, start + chunk_size) )
+
+	# Extra data read back beyond what was written
+	if len(actual) > len(expected):
+		start = len(expected) * chunk_size
+		ranges.append( (start, len(actual) * chunk_size) )
+
+	return ranges
+
+
+class DigestMismatch(Exception):
+	"""A chunk read back doesn't match the hash recorded when it was written"""
+	pass
+
+class StreamDigest:
+	"""
+	SHA-256 of a whole stream and of each @chunk_size chunk of it, fed with update().
+		dg = StreamDigest()
+		dg.update(data)
+		dg.finish()
+		dg.sha256, dg.leaves, dg.root
+	If @expected chunk hashes are given, update() raises DigestMismatch as soon as a chunk differs.
+	"""
+
+	def __init__(self, chunk_size=CHUNK_SIZE, expected=None):
+		self.chunk_size = chunk_size
+		self.expected = expected
+
+		self.bytes = 0
+		self.leaves = []
+		self.sha256 = None
+		self.root = None
+
+		self._whole = hashlib.sha256()
+		self._chunk = hashlib.sha256()
+		self._chunk_left = chunk_size
+
+	def update(self, data):
+		with STATS.phase('digest'):
+			self._whole.update(data)
+			self.bytes += len(data)
+
+			mv = memoryview(data)
+			while len(mv):
+				n = min(len(mv), self._chunk_left)
+				self._chunk.update(mv[:n])
+				self._chunk_left -= n
+				mv = mv[n:]
+
+				if self._chunk_left == 0:
+					self._leaf()
+
+	def _leaf(self):
+		idx = len(self.leaves)
+		self.leaves.append(self._chunk.hexdigest())
+		self._chunk = hashlib.sha256()
+		self._chunk_left = self.chunk_size
+
+		if self.expected is not None and (idx >= len(self.expected) or self.expected[idx] != self.leaves[idx]):
+			raise DigestMismatch("Chunk %d (bytes %d to %d) doesn't match the hash recorded when written" % (idx, idx * self.chunk_size, (idx+1) * self.chunk_size))
+
+	def finish(self):
+		"""Complete the last partial chunk and compute the whole digest and Merkle root"""
+		if self._chunk_left != self.chunk_size:
+			self._leaf()
+
+		if self.expected is not None and len(self.leaves) != len(self.expected):
+			raise DigestMismatch("Read %d chunks but %d were written" % (len(self.leaves), len(self.expected)))
+
+		self.sha256 = self._whole.hexdigest()
+		self.root = merkle_root(self.leaves)
+		return self
+
+
+class DigestReader:
+	"""
+	File-like reader passing @src through while feeding everything read to StreamDigest @dg,
+	to digest a tape file as it is consumed by something else (eg, tarfile).
+	"""
+
+	def __init__(self, src, dg):
+		self.src = src
+		self.dg = dg
+		self._peeked = b''
+
+	def peek(self, n):
+		"""Up to @n bytes from the start of what read() will return next, without consuming them"""
+		while len(self._peeked) < n:
+			chunk = self.src.read(n - len(self._peeked))
+			if not chunk: break
+			self.dg.update(chunk)
+			self._peeked += chunk
+		return self._peeked[:n]
+
+	def read(self, n=-1):
+		if self._peeked:
+			if n is None or n < 0:
+				n = len(self._peeked)
+			ret, self._peeked = self._peeked[:n], self._peeked[n:]
+			return ret
+
+		chunk = self.src.read(n)
+		self.dg.update(chunk)
+		return chunk
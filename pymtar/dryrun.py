@@ -0,0 +1,151 @@
+"""
+Prediction of what a write will do without touching the drive.
+
+The archive tar(1) makes from a file list is fully determined by the list: each member is a
+512 byte header (plus a GNU long name header and its blocks if the name doesn't fit in 100
+bytes) followed by the data padded to 512 bytes, then two zero blocks of end of archive with
+the whole padded out to a record. A hard link to a file earlier in the tar is a header alone, and
+a sparse file is stored as its allocated extents after a map of them taking 4 entries in the
+header and 21 in each further block. So the size of a tar is known exactly from the catalog.
+
+Time is predicted from the rates recorded in tarstat for earlier writes, falling back to the
+native rate of the LTO generation when there is no history.
+"""
+
+# Global libraries
+import tarfile
+
+# This library
+from .stream import RECORD_SIZE
+
+BLOCK = tarfile.BLOCKSIZE
+
+# LTO generation -> (native capacity in bytes, native rate in bytes per second)
+LTO = {
+	1: (100e9, 20e6),
+	2: (200e9, 40e6),
+	3: (400e9, 80e6),
+	4: (800e9, 120e6),
+	5: (1.5e12, 140e6),
+	6: (2.5e12, 160e6),
+	7: (6e12, 300e6),
+	8: (12e12, 360e6),
+	9: (18e12, 400e6),
+	10: (30e12, 400e6),
+}
+
+
+def _blocks(n):
+	"""Bytes of @n padded out to whole 512 byte blocks"""
+	return (n + BLOCK - 1) // BLOCK * BLOCK
+
+def _long(name):
+	"""Bytes of the ././@LongLink member holding @name if it is too long for the header"""
+	n = len(name.encode(tarfile.ENCODING, 'surrogateescape'))
+	if n > tarfile.LENGTH_NAME:
+		return BLOCK + _blocks(n + 1)
+	return 0
+
+def member_size(relpath, sz, linkname=None, extents=None):
+	"""
+	Bytes a regular file with @sz bytes of data stored as @relpath takes in a GNU format tar,
+	a hard link to @linkname if given (@sz is 0), or a sparse file of @extents allocated extents.
+	"""
+	ret = BLOCK + _blocks(sz)
+
+	# Names too long for the header are stored NUL terminated in a preceding ././@LongLink member
+	ret += _long(relpath)
+	if linkname is not None:
+		ret += _long(linkname)
+
+	# Sparse map ends with an entry for the end of the file
+	if extents is not None:
+		ret += (max(0, extents + 1 - 4) + 20) // 21 * BLOCK
+
+	return ret
+
+def plan_members(files):
+	"""
+	(relpath, sz, linkname, extents) of each of @files (tarfile rows in write order) as tar --sparse
+	stores them, for member_size(): a file with the same dev and ino as one earlier is a hard link
+	to it and a sparse file holds only its allocated extents.
+	"""
+	first = {}
+	for fl in files:
+		if (fl.get('nlink') or 1) > 1 and fl.get('ino') is not None:
+			key = (fl['dev'], fl['ino'])
+			if key in first:
+				yield fl['relpath'], 0, first[key], None
+				continue
+			first[key] = fl['relpath']
+
+		if fl.get('extents') is not None:
+			yield fl['relpath'], fl['alloc'], None, fl['extents']
+		else:
+			yield fl['relpath'], fl['sz'], None, None
+
+def archive_size(members):
+	"""
+	Bytes of the tar of @members, a list of (relpath, sz) or of (relpath, sz, linkname, extents)
+	as from plan_members().
+	Returns a dictionary of:
+		members     Number of members
+		data        Bytes of file data
+		overhead    Bytes of headers, padding, end of archive, and record padding
+		bytes       Total size of the archive
+	"""
+	ret = {'members': 0, 'data': 0, 'overhead': 0, 'bytes': 0}
+	for member in members:
+		ret['members'] += 1
+		ret['data'] += member[1]
+		ret['bytes'] += member_size(*member)
+
+	ret['bytes'] += 2 * BLOCK
+	ret['bytes'] += (RECORD_SIZE - ret['bytes'] % RECORD_SIZE) % RECORD_SIZE
+	ret['overhead'] = ret['bytes'] - ret['data']
+	return ret
+
+def lto_generation(gen):
+	"""LTO generation number from tape.gen (eg, "LTO8RW" gives 8), None if not recognized"""
+	import re
+
+	m = re.match(r'^\s*LTO-?(\d+)', gen or '', re.I)
+	if m is None:
+		return None
+	return int(m.group(1))
+
+def capacity(gen):
+	"""Native capacity in bytes of a tape of generation @gen (tape.gen), None if unknown"""
+	n = lto_generation(gen)
+	return LTO[n][0] if n in LTO else None
+
+def native_rate(gen):
+	"""Native rate in bytes per second of a drive for tape generation @gen (tape.gen), None if unknown"""
+	n = lto_generation(gen)
+	return LTO[n][1] if n in LTO else None
+
+def rates(tarstats, device=None):
+	"""
+	Rates measured over earlier writes in @tarstats (rows of the tarstat table), only those to
+	@device if there are any. Returns None if there is no history, otherwise a dictionary of:
+		writes      Number of writes measured
+		effective   Bytes per second end to end, including waits on the source
+		drive       Bytes per second while the drive had data, the rate it can stream at
+		seek        Average seconds positioning the tape before a write
+	"""
+	rows = [_ for _ in tarstats if _['seconds']]
+	if device is not None and any(_['device'] == device for _ in rows):
+		rows = [_ for _ in rows if _['device'] == device]
+	if not len(rows):
+		return None
+
+	nbytes = sum(_['bytes'] for _ in rows)
+	seconds = sum(_['seconds'] for _ in rows)
+	busy = sum(max(_['seconds'] - (_['idle_sec'] or 0.0), 0.0) for _ in rows)
+
+	return {
+		'writes': len(rows),
+		'effective': nbytes / seconds,
+		'drive': nbytes / busy if busy > 0 else nbytes / seconds,
+		'seek': sum(_['seek_sec'] or 0.0 for _ in rows) / len(rows),
+	}
@@ -0,0 +1,198 @@
+"""
+Background notification dispatcher.
+
+Notifications are queued and sent from a daemon thread so that a slow or hung
+endpoint never stalls hashing or a tape write.
+Pending messages are bounded, coalesced by key, rate limited, and batched together
+into a single message when several are waiting.
+"""
+
+# Global libraries
+import collections
+import datetime
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+
+class Transport:
+	"""Base class for a notification sink"""
+
+	def send(self, title, msg):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+class PushoverTransport(Transport):
+	"""
+	Send through pushover.net.
+	The client is created once and reused for every message.
+	"""
+
+	def __init__(self):
+		# Imported here so that pushover (and its HTTP stack) is only loaded if notifications are used
+		import pushover
+		self._pushover = pushover
+		self._client = None
+
+	def send(self, title, msg):
+		if self._client is None:
+			self._client = self._pushover.Client()
+		self._client.send_message(msg, title=title)
+
+class FileTransport(Transport):
+	"""Append each message as a JSON line to a local file, mostly for testing"""
+
+	def __init__(self, path):
+		self._path = os.path.expanduser(path)
+
+	def send(self, title, msg):
+		line = json.dumps({'time': str(datetime.datetime.utcnow()), 'title': title, 'msg': msg})
+		with open(self._path, 'a') as f:
+			f.write(line + '\n')
+
+class SocketTransport(Transport):
+	"""Send each message as a JSON line to a Unix stream socket"""
+
+	def __init__(self, path, timeout):
+		self._path = os.path.expanduser(path)
+		self._timeout = timeout
+
+	def send(self, title, msg):
+		line = json.dumps({'title': title, 'msg': msg}) + '\n'
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.settimeout(self._timeout)
+			s.connect(self._path)
+			s.sendall(line.encode('utf-8'))
+
+def get_transport(spec, timeout=10.0):
+	"""
+	Make a transport from a command line specification:
+		pushover         pushover.net (requires the pushover library and ~/.pushoverrc)
+		file:PATH        Append JSON lines to PATH
+		socket:PATH      Send JSON lines to the Unix socket at PATH
+	"""
+	if spec is None or spec == 'pushover':
+		return PushoverTransport()
+	elif spec.startswith('file:'):
+		return FileTransport(spec[5:])
+	elif spec.startswith('socket:'):
+		return SocketTransport(spec[7:], timeout)
+	else:
+		raise ValueError("Unrecognized notification transport '%s'" % spec)
+
+
+class Dispatcher:
+	"""
+	Sends notifications from a background thread.
+
+	post() never blocks: messages go into a bounded pending set and the oldest is dropped if it is full.
+	A message posted with a @key replaces any pending message with the same key (eg, progress steps).
+	At most one send happens every @min_interval seconds and everything pending at that point is sent as one message.
+	A send taking longer than @timeout is abandoned and counted as failed.
+	"""
+
+	def __init__(self, transport, *, maxsize=100, min_interval=5.0, timeout=10.0, title="pymtar"):
+		self.transport = transport
+		self.maxsize = maxsize
+		self.min_interval = min_interval
+		self.timeout = timeout
+		self.title = title
+
+		self.sent = 0
+		self.failed = 0
+		self.dropped = 0
+
+		self._pending = collections.OrderedDict()
+		self._counter = itertools.count()
+		self._cond = threading.Condition()
+		self._closing = False
+		self._last_send = 0.0
+
+		self._thread = threading.Thread(target=self._run, name='pymtar-notify', daemon=True)
+		self._thread.start()
+
+	def post(self, msg, key=None):
+		"""Queue @msg to be sent, replacing a pending message with the same @key"""
+		with self._cond:
+			if self._closing:
+				return
+
+			if key is None:
+				key = next(self._counter)
+			elif key in self._pending:
+				# Keep position of the original but with the newest text
+				self._pending[key] = msg
+				return
+
+			if len(self._pending) >= self.maxsize:
+				self._pending.popitem(last=False)
+				self.dropped += 1
+
+			self._pending[key] = msg
+			self._cond.notify()
+
+	def close(self, timeout=None):
+		"""Flush pending messages, waiting up to @timeout seconds (default is the send timeout)"""
+		if timeout is None:
+			timeout = self.timeout
+
+		with self._cond:
+			self._closing = True
+			self._cond.notify()
+
+		self._thread.join(timeout)
+		self.transport.close()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._pending and not self._closing:
+					self._cond.wait()
+
+				if not self._pending and self._closing:
+					return
+
+				# Rate limit, but flush immediately on close
+				delay = self._last_send + self.min_interval - time.monotonic()
+				if delay > 0 and not self._closing:
+					self._cond.wait(delay)
+					continue
+
+				msgs = list(self._pending.values())
+				self._pending.clear()
+				dropped = self.dropped
+				self.dropped = 0
+
+			msg = '\n'.join(msgs)
+			if dropped:
+				msg += "\n(%d older notifications dropped)" % dropped
+
+			self._send(msg)
+			self._last_send = time.monotonic()
+
+	def _send(self, msg):
+		err = []
+		def target():
+			try:
+				self.transport.send(self.title, msg)
+			except Exception as e:
+				err.append(e)
+
+		# Run the send in its own thread so that a hung endpoint can be abandoned
+		t = threading.Thread(target=target, name='pymtar-notify-send', daemon=True)
+		t.start()
+		t.join(self.timeout)
+
+		if t.is_alive():
+			self.failed += 1
+			print("Failed to send message: timed out after %.1f seconds" % self.timeout)
+		elif err:
+			self.failed += 1
+			print("Failed to send message: %s" % err[0])
+		else:
+			self.sent += 1
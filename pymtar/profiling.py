@@ -0,0 +1,196 @@
+"""
+Profiling hooks for the command line actions.
+
+	--profile=OUT            Profile the action with cProfile, pstats data written to OUT
+	--profile-mode=sample    Sample stacks of all threads instead, collapsed stacks written to OUT (for flamegraph.pl)
+	--sql-timing             Time every SQL statement run through the db class
+
+SIGUSR1 dumps the stack of every thread and the current counters to stderr without
+interrupting the running action (eg, `kill -USR1 <pid>` during a long queue or write).
+"""
+
+# Global libraries
+import collections
+import signal
+import sys
+import threading
+import time
+
+# This library
+from .stats import STATS
+
+# Time every SQL statement run through the catalog, see TimedConnection
+SQL_TIMING = False
+
+def dump_state(out=None):
+	"""Write the stack of every thread and the current counters to @out (default stderr)"""
+	import traceback
+
+	if out is None:
+		out = sys.stderr
+
+	names = {t.ident: t.name for t in threading.enumerate()}
+
+	out.write("=" * 80 + "\n")
+	out.write("pymtar state at %s\n" % time.strftime('%Y-%m-%d %H:%M:%S'))
+	for ident, frame in sys._current_frames().items():
+		out.write("-" * 80 + "\n")
+		out.write("Thread %s (%d)\n" % (names.get(ident, '?'), ident))
+		out.write(''.join(traceback.format_stack(frame)))
+
+	out.write("-" * 80 + "\n")
+	for line in STATS.report():
+		out.write(line + "\n")
+	out.write("=" * 80 + "\n")
+	out.flush()
+
+def install_signal_handler(signum=None):
+	"""Dump state on @signum (default SIGUSR1) without interrupting the action"""
+	if signum is None:
+		signum = getattr(signal, 'SIGUSR1', None)
+	if signum is None:
+		# Not available on this platform
+		return
+
+	signal.signal(signum, lambda s, f: dump_state())
+
+
+class Sampler:
+	"""
+	Sampling profiler that periodically records the stack of every thread.
+	Unlike cProfile the overhead is fixed by @interval rather than by the number of calls, so it
+	is safe to leave running through a long tape write.
+	"""
+
+	def __init__(self, interval=0.01):
+		self.interval = interval
+		self.samples = collections.Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='pymtar-sampler', daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+	def _run(self):
+		me = threading.get_ident()
+		names = {}
+		while not self._stop.wait(self.interval):
+			for t in threading.enumerate():
+				names[t.ident] = t.name
+
+			for ident, frame in sys._current_frames().items():
+				if ident == me: continue
+
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+					frame = frame.f_back
+				stack.append(names.get(ident, 'thread'))
+				stack.reverse()
+
+				self.samples[';'.join(stack)] += 1
+
+	def write(self, path):
+		"""Write collapsed stacks, one "frame;frame;frame count" line per unique stack"""
+		with open(path, 'w') as f:
+			for stack, cnt in self.samples.most_common():
+				f.write("%s %d\n" % (stack, cnt))
+
+def run(args, func):
+	"""Run func(args) under the profiler selected by @args"""
+	if args.profile is None:
+		return func(args)
+
+	if args.profile_mode == 'sample':
+		s = Sampler(args.profile_interval)
+		s.start()
+		try:
+			return func(args)
+		finally:
+			s.stop()
+			s.write(args.profile)
+			print("Wrote %d stack samples to %s" % (sum(s.samples.values()), args.profile))
+
+	else:
+		import cProfile
+
+		p = cProfile.Profile()
+		try:
+			return p.runcall(func, args)
+		finally:
+			p.dump_stats(args.profile)
+			print("Wrote cProfile data to %s (view with: python3 -m pstats %s)" % (args.profile, args.profile))
+
+
+def _sql_key(sql):
+	"""Phase name for a statement with whitespace collapsed"""
+	import re
+
+	return 'sql: ' + re.sub(r'\s+', ' ', sql).strip()[:100]
+
+class TimedCursor:
+	"""Cursor proxy that accounts execute and fetch time to the statement"""
+
+	def __init__(self, cur, key='sql: (unknown)'):
+		self._cur = cur
+		self._key = key
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def execute(self, sql, *args):
+		self._key = _sql_key(sql)
+		with STATS.phase(self._key):
+			self._cur.execute(sql, *args)
+		return self
+
+	def executemany(self, sql, *args):
+		self._key = _sql_key(sql)
+		with STATS.phase(self._key):
+			self._cur.executemany(sql, *args)
+		return self
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		t0 = time.monotonic()
+		try:
+			return next(self._cur)
+		finally:
+			STATS.add_time(self._key, time.monotonic() - t0)
+
+	def fetchone(self):
+		with STATS.phase(self._key):
+			return self._cur.fetchone()
+
+	def fetchmany(self, *args):
+		with STATS.phase(self._key):
+			return self._cur.fetchmany(*args)
+
+	def fetchall(self):
+		with STATS.phase(self._key):
+			return self._cur.fetchall()
+
+class TimedConnection:
+	"""sqlite3 connection proxy that times every statement, see db.open()"""
+
+	def __init__(self, conn):
+		self._conn = conn
+
+	def __getattr__(self, name):
+		return getattr(self._conn, name)
+
+	def cursor(self, *args):
+		return TimedCursor(self._conn.cursor(*args))
+
+	def execute(self, sql, *args):
+		return TimedCursor(self._conn.cursor()).execute(sql, *args)
+
+	def executemany(self, sql, *args):
+		return TimedCursor(self._conn.cursor()).executemany(sql, *args)
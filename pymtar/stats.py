@@ -0,0 +1,183 @@
+"""
+Counters and phase timers for queueing and writing.
+
+A single process-wide collector, STATS, is used so that any part of the code can
+account time to a named phase (eg, "queue.hash", "mt.fsf", "write.stream").
+"""
+
+# Global libraries
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+class Stats:
+	"""
+	Thread-safe collection of named counters and phase timers.
+		with STATS.phase('queue.hash'):
+			h = hashfile(fl)
+		STATS.incr('queue.added')
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.counters = {}
+		# Phase name -> [number of times entered, total seconds]
+		self.timers = {}
+
+	def reset(self):
+		with self._lock:
+			self.counters.clear()
+			self.timers.clear()
+
+	def incr(self, name, n=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def add_time(self, name, seconds):
+		with self._lock:
+			t = self.timers.setdefault(name, [0, 0.0])
+			t[0] += 1
+			t[1] += seconds
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Account the time spent in the with block to phase @name"""
+		t0 = time.monotonic()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.monotonic() - t0)
+
+	def snapshot(self):
+		"""Get a copy of the current counters and timers"""
+		with self._lock:
+			return {
+				'counters': dict(self.counters),
+				'timers': {k: {'count': v[0], 'seconds': v[1]} for k,v in self.timers.items()},
+			}
+
+	def report(self):
+		"""Human readable summary as a list of lines"""
+		snap = self.snapshot()
+
+		# Size name column to the longest name (SQL statements can be long)
+		w = max([30] + [len(_) for _ in snap['timers']] + [len(_) for _ in snap['counters']])
+
+		lines = []
+		if snap['timers']:
+			lines.append("%-*s %10s %12s %10s" % (w, 'PHASE', 'COUNT', 'SECONDS', 'MS/EACH'))
+			for k,v in sorted(snap['timers'].items()):
+				each = 1000.0 * v['seconds'] / v['count'] if v['count'] else 0.0
+				lines.append("%-*s %10d %12.3f %10.3f" % (w, k, v['count'], v['seconds'], each))
+		if snap['counters']:
+			lines.append("%-*s %10s" % (w, 'COUNTER', 'VALUE'))
+			for k,v in sorted(snap['counters'].items()):
+				lines.append("%-*s %10d" % (w, k, v))
+
+		return lines
+
+	def print_report(self):
+		for line in self.report():
+			print(line)
+
+	def write_prometheus(self, path, extra=None):
+		"""
+		Write all counters and timers in the Prometheus text exposition format to @path.
+		This is intended for the node_exporter textfile collector so the file is replaced atomically.
+		@extra is an optional list of (metric name, labels dictionary, value) to include as gauges.
+		"""
+		snap = self.snapshot()
+
+		lines = []
+		lines.append('# TYPE pymtar_phase_seconds_total counter')
+		for k,v in sorted(snap['timers'].items()):
+			lines.append('pymtar_phase_seconds_total{phase="%s"} %f' % (k, v['seconds']))
+		lines.append('# TYPE pymtar_phase_count_total counter')
+		for k,v in sorted(snap['timers'].items()):
+			lines.append('pymtar_phase_count_total{phase="%s"} %d' % (k, v['count']))
+		lines.append('# TYPE pymtar_events_total counter')
+		for k,v in sorted(snap['counters'].items()):
+			lines.append('pymtar_events_total{name="%s"} %d' % (k, v))
+
+		for name, labels, value in (extra or []):
+			lbl = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k,v in sorted(labels.items()))
+			lines.append('# TYPE %s gauge' % name)
+			lines.append('%s{%s} %f' % (name, lbl, value))
+
+		# Unique per thread as several drives may export at once
+		tmp = "%s.%d.tmp" % (path, threading.get_ident())
+		with open(tmp, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.replace(tmp, path)
+
+# Process-wide collector
+STATS = Stats()
+
+
+def fmt_bytes(n):
+	"""Format byte count @n with a binary suffix"""
+	for suffix in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+		if abs(n) < 1024 or suffix == 'TiB':
+			break
+		n /= 1024.0
+	return "%.1f %s" % (n, suffix)
+
+class Progress:
+	"""
+	Live single-line console progress with rate and ETA.
+	Updates are cheap to call often; the line is redrawn at most every @interval seconds.
+	"""
+
+	def __init__(self, label, total=None, *, interval=1.0, stream=None, newline=False):
+		self.label = label
+		self.total = total
+		self.interval = interval
+		self.stream = stream or sys.stdout
+		# Print each update on its own line rather than redrawing, for several at once
+		self.newline = newline
+
+		self.done = 0
+		self.start = time.monotonic()
+		self._last = 0.0
+
+	def update(self, n):
+		self.done += n
+
+		now = time.monotonic()
+		if now - self._last >= self.interval:
+			self._last = now
+			self.draw(now)
+
+	def rate(self, now=None):
+		"""Bytes per second since start"""
+		if now is None:
+			now = time.monotonic()
+		dt = now - self.start
+		return self.done / dt if dt > 0 else 0.0
+
+	def draw(self, now=None):
+		rate = self.rate(now)
+
+		line = "%s: %s at %s/s" % (self.label, fmt_bytes(self.done), fmt_bytes(rate))
+		if self.total:
+			pct = 100.0 * self.done / self.total
+			if rate > 0 and self.done < self.total:
+				eta = int((self.total - self.done) / rate)
+				line += ", %.1f%%, ETA %d:%02d:%02d" % (pct, eta // 3600, (eta // 60) % 60, eta % 60)
+			else:
+				line += ", %.1f%%" % pct
+
+		if self.newline:
+			self.stream.write(line + '\n')
+		else:
+			self.stream.write('\r' + line + ' '*8)
+		self.stream.flush()
+
+	def finish(self):
+		self.draw()
+		if not self.newline:
+			self.stream.write('\n')
+		self.stream.flush()
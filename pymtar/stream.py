@@ -0,0 +1,283 @@
+"""
+Streaming of tar data between the archiver and the tape device.
+
+tar(1) writes the archive to a pipe and pymtar copies it to the drive in fixed-size records.
+Reading the pipe happens in a background thread into a bounded buffer so the drive only
+waits when the source genuinely can't keep up, which is counted as an underrun.
+"""
+
+# Global libraries
+import contextlib
+import errno
+import queue
+import threading
+import time
+
+# This library
+from .stats import STATS
+
+
+# tar(1) default blocking factor of 20 512-byte blocks
+RECORD_SIZE = 10240
+
+# Source is read in larger chunks than records to keep per-call overhead down
+CHUNK_SIZE = RECORD_SIZE * 100
+
+# Default amount of data buffered between the source and the drive
+BUFFER_SIZE = 256 * 1024 * 1024
+
+# A writer waiting longer than this for data means the drive would have stopped streaming
+UNDERRUN_SEC = 0.1
+
+
+class ReadBudget:
+	"""
+	Limit on the combined rate that several concurrent streams read their sources.
+	Each active stream gets an equal share, so one drive's sources can't starve another's.
+		budget = ReadBudget(400e6)
+		with budget.share() as share:
+			share.consume(len(chunk))
+	"""
+
+	def __init__(self, rate):
+		self.rate = rate
+		self._lock = threading.Lock()
+		self._active = 0
+
+	@contextlib.contextmanager
+	def share(self):
+		with self._lock:
+			self._active += 1
+		try:
+			yield _Share(self)
+		finally:
+			with self._lock:
+				self._active -= 1
+
+class _Share:
+	"""One stream's share of a ReadBudget"""
+
+	def __init__(self, budget):
+		self._budget = budget
+		self._next = time.monotonic()
+
+	def consume(self, nbytes):
+		"""Account @nbytes just read, sleeping as needed to stay within this stream's share"""
+		rate = self._budget.rate / max(1, self._budget._active)
+
+		now = time.monotonic()
+		# Don't bank unused budget for more than a second of burst
+		self._next = max(self._next, now - 1.0) + nbytes / rate
+		if self._next > now:
+			with STATS.phase('stream.throttle'):
+				time.sleep(self._next - now)
+
+class ThrottledWriter:
+	"""
+	Writer passing everything on to @dst at no more than @rate bytes per second, to stand in
+	for the streaming rate of a drive.
+	"""
+
+	def __init__(self, dst, rate):
+		self.dst = dst
+		self.rate = rate
+		self._next = time.monotonic()
+
+	def write(self, data):
+		now = time.monotonic()
+		self._next = max(self._next, now) + len(data) / self.rate
+		# Records are small, so only sleep once far enough ahead for sleep() to be accurate
+		if self._next - now > 0.01:
+			with STATS.phase('stream.throttle'):
+				time.sleep(self._next - now)
+		return self.dst.write(data)
+
+def _reader(src, q, budget, digest):
+	"""Background thread that fills @q with chunks from @src, ending with None or an exception"""
+	try:
+		with (budget.share() if budget is not None else contextlib.nullcontext()) as share:
+			while True:
+				with STATS.phase('stream.read'):
+					chunk = src.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				if share is not None:
+					share.consume(len(chunk))
+				# Hashed here, off the writer's path, as the bytes written are the same bytes read
+				if digest is not None:
+					digest.update(chunk)
+				q.put(chunk)
+		q.put(None)
+	except Exception as e:
+		q.put(e)
+
+class Pump:
+	"""
+	Copy of @src to one or more destinations in turn, for a tape file continued on the next
+	cartridge when the drive reports the end of the medium.
+		pmp = Pump(src, progress=prog)
+		res = pmp.run(dst)
+		if res['eom']:
+			res = pmp.run(next_dst)
+	Keyword arguments are those of pump(). Each run() copies until @src is done or @dst is full
+	and returns what pump() does for that destination, plus:
+		eom         True if @dst filled up before all of @src was copied
+	Nothing is lost or repeated between runs: whatever @dst didn't accept is the start of the next run.
+	"""
+
+	def __init__(self, src, *, record_size=RECORD_SIZE, buffer_size=BUFFER_SIZE, progress=None, prefix='write', budget=None, digest=None):
+		self.record_size = record_size
+		self.progress = progress
+		self.prefix = prefix
+
+		# Bytes written over all runs
+		self.bytes = 0
+
+		self._q = queue.Queue(maxsize=max(1, buffer_size // CHUNK_SIZE))
+		self._t = threading.Thread(target=_reader, args=(src, self._q, budget, digest), name='pymtar-stream-read', daemon=True)
+		self._pending = b''
+		self._started = False
+		self._done = False
+
+	def _write(self, dst, buf, ret):
+		"""Write all of @buf to @dst a record at a time, returning False if @dst filled up first"""
+		i = 0
+		while i < len(buf):
+			rec = buf[i:i+self.record_size]
+			try:
+				n = dst.write(rec)
+			except OSError as e:
+				if e.errno != errno.ENOSPC:
+					raise
+				# Early warning or end of medium, this record and everything after it goes on the next one
+				self._pending = bytes(buf[i:])
+				return False
+
+			# A drive accepting part of a record at the end of the medium takes the rest next time
+			if n is None:
+				n = len(rec)
+			i += n
+			ret['bytes'] += n
+			if self.progress is not None:
+				self.progress.update(n)
+
+		self._pending = b''
+		return True
+
+	def run(self, dst):
+		ret = {'bytes': 0, 'seconds': 0.0, 'stream': 0.0, 'idle': 0.0, 'underruns': 0, 'eom': False}
+
+		start = time.monotonic()
+		if not self._started:
+			self._t.start()
+			self._started = True
+
+		while not self._done:
+			# Left over from a destination that filled up goes first, a record at a time
+			full = len(self._pending) - (len(self._pending) % self.record_size)
+			if full:
+				chunk = b''
+			else:
+				t0 = time.monotonic()
+				chunk = self._q.get()
+				dt = time.monotonic() - t0
+
+				# Startup wait isn't an underrun as the drive hasn't started streaming yet
+				if ret['bytes']:
+					ret['idle'] += dt
+					if dt > UNDERRUN_SEC:
+						ret['underruns'] += 1
+
+				if isinstance(chunk, Exception):
+					raise chunk
+				if chunk is None:
+					self._done = True
+					break
+
+			buf = memoryview(self._pending + chunk if self._pending else chunk)
+			full = len(buf) - (len(buf) % self.record_size)
+
+			t0 = time.monotonic()
+			ok = self._write(dst, buf[:full], ret)
+			ret['stream'] += time.monotonic() - t0
+			if not ok:
+				# Records not written are still in self._pending ahead of the short trailer
+				self._pending += bytes(buf[full:])
+				ret['eom'] = True
+				break
+			self._pending = bytes(buf[full:])
+
+		# Archive should be record-aligned, but don't lose a short trailer if not
+		if self._done and self._pending:
+			t0 = time.monotonic()
+			ret['eom'] = not self._write(dst, memoryview(self._pending), ret)
+			ret['stream'] += time.monotonic() - t0
+
+		if self._done and not ret['eom']:
+			self._t.join()
+		ret['seconds'] = time.monotonic() - start
+		self.bytes += ret['bytes']
+
+		STATS.add_time(self.prefix + '.stream', ret['stream'])
+		STATS.add_time(self.prefix + '.idle', ret['idle'])
+		STATS.incr(self.prefix + '.bytes', ret['bytes'])
+		STATS.incr(self.prefix + '.underruns', ret['underruns'])
+		if ret['eom']:
+			STATS.incr(self.prefix + '.eom')
+
+		return ret
+
+def pump(src, dst, *, record_size=RECORD_SIZE, buffer_size=BUFFER_SIZE, progress=None, prefix='write', budget=None, digest=None):
+	"""
+	Copy all of @src to @dst in records of @record_size bytes through a buffer of @buffer_size bytes.
+	@progress is an optional stats.Progress to update as data is written.
+	Phase times are accounted under @prefix (eg, "write.stream", "write.idle").
+	@budget is an optional ReadBudget shared with other streams to limit reading @src.
+	@digest is an optional digest.StreamDigest updated with everything copied (finish() is left to the caller).
+	Raises OSError(ENOSPC) if @dst fills up, use Pump to continue elsewhere instead.
+
+	Returns a dictionary of:
+		bytes       Bytes written
+		seconds     Wall clock time of the copy
+		stream      Seconds spent writing to @dst
+		idle        Seconds @dst sat waiting on @src
+		underruns   Number of waits on @src longer than UNDERRUN_SEC
+	"""
+	ret = Pump(src, record_size=record_size, buffer_size=buffer_size, progress=progress, prefix=prefix, budget=budget, digest=digest).run(dst)
+	if ret['eom']:
+		raise OSError(errno.ENOSPC, "End of medium after %d bytes" % ret['bytes'])
+	del ret['eom']
+	return ret
+
+
+class ConcatReader:
+	"""
+	File-like reader of several sources one after another, for a tar continued across cartridges.
+	@openers are functions each returning a context manager that gives a file object, called only
+	once the source before it is used up (eg, after the next cartridge is loaded).
+	"""
+
+	def __init__(self, openers):
+		self._openers = iter(openers)
+		self._stack = None
+		self._f = None
+
+	def read(self, n=-1):
+		while True:
+			if self._f is None:
+				opener = next(self._openers, None)
+				if opener is None:
+					return b''
+				self._stack = contextlib.ExitStack()
+				self._f = self._stack.enter_context(opener())
+
+			data = self._f.read(n)
+			if data:
+				return data
+
+			self.close()
+
+	def close(self):
+		if self._stack is not None:
+			self._stack.close()
+		self._stack = self._f = None
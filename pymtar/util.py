@@ -1,6 +1,5 @@
 
 import datetime
-import subprocess
 
 class ItemExists(Exception): pass
 class ItemNotFound(Exception): pass
@@ -41,6 +40,8 @@ def hashfile(f):
 	As I suspect sha256sum is faster I will invoke it through subprocess.
 	"""
 
+	import subprocess
+
 	args = ['sha256sum', f]
 	ret = subprocess.run(args, stdout=subprocess.PIPE)
 	return ret.stdout.decode('utf-8').split(' ')[0]
@@ -100,6 +101,8 @@ class DataArgsParser:
 
 def getuname():
 	"""Call `uname -a` to get system information"""
+	import subprocess
+
 	ret = subprocess.run(['uname', '-a'], stdout=subprocess.PIPE)
 	return ret.stdout.decode('ascii').strip()
 